@@ -6,17 +6,24 @@ Script demonstrating how to create posts using the Bluesky API, covering most of
 To run this Python script, you need the 'requests' and 'bs4' (BeautifulSoup) packages installed.
 """
 
-import re
 import os
 import sys
 import json
+import mmap
+import base64
+import time
 import argparse
-from typing import Dict, List
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import requests
 from bs4 import BeautifulSoup
 
+from richtext import tokenize, mention_handles, facets_from_tokens
+
 
 def bsky_login_session(pds_url: str, handle: str, password: str) -> Dict:
     resp = requests.post(
@@ -27,20 +34,39 @@ def bsky_login_session(pds_url: str, handle: str, password: str) -> Dict:
     return resp.json()
 
 
+# exchanges a session's refresh token for new access and refresh tokens (refresh tokens are single-use)
+def bsky_refresh_session(pds_url: str, refresh_jwt: str) -> Dict:
+    resp = requests.post(
+        pds_url + "/xrpc/com.atproto.server.refreshSession",
+        headers={"Authorization": "Bearer " + refresh_jwt},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+# expiry time (unix seconds) of a JWT, or None if it can't be read. the signature isn't checked: this is only used to decide when to refresh our own session
+def jwt_expiry(token: str) -> Optional[int]:
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return int(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def test_jwt_expiry():
+    claims = base64.urlsafe_b64encode(json.dumps({"exp": 1700000000}).encode()).rstrip(b"=").decode()
+    assert jwt_expiry(f"eyJhbGciOiJIUzI1NiJ9.{claims}.sig") == 1700000000
+    assert jwt_expiry("not-a-jwt") is None
+    assert jwt_expiry("a.b.c") is None
+
+
 def parse_mentions(text: str) -> List[Dict]:
-    spans = []
-    # regex based on: https://atproto.com/specs/handle#handle-identifier-syntax
-    mention_regex = rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in re.finditer(mention_regex, text_bytes):
-        spans.append(
-            {
-                "start": m.start(1),
-                "end": m.end(1),
-                "handle": m.group(1)[1:].decode("UTF-8"),
-            }
-        )
-    return spans
+    return [
+        {"start": t["start"], "end": t["end"], "handle": t["value"]}
+        for t in tokenize(text)
+        if t["type"] == "mention"
+    ]
 
 
 def test_parse_mentions():
@@ -60,20 +86,11 @@ def test_parse_mentions():
 
 
 def parse_urls(text: str) -> List[Dict]:
-    spans = []
-    # partial/naive URL regex based on: https://stackoverflow.com/a/3809435
-    # tweaked to disallow some training punctuation
-    url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in re.finditer(url_regex, text_bytes):
-        spans.append(
-            {
-                "start": m.start(1),
-                "end": m.end(1),
-                "url": m.group(1).decode("UTF-8"),
-            }
-        )
-    return spans
+    return [
+        {"start": t["start"], "end": t["end"], "url": t["value"]}
+        for t in tokenize(text)
+        if t["type"] == "link"
+    ]
 
 
 def test_parse_urls():
@@ -91,7 +108,6 @@ def test_parse_urls():
     assert parse_urls("ref [https://bsky.app]") == [
         {"start": 5, "end": 21, "url": "https://bsky.app"}
     ]
-    # note: a better regex would not mangle these:
     assert parse_urls("ref (https://bsky.app/)") == [
         {"start": 5, "end": 22, "url": "https://bsky.app/"}
     ]
@@ -100,48 +116,147 @@ def test_parse_urls():
     ]
 
 
+# Handle to DID resolutions are cached in a JSON file between runs. Set BSKY_HANDLE_CACHE to use another file, or to an empty string to disable the cache.
+HANDLE_CACHE_PATH = os.environ.get(
+    "BSKY_HANDLE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "create_bsky_post", "handles.json"),
+)
+# handles can be changed (or moved to another account), so cached DIDs expire. handles which didn't resolve are only remembered briefly
+HANDLE_CACHE_TTL = 24 * 60 * 60
+HANDLE_CACHE_NEGATIVE_TTL = 10 * 60
+# only this many distinct handles are resolved per post (in order of first mention); further mentions are left as plain text, like in the python-oauth-web-app example
+MAX_MENTIONS = 10
+# most concurrent resolveHandle requests per post
+MAX_CONCURRENT_RESOLVES = 8
+
+
+class HandleCache:
+    """
+    handle -> DID (or None, if the handle didn't resolve) mapping with expiry, persisted as a JSON file
+
+    the file is loaded on first use, and rewritten (atomically) by save() when there are new entries; main() saves it once, when the script is done. safe to use from several threads
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.loaded = False
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.loaded = True
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"ignoring unreadable handle cache {self.path}: {e}", file=sys.stderr)
+
+    # returns (True, did) for a cached handle (did is None if it didn't resolve), or (False, None)
+    def get(self, handle: str) -> Tuple[bool, Optional[str]]:
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            entry = self.entries.get(handle.lower())
+        if entry is None or entry["expires"] < time.time():
+            return False, None
+        return True, entry["did"]
+
+    def put(self, handle: str, did: Optional[str]):
+        ttl = HANDLE_CACHE_TTL if did else HANDLE_CACHE_NEGATIVE_TTL
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            self.entries[handle.lower()] = {"did": did, "expires": time.time() + ttl}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not (self.path and self.dirty):
+                return
+            now = time.time()
+            self.entries = {h: e for h, e in self.entries.items() if e["expires"] >= now}
+            try:
+                directory = os.path.dirname(self.path) or "."
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp_path, self.path)
+                self.dirty = False
+            except OSError as e:
+                print(f"failed to write handle cache {self.path}: {e}", file=sys.stderr)
+
+
+HANDLE_CACHE = HandleCache(HANDLE_CACHE_PATH)
+
+
+def test_handle_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache", "handles.json")
+        cache = HandleCache(path)
+        assert cache.get("handle.example.com") == (False, None)
+        cache.put("Handle.Example.com", "did:plc:abc")
+        cache.put("missing.example.com", None)
+        cache.save()
+        cache = HandleCache(path)
+        assert cache.get("handle.example.com") == (True, "did:plc:abc")
+        assert cache.get("missing.example.com") == (True, None)
+        cache.entries["handle.example.com"]["expires"] = time.time() - 1
+        assert cache.get("handle.example.com") == (False, None)
+
+
+# resolves a handle to a DID, or None if it doesn't resolve
+def resolve_handle(pds_url: str, handle: str) -> Optional[str]:
+    resp = requests.get(
+        pds_url + "/xrpc/com.atproto.identity.resolveHandle",
+        params={"handle": handle},
+    )
+    if resp.status_code == 400:
+        return None
+    resp.raise_for_status()
+    return resp.json()["did"]
+
+
+def resolve_handles(pds_url: str, handles: List[str]) -> Dict[str, Optional[str]]:
+    """
+    resolves a set of handles to DIDs (None for any which don't resolve), keyed by lower-cased handle
+
+    duplicates are resolved once, cached handles not at all, and the rest concurrently, up to MAX_CONCURRENT_RESOLVES at a time (so more uncached handles than that take more than one round trip)
+    """
+    dids = {}
+    missing = []
+    for handle in set(h.lower() for h in handles):
+        found, did = HANDLE_CACHE.get(handle)
+        if found:
+            dids[handle] = did
+        else:
+            missing.append(handle)
+    if not missing:
+        return dids
+
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_RESOLVES, len(missing))) as pool:
+        results = pool.map(lambda handle: resolve_handle(pds_url, handle), missing)
+        for handle, did in zip(missing, results):
+            dids[handle] = did
+            HANDLE_CACHE.put(handle, did)
+    return dids
+
+
 def parse_facets(pds_url: str, text: str) -> List[Dict]:
     """
-    parses post text and returns a list of app.bsky.richtext.facet objects for any mentions (@handle.example.com) or URLs (https://example.com)
+    parses post text and returns a list of app.bsky.richtext.facet objects for any mentions (@handle.example.com), URLs (https://example.com) or hashtags (#tag), using the tokenizer in richtext.py
 
     indexing must work with UTF-8 encoded bytestring offsets, not regular unicode string offsets, to match Bluesky API expectations
     """
-    facets = []
-    for m in parse_mentions(text):
-        resp = requests.get(
-            pds_url + "/xrpc/com.atproto.identity.resolveHandle",
-            params={"handle": m["handle"]},
-        )
-        # if handle couldn't be resolved, just skip it! will be text in the post
-        if resp.status_code == 400:
-            continue
-        did = resp.json()["did"]
-        facets.append(
-            {
-                "index": {
-                    "byteStart": m["start"],
-                    "byteEnd": m["end"],
-                },
-                "features": [{"$type": "app.bsky.richtext.facet#mention", "did": did}],
-            }
-        )
-    for u in parse_urls(text):
-        facets.append(
-            {
-                "index": {
-                    "byteStart": u["start"],
-                    "byteEnd": u["end"],
-                },
-                "features": [
-                    {
-                        "$type": "app.bsky.richtext.facet#link",
-                        # NOTE: URI ("I") not URL ("L")
-                        "uri": u["url"],
-                    }
-                ],
-            }
-        )
-    return facets
+    tokens = tokenize(text)
+    # if a handle couldn't be resolved (or is past MAX_MENTIONS), it is just skipped! will be text in the post
+    dids = resolve_handles(pds_url, mention_handles(tokens)[:MAX_MENTIONS])
+    return facets_from_tokens(tokens, dids)
 
 
 def parse_uri(uri: str) -> Dict:
@@ -197,15 +312,47 @@ def get_reply_refs(pds_url: str, parent_uri: str) -> Dict:
     }
 
 
-def upload_file(pds_url, access_token, filename, img_bytes) -> Dict:
+# this size limit specified in the app.bsky.embed.images lexicon
+MAX_IMAGE_SIZE = 2000000
+
+
+# detects the image format from the first few bytes of the file ("magic numbers"), falling back to the file name suffix
+def sniff_mimetype(filename: str, head: bytes) -> str:
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    if head[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+
     suffix = filename.split(".")[-1].lower()
-    mimetype = "application/octet-stream"
     if suffix in ["png"]:
-        mimetype = "image/png"
+        return "image/png"
     elif suffix in ["jpeg", "jpg"]:
-        mimetype = "image/jpeg"
+        return "image/jpeg"
     elif suffix in ["webp"]:
-        mimetype = "image/webp"
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def test_sniff_mimetype():
+    assert sniff_mimetype("a.jpg", b"\x89PNG\r\n\x1a\n\x00\x00") == "image/png"
+    assert sniff_mimetype("a", b"\xff\xd8\xff\xe0\x00\x10JFIF") == "image/jpeg"
+    assert sniff_mimetype("a.png", b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_mimetype("a.webp", b"GIF89a") == "image/gif"
+    assert sniff_mimetype("photo.JPG", b"") == "image/jpeg"
+    assert sniff_mimetype("https://example.com/thumb", b"<html>") == "application/octet-stream"
+
+
+# 'img_bytes' can be a bytes object, or a memory-mapped file (which is then streamed, instead of copied into memory)
+def upload_file(pds_url, access_token, filename, img_bytes) -> Dict:
+    mimetype = sniff_mimetype(filename, img_bytes[:16])
 
     # WARNING: a non-naive implementation would strip EXIF metadata from JPEG files here by default
     resp = requests.post(
@@ -220,23 +367,32 @@ def upload_file(pds_url, access_token, filename, img_bytes) -> Dict:
     return resp.json()["blob"]
 
 
+def upload_image_file(pds_url: str, access_token: str, path: str) -> Dict:
+    with open(path, "rb") as f:
+        # the file is mapped rather than read: the request body is streamed from the page cache, without a copy of the whole file in memory
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as img:
+            return upload_file(pds_url, access_token, path, img)
+
+
 def upload_images(
     pds_url: str, access_token: str, image_paths: List[str], alt_text: str
 ) -> Dict:
-    images = []
+    # check all the sizes up front (without reading the files), so that no upload is wasted on a post which would fail anyway
     for ip in image_paths:
-        with open(ip, "rb") as f:
-            img_bytes = f.read()
-        # this size limit specified in the app.bsky.embed.images lexicon
-        if len(img_bytes) > 2000000:
+        size = os.stat(ip).st_size
+        if size > MAX_IMAGE_SIZE:
             raise Exception(
-                f"image file size too large. 2000000 bytes maximum, got: {len(img_bytes)}"
+                f"image file size too large. {MAX_IMAGE_SIZE} bytes maximum, got: {size}"
             )
-        blob = upload_file(pds_url, access_token, ip, img_bytes)
-        images.append({"alt": alt_text or "", "image": blob})
+        if size == 0:
+            raise Exception(f"image file is empty: {ip}")
+
+    # the images are uploaded concurrently (there are at most 4), so this takes about as long as the slowest upload
+    with ThreadPoolExecutor(max_workers=len(image_paths)) as pool:
+        blobs = list(pool.map(lambda ip: upload_image_file(pds_url, access_token, ip), image_paths))
     return {
         "$type": "app.bsky.embed.images",
-        "images": images,
+        "images": [{"alt": alt_text or "", "image": blob} for blob in blobs],
     }
 
 
@@ -282,7 +438,7 @@ def get_embed_ref(pds_url: str, ref_uri: str) -> Dict:
         pds_url + "/xrpc/com.atproto.repo.getRecord",
         params=uri_parts,
     )
-    print(resp.json())
+    print(resp.json(), file=sys.stderr)
     resp.raise_for_status()
     record = resp.json()
 
@@ -295,49 +451,57 @@ def get_embed_ref(pds_url: str, ref_uri: str) -> Dict:
     }
 
 
-def create_post(args):
-    session = bsky_login_session(args.pds_url, args.handle, args.password)
-
+def build_post(
+    pds_url: str,
+    access_token: str,
+    text: str,
+    langs: Optional[List[str]] = None,
+    reply_to: Optional[str] = None,
+    reply_refs: Optional[Dict] = None,
+    images: Optional[List[str]] = None,
+    alt_text: Optional[str] = None,
+    embed_url: Optional[str] = None,
+    embed_ref: Optional[str] = None,
+) -> Dict:
     # trailing "Z" is preferred over "+00:00"
     now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
     # these are the required fields which every post must include
     post = {
         "$type": "app.bsky.feed.post",
-        "text": args.text,
+        "text": text,
         "createdAt": now,
     }
 
     # indicate included languages (optional)
-    if args.lang:
-        post["langs"] = args.lang
+    if langs:
+        post["langs"] = langs
 
     # parse out mentions and URLs as "facets"
-    if len(args.text) > 0:
-        facets = parse_facets(args.pds_url, post["text"])
+    if len(text) > 0:
+        facets = parse_facets(pds_url, post["text"])
         if facets:
             post["facets"] = facets
 
-    # if this is a reply, get references to the parent and root
-    if args.reply_to:
-        post["reply"] = get_reply_refs(args.pds_url, args.reply_to)
+    # if this is a reply, get references to the parent and root (unless the caller already has them)
+    if reply_refs:
+        post["reply"] = reply_refs
+    elif reply_to:
+        post["reply"] = get_reply_refs(pds_url, reply_to)
 
-    if args.image:
-        post["embed"] = upload_images(
-            args.pds_url, session["accessJwt"], args.image, args.alt_text
-        )
-    elif args.embed_url:
-        post["embed"] = fetch_embed_url_card(
-            args.pds_url, session["accessJwt"], args.embed_url
-        )
-    elif args.embed_ref:
-        post["embed"] = get_embed_ref(args.pds_url, args.embed_ref)
+    if images:
+        post["embed"] = upload_images(pds_url, access_token, images, alt_text)
+    elif embed_url:
+        post["embed"] = fetch_embed_url_card(pds_url, access_token, embed_url)
+    elif embed_ref:
+        post["embed"] = get_embed_ref(pds_url, embed_ref)
 
-    print("creating post:", file=sys.stderr)
-    print(json.dumps(post, indent=2), file=sys.stderr)
+    return post
 
-    resp = requests.post(
-        args.pds_url + "/xrpc/com.atproto.repo.createRecord",
+
+def create_record(pds_url: str, session: Dict, post: Dict) -> requests.Response:
+    return requests.post(
+        pds_url + "/xrpc/com.atproto.repo.createRecord",
         headers={"Authorization": "Bearer " + session["accessJwt"]},
         json={
             "repo": session["did"],
@@ -345,11 +509,248 @@ def create_post(args):
             "record": post,
         },
     )
+
+
+def create_post(args):
+    session = bsky_login_session(args.pds_url, args.handle, args.password)
+
+    post = build_post(
+        args.pds_url,
+        session["accessJwt"],
+        args.text,
+        langs=args.lang,
+        reply_to=args.reply_to,
+        images=args.image,
+        alt_text=args.alt_text,
+        embed_url=args.embed_url,
+        embed_ref=args.embed_ref,
+    )
+
+    print("creating post:", file=sys.stderr)
+    print(json.dumps(post, indent=2), file=sys.stderr)
+
+    resp = create_record(args.pds_url, session, post)
     print("createRecord response:", file=sys.stderr)
     print(json.dumps(resp.json(), indent=2))
     resp.raise_for_status()
 
 
+# reply refs for a reply to a post which was just created, from its createRecord response: the thread root carries over from the new post's own reply refs, or is the new post itself if it wasn't a reply. this saves the getRecord round trips get_reply_refs would make
+def next_reply_refs(created: Dict, created_reply_refs: Optional[Dict]) -> Dict:
+    parent = {"uri": created["uri"], "cid": created["cid"]}
+    root = created_reply_refs["root"] if created_reply_refs else parent
+    return {"root": root, "parent": parent}
+
+
+def create_thread(args):
+    """
+    creates a thread: the first text is a regular post (or a reply to --reply-to), and each of the following ones a reply to the one before it
+
+    languages apply to every post, images and embeds only to the first one
+    """
+    session = bsky_login_session(args.pds_url, args.handle, args.password)
+
+    reply_refs = get_reply_refs(args.pds_url, args.reply_to) if args.reply_to else None
+    for i, text in enumerate(args.text):
+        first = i == 0
+        post = build_post(
+            args.pds_url,
+            session["accessJwt"],
+            text,
+            langs=args.lang,
+            reply_refs=reply_refs,
+            images=args.image if first else None,
+            alt_text=args.alt_text,
+            embed_url=args.embed_url if first else None,
+            embed_ref=args.embed_ref if first else None,
+        )
+
+        print(f"creating post {i + 1}/{len(args.text)}:", file=sys.stderr)
+        print(json.dumps(post, indent=2), file=sys.stderr)
+
+        resp = create_record(args.pds_url, session, post)
+        print(json.dumps(resp.json()))
+        resp.raise_for_status()
+        reply_refs = next_reply_refs(resp.json(), post.get("reply"))
+
+
+def test_next_reply_refs():
+    first = {"uri": "at://did:plc:abc/app.bsky.feed.post/1", "cid": "bafy1"}
+    second = {"uri": "at://did:plc:abc/app.bsky.feed.post/2", "cid": "bafy2"}
+    third = {"uri": "at://did:plc:abc/app.bsky.feed.post/3", "cid": "bafy3"}
+    refs = next_reply_refs(first, None)
+    assert refs == {"root": first, "parent": first}
+    refs = next_reply_refs(dict(second, validationStatus="valid"), refs)
+    assert refs == {"root": first, "parent": second}
+    assert next_reply_refs(third, refs) == {"root": first, "parent": third}
+
+
+# Fields of a post spec in batch mode (one JSON object per input line), eg:
+#
+#   {"text": "hello #bsky", "langs": ["en"], "images": ["cat.jpg"], "alt_text": "a cat"}
+#   {"text": "a reply", "reply_to": "at://did:plc:abc/app.bsky.feed.post/3k..."}
+#   {"text": "a link", "embed_url": "https://atproto.com"}
+BATCH_FIELDS = ["text", "langs", "images", "alt_text", "reply_to", "embed_url", "embed_ref"]
+
+
+def parse_batch_spec(line: str) -> Dict:
+    spec = json.loads(line)
+    if not isinstance(spec, dict):
+        raise ValueError("post spec must be a JSON object")
+    unknown = set(spec) - set(BATCH_FIELDS)
+    if unknown:
+        raise ValueError("unknown post spec fields: " + ", ".join(sorted(unknown)))
+    if not isinstance(spec.get("text", ""), str):
+        raise ValueError("post text must be a string")
+    for field in ["alt_text", "reply_to", "embed_url", "embed_ref"]:
+        if spec.get(field) is not None and not isinstance(spec[field], str):
+            raise ValueError(f"post {field} must be a string")
+    for field in ["langs", "images"]:
+        value = spec.get(field)
+        if value is not None and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            raise ValueError(f"post {field} must be a list of strings")
+    if len(spec.get("images") or []) > 4:
+        raise ValueError("at most 4 images per post")
+    return spec
+
+
+def test_parse_batch_spec():
+    spec = parse_batch_spec('{"text": "hi", "langs": ["en"], "images": ["cat.jpg"]}')
+    assert spec == {"text": "hi", "langs": ["en"], "images": ["cat.jpg"]}
+    for line in [
+        "[]",
+        '{"text": 1}',
+        '{"bogus": 1}',
+        '{"langs": "en"}',
+        '{"images": "cat.jpg"}',
+        '{"images": [1]}',
+        '{"alt_text": ["a cat"]}',
+        '{"images": ["1", "2", "3", "4", "5"]}',
+    ]:
+        try:
+            parse_batch_spec(line)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted invalid post spec: {line}")
+
+
+# access tokens from createSession are short-lived (a couple of hours), so long batches refresh the session when the access token expires within this many seconds
+SESSION_REFRESH_MARGIN = 5 * 60
+
+
+class BatchSession:
+    """
+    login session shared by the batch workers, which is refreshed (com.atproto.server.refreshSession) shortly before the access token expires, or if the PDS says it has expired anyway
+
+    refreshes are serialized, since refresh tokens are single-use
+    """
+
+    def __init__(self, pds_url: str, session: Dict):
+        self.pds_url = pds_url
+        self.session = session
+        self.lock = threading.Lock()
+
+    # the current session, refreshed first if its access token is about to expire
+    def get(self) -> Dict:
+        with self.lock:
+            expires = jwt_expiry(self.session["accessJwt"])
+            if expires is not None and expires - SESSION_REFRESH_MARGIN < time.time():
+                self._refresh()
+            return self.session
+
+    # refreshes the session after 'stale' was rejected as expired, unless another worker already did
+    def refresh(self, stale: Dict) -> Dict:
+        with self.lock:
+            if self.session["accessJwt"] == stale["accessJwt"]:
+                self._refresh()
+            return self.session
+
+    def _refresh(self):
+        print("refreshing session", file=sys.stderr)
+        self.session = bsky_refresh_session(self.pds_url, self.session["refreshJwt"])
+
+
+# the PDS rejects an expired access token with HTTP 400 and the error "ExpiredToken"
+def is_expired_token(resp: requests.Response) -> bool:
+    if resp.status_code != 400:
+        return False
+    try:
+        return resp.json().get("error") == "ExpiredToken"
+    except ValueError:
+        return False
+
+
+def create_batch_post(pds_url: str, batch_session: BatchSession, spec: Dict) -> Dict:
+    session = batch_session.get()
+    post = build_post(
+        pds_url,
+        session["accessJwt"],
+        spec.get("text", ""),
+        langs=spec.get("langs"),
+        reply_to=spec.get("reply_to"),
+        images=spec.get("images"),
+        alt_text=spec.get("alt_text"),
+        embed_url=spec.get("embed_url"),
+        embed_ref=spec.get("embed_ref"),
+    )
+    resp = create_record(pds_url, session, post)
+    if is_expired_token(resp):
+        resp = create_record(pds_url, batch_session.refresh(session), post)
+    if not resp.ok:
+        raise Exception(f"createRecord failed ({resp.status_code}): {resp.text}")
+    record = resp.json()
+    return {"uri": record["uri"], "cid": record["cid"]}
+
+
+def create_posts_batch(args):
+    """
+    creates one post per line of a JSONL file (or stdin), logging in only once (the session is refreshed as needed, see BatchSession)
+
+    posts are created concurrently by a pool of 'args.workers' threads, and a result line is printed to stdout as each one finishes (so in completion order, not input order):
+
+        {"line": 3, "uri": "at://...", "cid": "...", "error": null}
+
+    where "line" is the line number in the input. the input is read incrementally, so it can be arbitrarily long
+    """
+    session = BatchSession(args.pds_url, bsky_login_session(args.pds_url, args.handle, args.password))
+    infile = sys.stdin if args.batch == "-" else open(args.batch)
+
+    output_lock = threading.Lock()
+    # limits how far reading the input gets ahead of the workers
+    pending = threading.BoundedSemaphore(args.workers * 2)
+    counts = {"created": 0, "failed": 0}
+
+    def emit(lineno: int, uri: Optional[str], cid: Optional[str], error: Optional[str]):
+        with output_lock:
+            counts["failed" if error else "created"] += 1
+            print(json.dumps({"line": lineno, "uri": uri, "cid": cid, "error": error}), flush=True)
+
+    def worker(lineno: int, spec: Dict):
+        try:
+            result = create_batch_post(args.pds_url, session, spec)
+            emit(lineno, result["uri"], result["cid"], None)
+        except Exception as e:
+            emit(lineno, None, None, f"{type(e).__name__}: {e}")
+        finally:
+            pending.release()
+
+    with infile, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for lineno, line in enumerate(infile, start=1):
+            if not line.strip():
+                continue
+            try:
+                spec = parse_batch_spec(line)
+            except ValueError as e:
+                emit(lineno, None, None, f"{type(e).__name__}: {e}")
+                continue
+            pending.acquire()
+            pool.submit(worker, lineno, spec)
+
+    print(f"created {counts['created']} posts, {counts['failed']} failed", file=sys.stderr)
+    if counts["failed"]:
+        sys.exit(1)
+
+
 def main():
     parser = argparse.ArgumentParser(description="bsky.app post upload example script")
     parser.add_argument(
@@ -357,13 +758,28 @@ def main():
     )
     parser.add_argument("--handle", default=os.environ.get("ATP_AUTH_HANDLE"))
     parser.add_argument("--password", default=os.environ.get("ATP_AUTH_PASSWORD"))
-    parser.add_argument("text", default="")
+    parser.add_argument(
+        "text", nargs="*", default=[], help="post text (required, except with --batch); several with --thread"
+    )
     parser.add_argument("--image", action="append")
     parser.add_argument("--alt-text")
     parser.add_argument("--lang", action="append")
     parser.add_argument("--reply-to")
     parser.add_argument("--embed-url")
     parser.add_argument("--embed-ref")
+    parser.add_argument(
+        "--thread",
+        action="store_true",
+        help="post each text argument as a reply to the one before it",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="create one post per line of this JSONL file ('-' for stdin), instead of a single post",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="posts created concurrently in batch mode"
+    )
     args = parser.parse_args()
     if not args.pds_url:
         print("PDS host must be supplied", file=sys.stderr)
@@ -374,7 +790,32 @@ def main():
     if args.image and len(args.image) > 4:
         print("at most 4 images per post", file=sys.stderr)
         sys.exit(-1)
-    create_post(args)
+    if args.batch and args.text:
+        print("post text can't be combined with --batch", file=sys.stderr)
+        sys.exit(-1)
+    if not (args.batch or args.text):
+        print("post text is required", file=sys.stderr)
+        sys.exit(-1)
+    if any(not text.strip() for text in args.text):
+        print("post text can't be empty", file=sys.stderr)
+        sys.exit(-1)
+    # handle resolutions are written to the cache file once, at the end (also if a post failed)
+    try:
+        if args.batch:
+            if args.workers < 1:
+                print("--workers must be at least 1", file=sys.stderr)
+                sys.exit(-1)
+            create_posts_batch(args)
+        elif args.thread:
+            create_thread(args)
+        else:
+            if len(args.text) > 1:
+                print("only one post text allowed (use --thread to post several)", file=sys.stderr)
+                sys.exit(-1)
+            args.text = args.text[0]
+            create_post(args)
+    finally:
+        HANDLE_CACHE.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+import os
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+# Rich-text tokenizer for Bluesky posts: finds mentions (@handle.example.com), links (https://example.com/...) and hashtags (#tag) in a single left-to-right pass, and turns them into app.bsky.richtext.facet objects.
+#
+# This file is shared by the python-bsky-post and python-oauth-web-app examples. The examples are standalone directories, so each has a copy; the two copies must be kept identical. test_copies_match() fails if they aren't, and runs with the rest of the tests ('make test-all', or 'python richtext.py' in either directory).
+#
+# Facet indexes are UTF-8 byte offsets, not string offsets.
+#
+# The cost is linear in the length of the text for any input: candidate positions are found with a regex of fixed strings, and each candidate is scanned with single character-class runs (which can't backtrack) followed by validation. A candidate's scan never contains another candidate of the same kind, so no character is scanned more than a few times. For mentions and hashtags, the candidate regex also captures the run of characters to validate, so most of the scanning is done inside the regex engine. On a corpus of ordinary posts this is about as fast as the separate regexes it replaced; text which is dense with tokens is slower (about 2x), because each token costs some Python code (see benchmarks/bench_richtext.py).
+
+# Where a token might start: an '@' or "http(s)://" after a non-word character, or a '#' after whitespace (or at the start of the text). Each alternative is a fixed string with single-character lookarounds, so this can't backtrack either. (The lookbehinds come after the first character, so that the regex engine can skip ahead to the next '@', 'h' or '#'.)
+# Mentions capture (group 1) the run of characters which can appear in a handle, and hashtags (group 2) the run up to whitespace or one of the zero-width and formatting characters which end a tag. The runs are in lookaheads, so they don't hide any candidates inside them from finditer().
+CANDIDATE_REGEX = re.compile(
+    r"@(?<!\w@)(?=([a-zA-Z0-9][a-zA-Z0-9.-]*))"
+    r"|h(?<!\wh)ttps?://"
+    r"|[#＃](?<!\S[#＃])(?=([^\s\u00ad\u2060\u200a\u200b\u200c\u200d\u20e2]+))"
+)
+# Characters which can appear in the host part of a URL
+HOST_RUN_REGEX = re.compile(r"[a-zA-Z0-9.-]*")
+# Characters which can appear in the path, query or fragment of a URL (after the host)
+URL_PATH_RUN_REGEX = re.compile(r"[a-zA-Z0-9._~:/?#@!$&'()*+,;=%-]*")
+PORT_RUN_REGEX = re.compile(r"[0-9]*")
+# The ASCII characters in the Unicode punctuation ("P") categories
+ASCII_PUNCTUATION = "!\"#%&'()*,-./:;?@[\\]_{}"
+# Trailing characters which are usually sentence punctuation rather than part of a URL
+URL_TRAILING_PUNCTUATION = ".,;:!?'"
+# Longest hashtag (in characters, not including the '#')
+MAX_TAG_LENGTH = 64
+MAX_HANDLE_LENGTH = 253
+# A valid handle has at least two labels, of 1-63 letters, digits and hyphens, which don't start or end with a hyphen, and the last one (the TLD) starts with a letter. Only used on strings of at most MAX_HANDLE_LENGTH characters, so the (bounded) backtracking can't add up.
+HANDLE_SYNTAX_REGEX = re.compile(
+    r"(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?"
+)
+
+
+def is_valid_handle_syntax(handle: str) -> bool:
+    return len(handle) <= MAX_HANDLE_LENGTH and HANDLE_SYNTAX_REGEX.fullmatch(handle) is not None
+
+
+# Returns the handle at the start of 'run' (the handle characters following an '@'), or None if it isn't a valid handle
+def scan_mention(run: str) -> Optional[str]:
+    # trailing dots and hyphens can't end a handle, and are more likely punctuation ("ping @me.example.com.")
+    handle = run.rstrip(".-")
+    if is_valid_handle_syntax(handle):
+        return handle
+    return None
+
+
+# Returns the end (exclusive) of a URL starting at 'start' ("http://" or "https://"), or -1 if the host isn't valid
+def scan_url(text: str, start: int, scheme_len: int) -> int:
+    n = len(text)
+    end = HOST_RUN_REGEX.match(text, start + scheme_len).end()
+    host_end = end
+    while host_end > start + scheme_len and text[host_end - 1] in ".-":
+        host_end -= 1
+    host = text[start + scheme_len : host_end]
+    labels = host.split(".")
+    if len(labels) < 2 or not all(labels) or not labels[-1].isalnum():
+        return -1
+    if host_end < end:
+        # the host was followed by punctuation, so that's the end of the URL
+        return host_end
+    end = host_end
+    # optional port
+    if end + 1 < n and text[end] == ":" and text[end + 1].isdigit():
+        end = PORT_RUN_REGEX.match(text, end + 1).end()
+    if end < n and text[end] in "/?#":
+        path_start = end
+        end = URL_PATH_RUN_REGEX.match(text, end).end()
+        # trim trailing punctuation, and closing brackets which don't have a matching opening one in the URL ("(see https://example.com/a)")
+        opened = text.count("(", path_start, end)
+        closed = text.count(")", path_start, end)
+        while end > path_start + 1:
+            c = text[end - 1]
+            if c in URL_TRAILING_PUNCTUATION:
+                end -= 1
+            elif c == ")" and closed > opened:
+                end -= 1
+                closed -= 1
+            else:
+                break
+    return end
+
+
+# Returns the tag at the start of 'run' (the characters following a '#', up to whitespace), or None if it isn't a valid tag
+def scan_tag(run: str) -> Optional[str]:
+    # trailing punctuation isn't part of the tag ("#atproto!"). ASCII punctuation is stripped in one go, as a shortcut; the Unicode category is only looked up for other characters
+    tag = run.rstrip(ASCII_PUNCTUATION)
+    end = len(tag)
+    while end and (tag[end - 1] in ASCII_PUNCTUATION or (tag[end - 1] >= "\x80" and unicodedata.category(tag[end - 1]).startswith("P"))):
+        end -= 1
+    tag = tag[:end]
+    # a tag can't be empty, all digits ("#1"), start with a variation selector (keycap emoji), or be too long
+    if not tag or tag.isdigit() or tag[0] == "\ufe0f" or len(tag) > MAX_TAG_LENGTH:
+        return None
+    return tag
+
+
+def tokenize(text: str) -> List[Dict]:
+    """
+    finds all mentions, links and hashtags in 'text', in order. each token is a dict with "type" ("mention", "link" or "tag"), "start" and "end" (UTF-8 byte offsets of the whole token, including the '@' or '#'), and "value" (the handle, URL, or tag without the '#')
+
+    - mentions and links must follow a non-word character (or the start of the text), so "email@example.com" isn't a mention
+    - hashtags must follow whitespace (or the start of the text), so URL fragments aren't tags
+    """
+    tokens = []
+    # string offsets are converted to byte offsets as tokens are found. they are the same for ASCII text; otherwise the text between tokens is encoded (once), and so are non-ASCII hashtags. mentions and links are all ASCII, so their length in bytes is their length in characters
+    ascii = text.isascii()
+    # end of the last token, in characters and bytes: candidates before it are skipped
+    i = 0
+    i_bytes = 0
+    for m in CANDIDATE_REGEX.finditer(text):
+        start = m.start()
+        if start < i:
+            continue
+        mention_run, tag_run = m.groups()
+        if mention_run is not None:
+            value = scan_mention(mention_run)
+            if value is None:
+                continue
+            kind, end = "mention", start + 1 + len(value)
+            length = end - start
+        elif tag_run is not None:
+            value = scan_tag(tag_run)
+            if value is None:
+                continue
+            kind, end = "tag", start + 1 + len(value)
+            if ascii or (value.isascii() and text[start] == "#"):
+                length = end - start
+            else:
+                length = len(text[start:end].encode("utf-8"))
+        else:
+            end = scan_url(text, start, m.end() - start)
+            if end < 0:
+                continue
+            kind, value = "link", text[start:end]
+            length = end - start
+        if ascii:
+            tokens.append({"type": kind, "start": start, "end": end, "value": value})
+        else:
+            start_bytes = i_bytes + len(text[i:start].encode("utf-8"))
+            i_bytes = start_bytes + length
+            tokens.append({"type": kind, "start": start_bytes, "end": i_bytes, "value": value})
+        i = end
+    return tokens
+
+
+def mention_handles(tokens: List[Dict]) -> List[str]:
+    """
+    the distinct handles mentioned in 'tokens', lower-cased (handles are case-insensitive), in order of first mention
+    """
+    return list(dict.fromkeys(t["value"].lower() for t in tokens if t["type"] == "mention"))
+
+
+def facets_from_tokens(tokens: List[Dict], dids: Optional[Dict[str, Optional[str]]] = None) -> List[Dict]:
+    """
+    builds app.bsky.richtext.facet objects for 'tokens'
+
+    'dids' maps lower-cased handles to DIDs. mentions of handles which aren't in it (or map to None, because they couldn't be resolved) are left as plain text
+    """
+    dids = dids or {}
+    facets = []
+    for t in tokens:
+        if t["type"] == "mention":
+            did = dids.get(t["value"].lower())
+            if not did:
+                continue
+            feature = {"$type": "app.bsky.richtext.facet#mention", "did": did}
+        elif t["type"] == "link":
+            # NOTE: URI ("I") not URL ("L")
+            feature = {"$type": "app.bsky.richtext.facet#link", "uri": t["value"]}
+        else:
+            feature = {"$type": "app.bsky.richtext.facet#tag", "tag": t["value"]}
+        facets.append(
+            {
+                "index": {"byteStart": t["start"], "byteEnd": t["end"]},
+                "features": [feature],
+            }
+        )
+    return facets
+
+
+def test_tokenize():
+    def values(text):
+        return [(t["type"], t["value"]) for t in tokenize(text)]
+
+    assert tokenize("hello world") == []
+    assert tokenize("@handle.example.com #tag https://example.com") == [
+        {"type": "mention", "start": 0, "end": 19, "value": "handle.example.com"},
+        {"type": "tag", "start": 20, "end": 24, "value": "tag"},
+        {"type": "link", "start": 25, "end": 44, "value": "https://example.com"},
+    ]
+    # byte offsets, not string offsets
+    assert tokenize("💩💩💩 @handle.example.com #✨") == [
+        {"type": "mention", "start": 13, "end": 32, "value": "handle.example.com"},
+        {"type": "tag", "start": 33, "end": 37, "value": "✨"},
+    ]
+    assert tokenize("é #tag") == [{"type": "tag", "start": 3, "end": 7, "value": "tag"}]
+
+    # mentions
+    assert values("email@example.com @bare @-bad.com @bad-.com @a..b @x.1com") == []
+    assert values("cc:@example.com (@a.example.com) ping @me.example.com.") == [
+        ("mention", "example.com"),
+        ("mention", "a.example.com"),
+        ("mention", "me.example.com"),
+    ]
+
+    # links
+    assert values("example.com runonhttp://blah.com http://nodot https://a..b") == []
+    assert values("ref [https://bsky.app] and (https://bsky.app/) ends https://bsky.app. what else?") == [
+        ("link", "https://bsky.app"),
+        ("link", "https://bsky.app/"),
+        ("link", "https://bsky.app"),
+    ]
+    assert values("see https://en.wikipedia.org/wiki/Python_(language), or http://localhost.test:8080/a?b=c#d!") == [
+        ("link", "https://en.wikipedia.org/wiki/Python_(language)"),
+        ("link", "http://localhost.test:8080/a?b=c#d"),
+    ]
+    assert values("@https://example.com/#frag") == [("link", "https://example.com/#frag")]
+
+    # hashtags
+    assert values("this is # not a hashtag but #ThisIs, #123 isn't either, nor is a#b or #️⃣") == [
+        ("tag", "ThisIs")
+    ]
+    assert values("#atproto! #日本語 ＃fullwidth #" + "x" * 65) == [
+        ("tag", "atproto"),
+        ("tag", "日本語"),
+        ("tag", "fullwidth"),
+    ]
+
+
+def test_facets_from_tokens():
+    tokens = tokenize("@a.example.com @B.example.com @a.example.com #tag https://bsky.app")
+    assert mention_handles(tokens) == ["a.example.com", "b.example.com"]
+    facets = facets_from_tokens(tokens, {"a.example.com": "did:plc:a", "b.example.com": None})
+    assert [f["features"][0] for f in facets] == [
+        {"$type": "app.bsky.richtext.facet#mention", "did": "did:plc:a"},
+        {"$type": "app.bsky.richtext.facet#mention", "did": "did:plc:a"},
+        {"$type": "app.bsky.richtext.facet#tag", "tag": "tag"},
+        {"$type": "app.bsky.richtext.facet#link", "uri": "https://bsky.app"},
+    ]
+    assert facets[2]["index"] == {"byteStart": 45, "byteEnd": 49}
+
+
+# In a checkout of the whole repository, the other example's copy of this file must be identical to this one
+def test_copies_match():
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "richtext.py"), "rb") as f:
+        contents = f.read()
+    for example in ("python-bsky-post", "python-oauth-web-app"):
+        path = os.path.join(os.path.dirname(here), example, "richtext.py")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                assert f.read() == contents, f"{path} differs from {here}/richtext.py"
+
+
+if __name__ == "__main__":
+    test_tokenize()
+    test_facets_from_tokens()
+    test_copies_match()
@@ -1,9 +1,7 @@
-import json
-import sqlite3
+import time
 import functools
-import regex
-from datetime import datetime, timezone
-from urllib.parse import urlencode, urlparse
+import importlib
+from types import SimpleNamespace
 from flask import (
     Flask,
     flash,
@@ -15,113 +13,229 @@ from flask import (
     session,
     abort,
 )
-from authlib.jose import JsonWebKey
 
-from atproto_identity import (
-    is_valid_did,
-    is_valid_handle,
-    resolve_identity,
-    pds_endpoint,
-)
-from atproto_oauth import (
-    refresh_token_request,
-    revoke_token_request,
-    pds_authed_req,
-    resolve_pds_authserver,
-    initial_token_request,
-    send_par_auth_request,
-    fetch_authserver_meta,
-)
-from atproto_security import is_safe_url
+import metrics
+import tracing
 from atproto_util import parse_full_aturi
 from bsky_util import extract_facets
+from token_refresh import KeyedLock
+from app_common import (
+    METRICS_CONTENT_TYPE,
+    OAUTH_SCOPE,
+    REFRESH_LEASE_SECONDS,
+    auth_request_row,
+    authorization_url,
+    background_refresh_due,
+    check_auth_request,
+    client_metadata,
+    compute_client_id,
+    configure_services,
+    identity_cache_settings,
+    metrics_authorized,
+    needs_touch,
+    parse_login_username,
+    post_request,
+    public_jwk,
+    session_row,
+    token_expires_at,
+)
 
-app = Flask(__name__)
-
-# Load this configuration from environment variables (which might mean a .env "dotenv" file)
-app.config.from_prefixed_env()
-
-# This is a "confidential" OAuth client, meaning it has access to a persistent secret signing key. parse that key as a global.
-CLIENT_SECRET_JWK = JsonWebKey.import_key(app.config["CLIENT_SECRET_JWK"])
-CLIENT_PUB_JWK = json.loads(CLIENT_SECRET_JWK.as_json(is_private=False))
-# Defensively check that the public JWK is really public and didn't somehow end up with secret cryptographic key info
-assert "d" not in CLIENT_PUB_JWK
-
-# OAuth scopes requested by this app (goes in the client metadata, and authorization requests)
-OAUTH_SCOPE = "atproto repo:app.bsky.feed.post?action=create"
-
+# The app is built by create_app() (which 'flask run' finds automatically), so that importing this module has no side effects. The objects below are set up by create_app(); there is one app per process.
+APP_CONFIG = None
+session_store = None
+auth_request_sweeper = None
+refresh_scheduler = None
+pds_nonce_writer = None
+
+
+# Creates the Flask app. Configuration is loaded from environment variables (which might mean a .env "dotenv" file), and then 'config' (eg, for tests).
+# Nothing slow happens here: the database schema is only applied when it has changed, and heavy dependencies are imported on first use. Set FLASK_WARMUP to do that work (and more, see warmup()) before the app is returned instead.
+def create_app(config: dict = None) -> Flask:
+    global APP_CONFIG, session_store, auth_request_sweeper, refresh_scheduler
+
+    app = Flask(__name__)
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+    APP_CONFIG = app.config
+    # fail fast if the client key isn't configured (it is parsed later)
+    assert app.config.get("CLIENT_SECRET_JWK"), "CLIENT_SECRET_JWK must be configured"
+    atproto_modules.cache_clear()
+    client_secret_jwk.cache_clear()
+    client_pub_jwk.cache_clear()
+
+    # Shared cache tier, session store, auth request sweeper, token refresh scheduler and tracing (see app_common.configure_services)
+    services = configure_services(app.config, app.root_path, background_refresh)
+    session_store = services.session_store
+    auth_request_sweeper = services.auth_request_sweeper
+    refresh_scheduler = services.refresh_scheduler
+
+    app.before_request(load_logged_in_user)
+    app.add_url_rule("/", view_func=homepage)
+    app.add_url_rule("/oauth-client-metadata.json", view_func=oauth_client_metadata)
+    app.add_url_rule("/oauth/jwks.json", view_func=oauth_jwks)
+    app.add_url_rule("/oauth/login", view_func=oauth_login, methods=("GET", "POST"))
+    app.add_url_rule("/oauth/callback", view_func=oauth_callback)
+    app.add_url_rule("/oauth/refresh", view_func=login_required(oauth_refresh))
+    app.add_url_rule("/oauth/logout", view_func=login_required(oauth_logout))
+    app.add_url_rule("/bsky/post", view_func=login_required(bsky_post), methods=("GET", "POST"))
+    app.add_url_rule("/metrics", view_func=prometheus_metrics)
+    app.register_error_handler(500, internal_server_error)
+    app.register_error_handler(400, bad_request_error)
+
+    if app.config.get("WARMUP"):
+        warmup(app)
+    return app
+
+
+# The atproto_* modules pull in authlib, dnspython, requests and requests_hardened, which together take a few hundred milliseconds to import. They are imported (and configured) the first time a request needs them, or by warmup().
+@functools.cache
+def atproto_modules() -> SimpleNamespace:
+    global pds_nonce_writer
+    import atproto_identity
+    import atproto_oauth
+    import atproto_security
+
+    # Handle and DID resolution results are cached in-process, for configurable lifetimes
+    atproto_identity.configure_identity_cache(**identity_cache_settings(APP_CONFIG))
+    # Batches of updated PDS DPoP nonces are written to the session store on a background thread, outside of any request
+    pds_nonce_writer = atproto_oauth.NonceWriteBehind(session_store.save_pds_nonces)
+    return SimpleNamespace(
+        identity=atproto_identity, oauth=atproto_oauth, security=atproto_security
+    )
 
-# Dynamically compute our "client_id" based on the request HTTP Host
-def compute_client_id(url_root):
-    parsed_url = urlparse(url_root)
-    if parsed_url.hostname in ["localhost", "127.0.0.1"]:
-        # for localhost testing, see https://atproto.com/specs/oauth#localhost-client-development
-        redirect_uri = f"http://127.0.0.1:{parsed_url.port}/oauth/callback"
-        client_id = "http://localhost?" + urlencode({
-            "redirect_uri": redirect_uri,
-            "scope": OAUTH_SCOPE,
-        })
-    else:
-        app_url = url_root.replace("http://", "https://")
-        redirect_uri = f"{app_url}oauth/callback"
-        client_id = f"{app_url}oauth-client-metadata.json"
 
-    return client_id, redirect_uri
+# This is a "confidential" OAuth client, meaning it has access to a persistent secret signing key. The key is parsed on first use (or by warmup()).
+@functools.cache
+def client_secret_jwk():
+    from authlib.jose import JsonWebKey
 
-# Helpers for managing database connection.
-# Note that you could use a sqlite ":memory:" database instead. In that case you would want to have a global sqlite connection, instead of re-connecting per connection. This file-based setup is following the Flask docs/tutorial.
-def get_db():
-    db = getattr(g, "_database", None)
-    if db is None:
-        db_path = app.config.get("DATABASE_URL", "demo.sqlite")
-        db = g._database = sqlite3.connect(db_path)
-        db.row_factory = sqlite3.Row
-    return db
+    return JsonWebKey.import_key(APP_CONFIG["CLIENT_SECRET_JWK"])
 
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+@functools.cache
+def client_pub_jwk() -> dict:
+    return public_jwk(client_secret_jwk())
 
 
-def query_db(query, args=(), one=False):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(query, args)
-    rv = cur.fetchall()
-    conn.commit()
-    cur.close()
-    return (rv[0] if rv else None) if one else rv
+# Does the one-time work of a worker process ahead of its first request: imports and configures the OAuth modules, compiles the page templates, parses the client key (and signs a throwaway client assertion, which loads the crypto backend), opens HTTP sessions, and fetches the auth server metadata for the servers in FLASK_WARMUP_AUTHSERVERS (a JSON list, default just https://bsky.social) into the discovery cache.
+# Failures are printed, but don't stop the app from starting: everything here would otherwise happen on demand anyway.
+def warmup(app: Flask):
+    start = time.perf_counter()
+    importlib.import_module("regex")  # used by oauth_login
+    mods = atproto_modules()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    client_pub_jwk()
+    mods.oauth.client_assertion_jwt("warmup", "https://example.com", client_secret_jwk())
+    mods.security.hardened_http.warm(4)
+    for url in APP_CONFIG.get("WARMUP_AUTHSERVERS", ["https://bsky.social"]):
+        try:
+            mods.oauth.fetch_authserver_meta(url)
+        except Exception as e:
+            print(f"warmup: failed to fetch auth server metadata for {url}: {e}")
+    print(f"warmup done in {time.perf_counter() - start:.2f}s")
+
+
+# Persists refreshed tokens (and DPoP nonce) for a session, and releases any refresh lease. Returns the new expiry time.
+def save_refreshed_tokens(did: str, tokens: dict, dpop_authserver_nonce: str):
+    expires_at = token_expires_at(tokens)
+    session_store.update_session_tokens(
+        did,
+        tokens["access_token"],
+        tokens["refresh_token"],
+        expires_at,
+        dpop_authserver_nonce,
+    )
+    return expires_at
 
 
-def init_db():
-    print("initializing database...")
-    with app.app_context():
-        db = get_db()
-        with app.open_resource("schema.sql", mode="r") as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+refresh_locks = KeyedLock()
 
 
-init_db()
+# Does the refresh request for a session whose refresh lease we hold, saves the new tokens (releasing the lease), and schedules the next background refresh in this worker process. Returns the updated session row.
+def refresh_with_lease(user: dict, client_id: str):
+    did = user["did"]
+    try:
+        tokens, dpop_authserver_nonce = atproto_modules().oauth.refresh_token_request(
+            user, client_id, client_secret_jwk()
+        )
+    except Exception:
+        session_store.release_refresh_lease(did)
+        raise
+    expires_at = save_refreshed_tokens(did, tokens, dpop_authserver_nonce)
+    if expires_at:
+        refresh_scheduler.schedule(did, expires_at, client_id)
+    return session_store.get_session(did, cached=False)
+
+
+# Refreshes the tokens for a session, making sure that only one refresh happens at a time per account, even with many concurrent requests across threads and worker processes. Otherwise concurrent refreshes would race and invalidate each other's (single-use) refresh tokens.
+# 'stale_access_token' is the access token which was found to be expired: if the session already has a different token by the time we get the lock, somebody else did the refresh and we just use the result.
+# Threads in this process are serialized with a per-account lock. Across processes, the worker which manages to set 'refresh_lease_until' in the session row does the refresh, and the others poll the database until the new tokens show up.
+# Returns the updated session row.
+def refresh_session(did: str, client_id: str, stale_access_token: str):
+    with refresh_locks.lock(did):
+        deadline = time.time() + REFRESH_LEASE_SECONDS
+        while True:
+            user = session_store.get_session(did, cached=False)
+            if user is None:
+                raise Exception(f"session not found: {did}")
+            if user["access_token"] != stale_access_token:
+                return user
+
+            until = int(time.time()) + REFRESH_LEASE_SECONDS
+            if session_store.claim_refresh_lease(did, stale_access_token, until):
+                break
+            if time.time() > deadline:
+                raise Exception(f"timed out waiting for token refresh: {did}")
+            time.sleep(0.1)
+
+        return refresh_with_lease(user, client_id)
+
+
+# Called by the background refresh scheduler (outside of any request) shortly before a session's access token expires.
+# Any worker process which has served the user may have the session scheduled, but only one of them keeps it: whichever claims the refresh lease does the refresh and reschedules, and the others stop tracking the session (as they do if another worker has already refreshed it). Sessions which have been idle for longer than TOKEN_REFRESH_IDLE_CUTOFF are dropped too; load_logged_in_user() schedules them again if the user comes back.
+def background_refresh(did: str, client_id: str):
+    with refresh_locks.lock(did):
+        user = session_store.get_session(did, cached=False)
+        if not background_refresh_due(
+            did, user, refresh_scheduler.lead_time, APP_CONFIG["TOKEN_REFRESH_IDLE_CUTOFF"]
+        ):
+            return None
+        until = int(time.time()) + REFRESH_LEASE_SECONDS
+        if not session_store.claim_refresh_lease(did, user["access_token"], until):
+            return None
+        print(f"refreshing tokens in background for {did}")
+        # the next refresh is scheduled by refresh_with_lease()
+        refresh_with_lease(user, client_id)
+        return None
 
 
 # Load back-end account auth metadata when there is a valid front-end session cookie
 # NOTE: Flask uses encrypted cookies for sessions. If the SECRET_KEY config variable isn't provided, Flask will error out when trying to use the session.
-@app.before_request
 def load_logged_in_user():
     user_did = session.get("user_did")
 
     if user_did is None:
         g.user = None
     else:
-        g.user = (
-            get_db()
-            .execute("SELECT * FROM oauth_session WHERE did = ?", (user_did,))
-            .fetchone()
-        )
+        # Only the summary columns (no tokens or keys) are loaded here, usually from the in-process cache. Routes which act on behalf of the user load the full session row with load_user_session().
+        g.user = session_store.get_session_summary(user_did)
+        now = int(time.time())
+        if g.user is not None and needs_touch(g.user, now):
+            session_store.touch_session(user_did, now)
+        # sessions created by another worker (or before a restart) get picked up by this worker's refresh scheduler the first time they are used
+        if g.user is not None and g.user["expires_at"] and not refresh_scheduler.is_scheduled(user_did):
+            client_id, _ = compute_client_id(request.url_root)
+            refresh_scheduler.schedule(user_did, g.user["expires_at"], client_id)
+
+
+# Returns the full session row (including tokens and DPoP key) for the logged-in user
+def load_user_session():
+    user = session_store.get_session(g.user["did"])
+    if user is None:
+        abort(400, "session not found")
+    return user
 
 
 def login_required(view):
@@ -136,88 +250,59 @@ def login_required(view):
 
 
 # Actual web routes start here!
-@app.route("/")
 def homepage():
     return render_template("home.html")
 
 
-# Every atproto OAuth client must have a public client metadata JSON document. It does not need to be at this specific path. The full URL to this file is the "client_id" of the app.
-# This implementation dynamically uses the HTTP request Host name to infer the "client_id".
-@app.route("/oauth-client-metadata.json")
+# The client metadata document (see app_common.client_metadata). Its URL is the "client_id" of the app.
 def oauth_client_metadata():
-    # Note: this endpoint is never reached during localhost testing
-    app_url = request.url_root.replace("http://", "https://")
-    client_id = f"{app_url}oauth-client-metadata.json"
-
-    return jsonify(
-        {
-            # simply using the full request URL for the client_id
-            "client_id": client_id,
-            "dpop_bound_access_tokens": True,
-            "application_type": "web",
-            "redirect_uris": [f"{app_url}oauth/callback"],
-            "grant_types": ["authorization_code", "refresh_token"],
-            "response_types": ["code"],
-            "scope": OAUTH_SCOPE,
-            "token_endpoint_auth_method": "private_key_jwt",
-            "token_endpoint_auth_signing_alg": "ES256",
-            # NOTE: in theory we can return the public key (in JWK format) inline
-            # "jwks": { #    "keys": [CLIENT_PUB_JWK], #},
-            "jwks_uri": f"{app_url}oauth/jwks.json",
-            # the following are optional fields, which might not be displayed by auth server
-            "client_name": "atproto OAuth Flask Backend Demo",
-            "client_uri": app_url,
-        }
-    )
+    return jsonify(client_metadata(request.url_root, "atproto OAuth Flask Backend Demo"))
 
 
 # In this example of a "confidential" OAuth client, we have only a single app key being used. In a production-grade client, it best practice to periodically rotate keys. Including both a "new key" and "old key" at the same time can make this process smoother.
-@app.route("/oauth/jwks.json")
 def oauth_jwks():
     return jsonify(
         {
-            "keys": [CLIENT_PUB_JWK],
+            "keys": [client_pub_jwk()],
         }
     )
 
 
 # Displays the login form (GET), or starts the OAuth authorization flow (POST).
-@app.route("/oauth/login", methods=("GET", "POST"))
+@tracing.traced()
 def oauth_login():
     if request.method != "POST":
         return render_template("login.html")
 
-    # Login can start with a handle, DID, or auth server URL. We are calling whatever the user supplied the "username".
-    username = request.form["username"]
+    from authlib.jose import JsonWebKey
 
-    # strip unicode control/formatting codepoints (common in copy-pasted handles)
-    username = regex.sub(r"[\p{C}]", "", username)
+    mods = atproto_modules()
+    identity, oauth, security = mods.identity, mods.oauth, mods.security
 
-    # strip @ prefix, if present
-    if is_valid_handle(username.removeprefix("@")):
-        username = username.removeprefix("@")
+    # Login can start with a handle, DID, or auth server URL
+    username, kind = parse_login_username(request.form["username"])
 
-    if is_valid_handle(username) or is_valid_did(username):
+    if kind == "account":
         # If starting with an account identifier, resolve the identity (bi-directionally), fetch the PDS URL, and resolve to the Authorization Server URL
         login_hint = username
 
         try:
-            did, handle, did_doc = resolve_identity(username)
+            did, handle, did_doc = identity.resolve_identity(username)
         except Exception as e:
             flash(f"Failed to resolve identity: {e}", "error")
             return render_template("login.html"), 400
 
-        pds_url = pds_endpoint(did_doc)
+        pds_url = identity.pds_endpoint(did_doc)
         print(f"account PDS: {pds_url}")
-        authserver_url = resolve_pds_authserver(pds_url)
-    elif username.startswith("https://") and is_safe_url(username):
+        authserver_url = oauth.resolve_pds_authserver(pds_url)
+    elif kind == "server":
         # When starting with an auth server, we don't know about the account yet.
         did, handle, pds_url = None, None, None
         login_hint = None
         # Check if this is a Resource Server (PDS) URL; otherwise assume it is authorization server
         initial_url = username
         try:
-            authserver_url = resolve_pds_authserver(initial_url)
+            authserver_url = oauth.resolve_pds_authserver(initial_url)
         except Exception:
             # If initial_url is an AS url, strip any trailing slashes
             authserver_url = initial_url.rstrip("/")
@@ -228,9 +313,9 @@ def oauth_login():
     # Fetch Auth Server metadata. For a self-hosted PDS, this will be the same server (the PDS). For large-scale PDS hosts like Bluesky, this may be a separate "entryway" server filling the Auth Server role.
     # IMPORTANT: Authorization Server URL is untrusted input, SSRF mitigations are needed
     print(f"account Authorization Server: {authserver_url}")
-    assert is_safe_url(authserver_url)
+    assert security.is_safe_url(authserver_url)
     try:
-        authserver_meta = fetch_authserver_meta(authserver_url)
+        authserver_meta = oauth.fetch_authserver_meta(authserver_url)
     except Exception as err:
         print(f"failed to fetch auth server metadata: {err}")
         # raise err
@@ -238,20 +323,21 @@ def oauth_login():
         return render_template("login.html"), 400
 
     # Generate DPoP private signing key for this account session. In theory this could be defered until the token request at the end of the athentication flow, but doing it now allows early binding during the PAR request.
-    dpop_private_jwk = JsonWebKey.generate_key("EC", "P-256", is_private=True)
+    with tracing.span("generate_dpop_key"):
+        dpop_private_jwk = JsonWebKey.generate_key("EC", "P-256", is_private=True)
 
     # Dynamically compute our "client_id" based on the request HTTP Host
     client_id, redirect_uri = compute_client_id(request.url_root)
 
     # Submit OAuth Pushed Authentication Request (PAR). We could have constructed a more complex authentication request URL below instead, but there are some advantages with PAR, including failing fast, early DPoP binding, and no URL length limitations.
-    pkce_verifier, state, dpop_authserver_nonce, resp = send_par_auth_request(
+    pkce_verifier, state, dpop_authserver_nonce, resp = oauth.send_par_auth_request(
         authserver_url,
         authserver_meta,
         login_hint,
         client_id,
         redirect_uri,
         OAUTH_SCOPE,
-        CLIENT_SECRET_JWK,
+        client_secret_jwk(),
         dpop_private_jwk,
     )
     if resp.status_code == 400:
@@ -261,31 +347,27 @@ def oauth_login():
     par_request_uri = resp.json()["request_uri"]
 
     print(f"saving oauth_auth_request to DB  state={state}")
-    query_db(
-        "INSERT INTO oauth_auth_request (state, authserver_iss, did, handle, pds_url, pkce_verifier, scope, dpop_authserver_nonce, dpop_private_jwk) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);",
-        [
-            state,
-            authserver_meta["issuer"],
-            did,  # might be None
-            handle,  # might be None
-            pds_url,  # might be None
-            pkce_verifier,
-            OAUTH_SCOPE,
-            dpop_authserver_nonce,
-            dpop_private_jwk.as_json(is_private=True),
-        ],
-    )
+    with tracing.span("save_auth_request"):
+        session_store.save_auth_request(
+            auth_request_row(
+                state,
+                authserver_meta,
+                did,  # might be None
+                handle,  # might be None
+                pds_url,  # might be None
+                pkce_verifier,
+                dpop_authserver_nonce,
+                dpop_private_jwk,
+            )
+        )
+    auth_request_sweeper.start()
 
     # Forward the user to the Authorization Server to complete the browser auth flow.
-    # IMPORTANT: Authorization endpoint URL is untrusted input, security mitigations are needed before redirecting user
-    auth_url = authserver_meta["authorization_endpoint"]
-    assert is_safe_url(auth_url)
-    qparam = urlencode({"client_id": client_id, "request_uri": par_request_uri})
-    return redirect(f"{auth_url}?{qparam}")
+    return redirect(authorization_url(authserver_meta, client_id, par_request_uri))
 
 
 # Endpoint for receiving "callback" responses from the Authorization Server, to complete the auth flow.
-@app.route("/oauth/callback")
+@tracing.traced()
 def oauth_callback():
     if error := request.args.get("error"):
         error_description = request.args.get("error_description", "")
@@ -296,31 +378,24 @@ def oauth_callback():
     authserver_iss = request.args["iss"]
     authorization_code = request.args["code"]
 
-    # Lookup auth request by the "state" token (which we randomly generated earlier)
-    row = query_db(
-        "SELECT * FROM oauth_auth_request WHERE state = ?;",
-        [state],
-        one=True,
-    )
-    if row is None:
-        abort(400, "OAuth request not found")
-
-    # Delete row to prevent response replay
-    query_db("DELETE FROM oauth_auth_request WHERE state = ?;", [state])
+    mods = atproto_modules()
+    identity, oauth = mods.identity, mods.oauth
 
-    # Verify query param "iss" against earlier oauth request "iss"
-    assert row["authserver_iss"] == authserver_iss
-    # This is redundant with the above SQL query, but also double-checking that the "state" param matches the original request
-    assert row["state"] == state
+    # Lookup auth request by the "state" token (which we randomly generated earlier). The row is deleted at the same time, to prevent response replay.
+    with tracing.span("pop_auth_request"):
+        row = session_store.pop_auth_request(state)
+    # Checks that the request exists and hasn't expired, and verifies the "iss" param against the original request
+    if error := check_auth_request(row, state, authserver_iss, auth_request_sweeper.ttl):
+        abort(400, error)
 
     # Complete the auth flow by requesting auth tokens from the authorization server.
     client_id, redirect_uri = compute_client_id(request.url_root)
-    tokens, dpop_authserver_nonce = initial_token_request(
+    tokens, dpop_authserver_nonce = oauth.initial_token_request(
         row,
         authorization_code,
         client_id,
         redirect_uri,
-        CLIENT_SECRET_JWK,
+        client_secret_jwk(),
     )
 
     # Now we verify the account authentication against the original request
@@ -331,10 +406,10 @@ def oauth_callback():
     else:
         # If we started with an auth server URL, now we need to resolve the identity
         did = tokens["sub"]
-        assert is_valid_did(did)
-        did, handle, did_doc = resolve_identity(did)
-        pds_url = pds_endpoint(did_doc)
-        authserver_url = resolve_pds_authserver(pds_url)
+        assert identity.is_valid_did(did)
+        did, handle, did_doc = identity.resolve_identity(did)
+        pds_url = identity.pds_endpoint(did_doc)
+        authserver_url = oauth.resolve_pds_authserver(pds_url)
 
         # Verify that Authorization Server matches
         assert authserver_url == authserver_iss
@@ -344,19 +419,13 @@ def oauth_callback():
 
     # Save session (including auth tokens) in database
     print(f"saving oauth_session to DB  {did}")
-    query_db(
-        "INSERT OR REPLACE INTO oauth_session (did, handle, pds_url, authserver_iss, access_token, refresh_token, dpop_authserver_nonce, dpop_private_jwk) VALUES(?, ?, ?, ?, ?, ?, ?, ?);",
-        [
-            did,
-            handle,
-            pds_url,
-            authserver_iss,
-            tokens["access_token"],
-            tokens["refresh_token"],
-            dpop_authserver_nonce,
-            row["dpop_private_jwk"],
-        ],
+    user = session_row(
+        did, handle, pds_url, authserver_iss, tokens, dpop_authserver_nonce, row["dpop_private_jwk"]
     )
+    with tracing.span("save_session"):
+        session_store.save_session(user)
+    if user["expires_at"]:
+        refresh_scheduler.schedule(did, user["expires_at"], client_id)
 
     # Set a (secure) session cookie in the user's browser, for authentication between the browser and this app
     session["user_did"] = did
@@ -368,68 +437,54 @@ def oauth_callback():
 
 # Example endpoint demonstrating manual refreshing of auth token.
 # This isn't something you would do in a real application, it is just to trigger this codepath.
-@login_required
-@app.route("/oauth/refresh")
 def oauth_refresh():
     client_id, _ = compute_client_id(request.url_root)
 
-    tokens, dpop_authserver_nonce = refresh_token_request(
-        g.user, client_id, CLIENT_SECRET_JWK
-    )
-
-    # persist updated tokens (and DPoP nonce) to database
-    query_db(
-        "UPDATE oauth_session SET access_token = ?, refresh_token = ?, dpop_authserver_nonce = ? WHERE did = ?;",
-        [
-            tokens["access_token"],
-            tokens["refresh_token"],
-            dpop_authserver_nonce,
-            g.user["did"],
-        ],
-    )
+    # refreshes tokens and persists them (and the DPoP nonce) to the database
+    user = load_user_session()
+    g.user = refresh_session(user["did"], client_id, user["access_token"])
 
     flash("Token refreshed!")
     return redirect("/")
 
 
-@login_required
-@app.route("/oauth/logout")
 def oauth_logout():
     client_id, _ = compute_client_id(request.url_root)
 
     try:
-        revoke_token_request(g.user, client_id, CLIENT_SECRET_JWK)
+        atproto_modules().oauth.revoke_token_request(
+            load_user_session(), client_id, client_secret_jwk()
+        )
     except Exception as e:
         print("Error during token revocation:", e)
         # but still proceed to delete the session on our end
 
-    query_db("DELETE FROM oauth_session WHERE did = ?;", [g.user["did"]])
+    session_store.delete_session(g.user["did"])
+    refresh_scheduler.cancel(g.user["did"])
     session.clear()
     return redirect("/")
 
 
 # Example form endpoint demonstrating making an authenticated request to the logged-in user's PDS to create a repository record.
-@login_required
-@app.route("/bsky/post", methods=("GET", "POST"))
 def bsky_post():
     if request.method != "POST":
         return render_template("bsky_post.html")
 
     pds_url = g.user["pds_url"]
-    req_url = f"{pds_url}/xrpc/com.atproto.repo.createRecord"
-
-    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
-    body = {
-        "repo": g.user["did"],
-        "collection": "app.bsky.feed.post",
-        "record": {
-            "$type": "app.bsky.feed.post",
-            "text": request.form["post_text"],
-            "facets": extract_facets(request.form["post_text"]),
-            "createdAt": now,
-        },
-    }
-    resp = pds_authed_req("POST", req_url, body=body, user=g.user, db=get_db())
+
+    # mentioned handles are resolved with the (cached) identity resolver
+    facets = extract_facets(request.form["post_text"], atproto_modules().identity.resolve_handle)
+    req_url, body = post_request(pds_url, g.user["did"], request.form["post_text"], facets)
+    # if the access token has expired, it gets refreshed and the request retried
+    client_id, _ = compute_client_id(request.url_root)
+    resp = atproto_modules().oauth.pds_authed_req(
+        "POST",
+        req_url,
+        body=body,
+        user=load_user_session(),
+        nonce_writer=pds_nonce_writer,
+        refresh=lambda stale_token: refresh_session(g.user["did"], client_id, stale_token),
+    )
     if resp.status_code not in [200, 201]:
         print(f"PDS HTTP Error: {resp.json()}")
     resp.raise_for_status()
@@ -446,11 +501,17 @@ def bsky_post():
     )
 
 
-@app.errorhandler(500)
+# Prometheus metrics for this worker process: outbound request latency and status codes (by operation and remote origin), DPoP nonce retries, and cache hit rates. See metrics.py.
+# Access is checked by app_common.metrics_authorized.
+def prometheus_metrics():
+    if not metrics_authorized(APP_CONFIG, request.headers.get("Authorization")):
+        abort(401)
+    return metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+
 def internal_server_error(e):
     return render_template("error.html", status_code=500, err=e), 500
 
 
-@app.errorhandler(400)
 def bad_request_error(e):
     return render_template("error.html", status_code=400, err=e), 400
@@ -0,0 +1,273 @@
+import os
+import time
+from types import SimpleNamespace
+from typing import Optional, Tuple
+from urllib.parse import urlencode, urlparse
+from datetime import datetime, timezone
+
+import tracing
+from atproto_cache import enable_shared_cache
+from token_refresh import RefreshScheduler
+from session_store import make_session_store, AuthRequestSweeper
+
+# The parts of the web app which don't depend on the web framework, shared by app.py (Flask) and asgi_app.py (Quart): configuration, the OAuth client metadata, and the rules for logins, sessions and token refreshes. The two front-ends only add request handling and I/O (blocking calls in app.py, awaited ones in asgi_app.py).
+# The OAuth modules (authlib, dnspython, requests_hardened) are only imported inside the functions which need them, so that importing app.py stays cheap.
+
+# OAuth scopes requested by this app (goes in the client metadata, and authorization requests)
+OAUTH_SCOPE = "atproto repo:app.bsky.feed.post?action=create"
+
+# How long (seconds) one worker process may hold the right to refresh a session, and how long other workers wait for it
+REFRESH_LEASE_SECONDS = 30
+
+# How often (seconds) a session's 'last_seen_at' is updated while it is in use
+SESSION_SEEN_INTERVAL = 300
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Sets up the per-process services described by the app configuration (the "FLASK_" environment variables), and returns them as 'session_store', 'auth_request_sweeper' and 'refresh_scheduler'. 'refresh_func(did, client_id)' does background token refreshes (see RefreshScheduler).
+def configure_services(config, root_path: str, refresh_func) -> SimpleNamespace:
+    # Identity and OAuth discovery caches are also shared between worker processes through a separate sqlite database file. Set this to an empty string to disable.
+    if cache_db_path := config.get("CACHE_DATABASE_URL", "cache.sqlite"):
+        enable_shared_cache(cache_db_path)
+
+    # OAuth auth requests and sessions are kept in a session store (see session_store.py). The default is a sqlite database file, which works with any number of worker processes; FLASK_SESSION_STORE=memory keeps everything in process memory instead, which is faster but only works with a single worker process (and is lost on restart). sqlite session rows are cached in-process for a few seconds (FLASK_SESSION_CACHE_TTL, 0 to disable).
+    session_store = make_session_store(
+        config.get("SESSION_STORE"),
+        config.get("DATABASE_URL", "demo.sqlite"),
+        os.path.join(root_path, "schema.sql"),
+        cache_ttl=config.get("SESSION_CACHE_TTL", 5),
+    )
+
+    # Logins which are abandoned before the callback leave an auth request behind. Requests older than this (seconds) are rejected by the callback, and deleted by a background sweeper (started with the first login).
+    auth_request_sweeper = AuthRequestSweeper(
+        session_store, ttl=config.get("AUTH_REQUEST_TTL", 900)
+    )
+
+    # Refreshes access tokens before they expire, so that user requests never have to wait on a token refresh. The lead time (seconds before expiry) and number of concurrent refreshes can be configured. Sessions which haven't been used for TOKEN_REFRESH_IDLE_CUTOFF seconds (default one day) stop being refreshed in the background; their tokens are refreshed on demand if the user comes back.
+    refresh_scheduler = RefreshScheduler(
+        refresh_func,
+        lead_time=config.get("TOKEN_REFRESH_LEAD_TIME", 120),
+        max_workers=config.get("TOKEN_REFRESH_WORKERS", 4),
+    )
+    config.setdefault("TOKEN_REFRESH_IDLE_CUTOFF", 86400)
+
+    # Span tracing of the login and callback routes (and the identity and OAuth requests they make), off by default. FLASK_TRACING is "log" (print each trace) or "otlp-file" (append OTLP/JSON to FLASK_TRACING_FILE); FLASK_TRACING_SAMPLE_RATE is the fraction of requests traced.
+    tracing.configure(
+        tracing.make_exporter(config.get("TRACING"), config.get("TRACING_FILE", "traces.jsonl")),
+        sample_rate=float(config.get("TRACING_SAMPLE_RATE", 1.0)),
+    )
+
+    return SimpleNamespace(
+        session_store=session_store,
+        auth_request_sweeper=auth_request_sweeper,
+        refresh_scheduler=refresh_scheduler,
+    )
+
+
+# Handle and DID resolution results are cached in-process. The lifetimes (in seconds) can be tuned with configuration variables; unset values keep the defaults. Pass the result to atproto_identity.configure_identity_cache().
+def identity_cache_settings(config) -> dict:
+    return {
+        "ttl": config.get("IDENTITY_CACHE_TTL"),
+        "negative_ttl": config.get("IDENTITY_CACHE_NEGATIVE_TTL"),
+        "stale_ttl": config.get("IDENTITY_CACHE_STALE_TTL"),
+    }
+
+
+# The public half of the client's secret JWK, for the JWKS endpoint
+def public_jwk(secret_jwk) -> dict:
+    import json
+
+    pub_jwk = json.loads(secret_jwk.as_json(is_private=False))
+    # Defensively check that the public JWK is really public and didn't somehow end up with secret cryptographic key info
+    assert "d" not in pub_jwk
+    return pub_jwk
+
+
+# Dynamically compute our "client_id" based on the request HTTP Host
+def compute_client_id(url_root: str) -> Tuple[str, str]:
+    parsed_url = urlparse(url_root)
+    if parsed_url.hostname in ["localhost", "127.0.0.1"]:
+        # for localhost testing, see https://atproto.com/specs/oauth#localhost-client-development
+        redirect_uri = f"http://127.0.0.1:{parsed_url.port}/oauth/callback"
+        client_id = "http://localhost?" + urlencode({
+            "redirect_uri": redirect_uri,
+            "scope": OAUTH_SCOPE,
+        })
+    else:
+        app_url = url_root.replace("http://", "https://")
+        redirect_uri = f"{app_url}oauth/callback"
+        client_id = f"{app_url}oauth-client-metadata.json"
+
+    return client_id, redirect_uri
+
+
+# Every atproto OAuth client must have a public client metadata JSON document. It does not need to be at this specific path. The full URL to this file is the "client_id" of the app.
+# This implementation dynamically uses the HTTP request Host name to infer the "client_id".
+def client_metadata(url_root: str, client_name: str) -> dict:
+    # Note: this endpoint is never reached during localhost testing
+    app_url = url_root.replace("http://", "https://")
+    client_id = f"{app_url}oauth-client-metadata.json"
+
+    return {
+        # simply using the full request URL for the client_id
+        "client_id": client_id,
+        "dpop_bound_access_tokens": True,
+        "application_type": "web",
+        "redirect_uris": [f"{app_url}oauth/callback"],
+        "grant_types": ["authorization_code", "refresh_token"],
+        "response_types": ["code"],
+        "scope": OAUTH_SCOPE,
+        "token_endpoint_auth_method": "private_key_jwt",
+        "token_endpoint_auth_signing_alg": "ES256",
+        # NOTE: in theory we can return the public key (in JWK format) inline
+        # "jwks": { #    "keys": [CLIENT_PUB_JWK], #},
+        "jwks_uri": f"{app_url}oauth/jwks.json",
+        # the following are optional fields, which might not be displayed by auth server
+        "client_name": client_name,
+        "client_uri": app_url,
+    }
+
+
+# Login can start with a handle, DID, or auth server URL. We are calling whatever the user supplied the "username".
+# Returns the cleaned-up username, and what it is: "account" (a handle or DID), "server" (an auth server or PDS URL), or None if it isn't valid.
+def parse_login_username(username: str) -> Tuple[str, Optional[str]]:
+    import regex
+    from atproto_identity import is_valid_did, is_valid_handle
+    from atproto_security import is_safe_url
+
+    # strip unicode control/formatting codepoints (common in copy-pasted handles)
+    username = regex.sub(r"[\p{C}]", "", username)
+
+    # strip @ prefix, if present
+    if is_valid_handle(username.removeprefix("@")):
+        username = username.removeprefix("@")
+
+    if is_valid_handle(username) or is_valid_did(username):
+        return username, "account"
+    if username.startswith("https://") and is_safe_url(username):
+        return username, "server"
+    return username, None
+
+
+# The auth request row saved after a successful PAR request, and looked up again by the callback. 'did', 'handle' and 'pds_url' are None if the login started with a server URL.
+def auth_request_row(
+    state: str,
+    authserver_meta: dict,
+    did: Optional[str],
+    handle: Optional[str],
+    pds_url: Optional[str],
+    pkce_verifier: str,
+    dpop_authserver_nonce: str,
+    dpop_private_jwk,
+) -> dict:
+    return {
+        "state": state,
+        "authserver_iss": authserver_meta["issuer"],
+        "did": did,
+        "handle": handle,
+        "pds_url": pds_url,
+        "pkce_verifier": pkce_verifier,
+        "scope": OAUTH_SCOPE,
+        "dpop_authserver_nonce": dpop_authserver_nonce,
+        "dpop_private_jwk": dpop_private_jwk.as_json(is_private=True),
+    }
+
+
+# Where to send the user's browser after the PAR request
+# IMPORTANT: Authorization endpoint URL is untrusted input, security mitigations are needed before redirecting user
+def authorization_url(authserver_meta: dict, client_id: str, par_request_uri: str) -> str:
+    from atproto_security import is_safe_url
+
+    auth_url = authserver_meta["authorization_endpoint"]
+    assert is_safe_url(auth_url)
+    qparam = urlencode({"client_id": client_id, "request_uri": par_request_uri})
+    return f"{auth_url}?{qparam}"
+
+
+# Checks the auth request row found for a callback. Returns an error message if the callback must be rejected, or None.
+def check_auth_request(row: Optional[dict], state: str, authserver_iss: str, ttl: float) -> Optional[str]:
+    if row is None:
+        return "OAuth request not found"
+    if row["created_at"] < time.time() - ttl:
+        return "OAuth request expired"
+
+    # Verify query param "iss" against earlier oauth request "iss"
+    assert row["authserver_iss"] == authserver_iss
+    # This is redundant with the lookup, but also double-checking that the "state" param matches the original request
+    assert row["state"] == state
+    return None
+
+
+# Token responses include a relative lifetime ('expires_in', in seconds); we store an absolute expiry time
+def token_expires_at(tokens: dict) -> Optional[int]:
+    if "expires_in" not in tokens:
+        return None
+    return int(time.time()) + int(tokens["expires_in"])
+
+
+# The session row saved at the end of the callback
+def session_row(
+    did: str,
+    handle: str,
+    pds_url: str,
+    authserver_iss: str,
+    tokens: dict,
+    dpop_authserver_nonce: str,
+    dpop_private_jwk: str,
+) -> dict:
+    return {
+        "did": did,
+        "handle": handle,
+        "pds_url": pds_url,
+        "authserver_iss": authserver_iss,
+        "access_token": tokens["access_token"],
+        "refresh_token": tokens["refresh_token"],
+        "expires_at": token_expires_at(tokens),
+        "dpop_authserver_nonce": dpop_authserver_nonce,
+        "dpop_private_jwk": dpop_private_jwk,
+        "last_seen_at": int(time.time()),
+    }
+
+
+# Whether a session summary's 'last_seen_at' is old enough to be updated
+def needs_touch(summary: dict, now: int) -> bool:
+    return (summary["last_seen_at"] or 0) < now - SESSION_SEEN_INTERVAL
+
+
+# Whether a background refresh which has come due should go ahead for the current session row ('user'). It shouldn't if the session is gone (logged out) or has nothing to refresh with, if it has been idle for longer than 'idle_cutoff' seconds, or if another worker process has refreshed it already.
+def background_refresh_due(did: str, user: Optional[dict], lead_time: float, idle_cutoff: float) -> bool:
+    if user is None or not user["refresh_token"]:
+        return False
+    if (user["last_seen_at"] or 0) < time.time() - idle_cutoff:
+        print(f"not refreshing tokens for idle session {did}")
+        return False
+    if user["expires_at"] and user["expires_at"] - lead_time > time.time():
+        return False
+    return True
+
+
+# The createRecord request for a new post: returns the request URL and body
+def post_request(pds_url: str, did: str, text: str, facets: list) -> Tuple[str, dict]:
+    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    body = {
+        "repo": did,
+        "collection": "app.bsky.feed.post",
+        "record": {
+            "$type": "app.bsky.feed.post",
+            "text": text,
+            "facets": facets,
+            "createdAt": now,
+        },
+    }
+    return f"{pds_url}/xrpc/com.atproto.repo.createRecord", body
+
+
+# The scraper needs to send METRICS_TOKEN as a bearer token. Without a configured token, nobody is allowed: metrics reveal which servers the app's users are on.
+def metrics_authorized(config, authorization: Optional[str]) -> bool:
+    import hmac
+
+    token = config.get("METRICS_TOKEN")
+    if not token:
+        return False
+    return hmac.compare_digest(authorization or "", f"Bearer {token}")
@@ -0,0 +1,442 @@
+import time
+import asyncio
+import functools
+from quart import (
+    Quart,
+    flash,
+    redirect,
+    render_template,
+    jsonify,
+    request,
+    g,
+    session,
+    abort,
+)
+from authlib.jose import JsonWebKey
+
+import metrics
+import tracing
+from atproto_identity import is_valid_did, pds_endpoint, configure_identity_cache
+from atproto_oauth import NonceWriteBehind
+from atproto_oauth_async import AsyncOAuthClient
+from atproto_security import is_safe_url
+from atproto_util import parse_full_aturi
+from bsky_util import extract_facets_async
+from token_refresh import AsyncKeyedLock
+from app_common import (
+    METRICS_CONTENT_TYPE,
+    OAUTH_SCOPE,
+    REFRESH_LEASE_SECONDS,
+    auth_request_row,
+    authorization_url,
+    background_refresh_due,
+    check_auth_request,
+    client_metadata,
+    compute_client_id,
+    configure_services,
+    identity_cache_settings,
+    metrics_authorized,
+    needs_touch,
+    parse_login_username,
+    post_request,
+    public_jwk,
+    session_row,
+    token_expires_at,
+)
+
+# ASGI version of app.py: the same routes, templates, database, and configuration, but built with Quart (an asyncio re-implementation of the Flask API) and AsyncOAuthClient. Outbound requests (identity resolution, OAuth discovery, PAR, token requests, PDS writes) are awaited instead of holding a worker thread, so a single worker process can have many logins in progress at once.
+# Everything which doesn't depend on the web framework is in app_common.py, shared with app.py; this file only has the request handling and awaited I/O. See app.py for more detailed comments on each route.
+# The app is built by create_app(), eg: uv run --extra asgi -- hypercorn 'asgi_app:create_app()'
+APP_CONFIG = None
+session_store = None
+auth_request_sweeper = None
+refresh_scheduler = None
+pds_nonce_writer = None
+# One client (and HTTP connection pool) for the whole worker process
+oauth_client = None
+client_pub_jwk = None
+# The server's event loop, which background refreshes (started from the scheduler's threads) run on
+event_loop = None
+
+refresh_locks = AsyncKeyedLock()
+
+
+# Creates the Quart app. Uses the same "FLASK_" environment variables as app.py, so both can share a .env file, and then 'config' (eg, for tests).
+def create_app(config: dict = None) -> Quart:
+    global APP_CONFIG, session_store, auth_request_sweeper, refresh_scheduler, pds_nonce_writer, oauth_client, client_pub_jwk
+
+    app = Quart(__name__)
+    app.config.from_prefixed_env("FLASK")
+    if config:
+        app.config.update(config)
+    APP_CONFIG = app.config
+
+    # Shared cache tier, session store, auth request sweeper, token refresh scheduler and tracing (see app_common.configure_services)
+    services = configure_services(app.config, app.root_path, background_refresh)
+    session_store = services.session_store
+    auth_request_sweeper = services.auth_request_sweeper
+    refresh_scheduler = services.refresh_scheduler
+    configure_identity_cache(**identity_cache_settings(app.config))
+
+    client_secret_jwk = JsonWebKey.import_key(app.config["CLIENT_SECRET_JWK"])
+    client_pub_jwk = public_jwk(client_secret_jwk)
+    oauth_client = AsyncOAuthClient(client_secret_jwk)
+    pds_nonce_writer = NonceWriteBehind(session_store.save_pds_nonces)
+
+    app.before_serving(capture_event_loop)
+    app.after_serving(close_oauth_client)
+    app.before_request(load_logged_in_user)
+    app.add_url_rule("/", view_func=homepage)
+    app.add_url_rule("/oauth-client-metadata.json", view_func=oauth_client_metadata)
+    app.add_url_rule("/oauth/jwks.json", view_func=oauth_jwks)
+    app.add_url_rule("/oauth/login", view_func=oauth_login, methods=("GET", "POST"))
+    app.add_url_rule("/oauth/callback", view_func=oauth_callback)
+    app.add_url_rule("/oauth/refresh", view_func=login_required(oauth_refresh))
+    app.add_url_rule("/oauth/logout", view_func=login_required(oauth_logout))
+    app.add_url_rule("/bsky/post", view_func=login_required(bsky_post), methods=("GET", "POST"))
+    app.add_url_rule("/metrics", view_func=prometheus_metrics)
+    app.register_error_handler(500, internal_server_error)
+    app.register_error_handler(400, bad_request_error)
+    return app
+
+
+# Calls a session store method. sqlite calls are blocking, so they run on worker threads (asyncio.to_thread); the in-memory store is called directly.
+async def store_call(method, *args):
+    if session_store.blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+
+# Same as app.refresh_with_lease
+async def refresh_with_lease(user: dict, client_id: str):
+    did = user["did"]
+    try:
+        tokens, dpop_authserver_nonce = await oauth_client.refresh_token_request(
+            user, client_id
+        )
+    except Exception:
+        await store_call(session_store.release_refresh_lease, did)
+        raise
+    expires_at = token_expires_at(tokens)
+    await store_call(
+        session_store.update_session_tokens,
+        did,
+        tokens["access_token"],
+        tokens["refresh_token"],
+        expires_at,
+        dpop_authserver_nonce,
+    )
+    if expires_at:
+        refresh_scheduler.schedule(did, expires_at, client_id)
+    return await store_call(session_store.get_session, did, False)
+
+
+# Same single-flight refresh as app.refresh_session: coroutines in this process are serialized per account, and worker processes (including Flask workers sharing the database) coordinate through the 'refresh_lease_until' column.
+async def refresh_session(did: str, client_id: str, stale_access_token: str):
+    async with refresh_locks.lock(did):
+        deadline = time.time() + REFRESH_LEASE_SECONDS
+        while True:
+            user = await store_call(session_store.get_session, did, False)
+            if user is None:
+                raise Exception(f"session not found: {did}")
+            if user["access_token"] != stale_access_token:
+                return user
+
+            until = int(time.time()) + REFRESH_LEASE_SECONDS
+            if await store_call(session_store.claim_refresh_lease, did, stale_access_token, until):
+                break
+            if time.time() > deadline:
+                raise Exception(f"timed out waiting for token refresh: {did}")
+            await asyncio.sleep(0.1)
+
+        return await refresh_with_lease(user, client_id)
+
+
+# Same as app.background_refresh: only the worker which claims the refresh lease keeps the session scheduled, and idle sessions are dropped
+async def background_refresh_async(did: str, client_id: str):
+    async with refresh_locks.lock(did):
+        user = await store_call(session_store.get_session, did, False)
+        if not background_refresh_due(
+            did, user, refresh_scheduler.lead_time, APP_CONFIG["TOKEN_REFRESH_IDLE_CUTOFF"]
+        ):
+            return None
+        until = int(time.time()) + REFRESH_LEASE_SECONDS
+        if not await store_call(session_store.claim_refresh_lease, did, user["access_token"], until):
+            return None
+        print(f"refreshing tokens in background for {did}")
+        await refresh_with_lease(user, client_id)
+        return None
+
+
+# The scheduler calls this from one of its worker threads; the refresh itself runs on the server's event loop, so it shares the HTTP connection pool and per-account locks with request handlers
+def background_refresh(did: str, client_id: str):
+    future = asyncio.run_coroutine_threadsafe(
+        background_refresh_async(did, client_id), event_loop
+    )
+    return future.result()
+
+
+async def capture_event_loop():
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+
+
+async def close_oauth_client():
+    await oauth_client.close()
+
+
+async def load_logged_in_user():
+    user_did = session.get("user_did")
+
+    if user_did is None:
+        g.user = None
+    else:
+        # summary columns only; see load_user_session()
+        g.user = await store_call(session_store.get_session_summary, user_did)
+        now = int(time.time())
+        if g.user is not None and needs_touch(g.user, now):
+            await store_call(session_store.touch_session, user_did, now)
+        if g.user is not None and g.user["expires_at"] and not refresh_scheduler.is_scheduled(user_did):
+            client_id, _ = compute_client_id(request.url_root)
+            refresh_scheduler.schedule(user_did, g.user["expires_at"], client_id)
+
+
+async def load_user_session():
+    user = await store_call(session_store.get_session, g.user["did"])
+    if user is None:
+        abort(400, "session not found")
+    return user
+
+
+def login_required(view):
+    @functools.wraps(view)
+    async def wrapped_view(**kwargs):
+        if g.user is None:
+            return redirect("/oauth/login")
+
+        return await view(**kwargs)
+
+    return wrapped_view
+
+
+async def homepage():
+    return await render_template("home.html")
+
+
+async def oauth_client_metadata():
+    return jsonify(client_metadata(request.url_root, "atproto OAuth Quart Backend Demo"))
+
+
+async def oauth_jwks():
+    return jsonify(
+        {
+            "keys": [client_pub_jwk],
+        }
+    )
+
+
+@tracing.traced()
+async def oauth_login():
+    if request.method != "POST":
+        return await render_template("login.html")
+
+    username, kind = parse_login_username((await request.form)["username"])
+
+    if kind == "account":
+        login_hint = username
+
+        try:
+            did, handle, did_doc = await oauth_client.resolve_identity(username)
+        except Exception as e:
+            await flash(f"Failed to resolve identity: {e}", "error")
+            return await render_template("login.html"), 400
+
+        pds_url = pds_endpoint(did_doc)
+        print(f"account PDS: {pds_url}")
+        authserver_url = await oauth_client.resolve_pds_authserver(pds_url)
+    elif kind == "server":
+        did, handle, pds_url = None, None, None
+        login_hint = None
+        initial_url = username
+        try:
+            authserver_url = await oauth_client.resolve_pds_authserver(initial_url)
+        except Exception:
+            authserver_url = initial_url.rstrip("/")
+    else:
+        await flash("Not a valid handle, DID, or auth server URL", "error")
+        return await render_template("login.html"), 400
+
+    # IMPORTANT: Authorization Server URL is untrusted input, SSRF mitigations are needed
+    print(f"account Authorization Server: {authserver_url}")
+    assert is_safe_url(authserver_url)
+    try:
+        authserver_meta = await oauth_client.fetch_authserver_meta(authserver_url)
+    except Exception as err:
+        print(f"failed to fetch auth server metadata: {err}")
+        await flash("Failed to fetch Auth Server (Entryway) OAuth metadata", "error")
+        return await render_template("login.html"), 400
+
+    with tracing.span("generate_dpop_key"):
+        dpop_private_jwk = JsonWebKey.generate_key("EC", "P-256", is_private=True)
+
+    client_id, redirect_uri = compute_client_id(request.url_root)
+
+    pkce_verifier, state, dpop_authserver_nonce, resp = await oauth_client.send_par_auth_request(
+        authserver_url,
+        authserver_meta,
+        login_hint,
+        client_id,
+        redirect_uri,
+        OAUTH_SCOPE,
+        dpop_private_jwk,
+    )
+    if resp.status_code == 400:
+        print(f"PAR HTTP 400: {resp.json()}")
+    resp.raise_for_status()
+    par_request_uri = resp.json()["request_uri"]
+
+    print(f"saving oauth_auth_request to DB  state={state}")
+    with tracing.span("save_auth_request"):
+        await store_call(
+            session_store.save_auth_request,
+            auth_request_row(
+                state,
+                authserver_meta,
+                did,
+                handle,
+                pds_url,
+                pkce_verifier,
+                dpop_authserver_nonce,
+                dpop_private_jwk,
+            ),
+        )
+    auth_request_sweeper.start()
+
+    return redirect(authorization_url(authserver_meta, client_id, par_request_uri))
+
+
+@tracing.traced()
+async def oauth_callback():
+    if error := request.args.get("error"):
+        error_description = request.args.get("error_description", "")
+        await flash(f"Authorization failed: {error}: {error_description}", "error")
+        return redirect("/oauth/login")
+
+    state = request.args["state"]
+    authserver_iss = request.args["iss"]
+    authorization_code = request.args["code"]
+
+    # The row is deleted as it is looked up, to prevent response replay
+    with tracing.span("pop_auth_request"):
+        row = await store_call(session_store.pop_auth_request, state)
+    if error := check_auth_request(row, state, authserver_iss, auth_request_sweeper.ttl):
+        abort(400, error)
+
+    client_id, redirect_uri = compute_client_id(request.url_root)
+    tokens, dpop_authserver_nonce = await oauth_client.initial_token_request(
+        row,
+        authorization_code,
+        client_id,
+        redirect_uri,
+    )
+
+    if row["did"]:
+        did, handle, pds_url = row["did"], row["handle"], row["pds_url"]
+        assert tokens["sub"] == did
+    else:
+        did = tokens["sub"]
+        assert is_valid_did(did)
+        did, handle, did_doc = await oauth_client.resolve_identity(did)
+        pds_url = pds_endpoint(did_doc)
+        authserver_url = await oauth_client.resolve_pds_authserver(pds_url)
+        assert authserver_url == authserver_iss
+
+    assert row["scope"] == tokens["scope"]
+
+    print(f"saving oauth_session to DB  {did}")
+    user = session_row(
+        did, handle, pds_url, authserver_iss, tokens, dpop_authserver_nonce, row["dpop_private_jwk"]
+    )
+    with tracing.span("save_session"):
+        await store_call(session_store.save_session, user)
+    if user["expires_at"]:
+        refresh_scheduler.schedule(did, user["expires_at"], client_id)
+
+    session["user_did"] = did
+    session["user_handle"] = handle
+
+    return redirect("/bsky/post")
+
+
+async def oauth_refresh():
+    client_id, _ = compute_client_id(request.url_root)
+
+    user = await load_user_session()
+    g.user = await refresh_session(user["did"], client_id, user["access_token"])
+
+    await flash("Token refreshed!")
+    return redirect("/")
+
+
+async def oauth_logout():
+    client_id, _ = compute_client_id(request.url_root)
+
+    try:
+        await oauth_client.revoke_token_request(await load_user_session(), client_id)
+    except Exception as e:
+        print("Error during token revocation:", e)
+
+    await store_call(session_store.delete_session, g.user["did"])
+    refresh_scheduler.cancel(g.user["did"])
+    session.clear()
+    return redirect("/")
+
+
+async def bsky_post():
+    if request.method != "POST":
+        return await render_template("bsky_post.html")
+
+    pds_url = g.user["pds_url"]
+    post_text = (await request.form)["post_text"]
+    facets = await extract_facets_async(post_text, oauth_client.resolve_handle)
+    req_url, body = post_request(pds_url, g.user["did"], post_text, facets)
+
+    client_id, _ = compute_client_id(request.url_root)
+    did = g.user["did"]
+    resp = await oauth_client.pds_authed_req(
+        "POST",
+        req_url,
+        body=body,
+        user=await load_user_session(),
+        nonce_writer=pds_nonce_writer,
+        refresh=lambda stale_token: refresh_session(did, client_id, stale_token),
+    )
+    if resp.status_code not in [200, 201]:
+        print(f"PDS HTTP Error: {resp.json()}")
+    resp.raise_for_status()
+
+    at_uri = resp.json()["uri"]
+    record_repo, _, record_rkey = parse_full_aturi(at_uri)
+
+    return await render_template(
+        "bsky_post_success.html",
+        repo=record_repo,
+        rkey=record_rkey,
+        pds_url=pds_url,
+        at_uri=at_uri
+    )
+
+
+# Same as app.prometheus_metrics (the metrics are kept per worker process)
+async def prometheus_metrics():
+    if not metrics_authorized(APP_CONFIG, request.headers.get("Authorization")):
+        abort(401)
+    return metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+
+async def internal_server_error(e):
+    return await render_template("error.html", status_code=500, err=e), 500
+
+
+async def bad_request_error(e):
+    return await render_template("error.html", status_code=400, err=e), 400
@@ -0,0 +1,409 @@
+import json
+import time
+import asyncio
+import random
+import sqlite3
+import weakref
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+# Optional cache tier shared between processes on the same host (see enable_shared_cache)
+SHARED_TIER = None
+
+# Every TTLCache which is still in use, for reporting stats (see metrics.py)
+CACHES = weakref.WeakSet()
+
+
+# In-process, bounded LRU cache with per-entry expiry.
+#
+# - successful lookups are kept for 'ttl' seconds
+# - failed lookups (loader returned None) are kept for the shorter 'negative_ttl', so that a burst of logins for a broken account doesn't hammer remote servers, but a fixed account recovers quickly
+# - for 'stale_ttl' seconds after expiry, a positive entry is still returned immediately while a background thread re-runs the loader ("stale-while-revalidate")
+#
+# Exceptions raised by the loader are never cached.
+#
+# If a shared tier has been enabled, entries are also written through to it (as JSON), and local misses are looked up there before calling the loader. This means that one worker process resolving an identity benefits all the other workers. The shared tier is a blocking sqlite database, so get_async() does its shared tier reads and writes on worker threads, off the event loop.
+class TTLCache:
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        negative_ttl: float = 60,
+        stale_ttl: float = 0,
+        shared: bool = True,
+        ttl_func: Optional[Callable[[Any], float]] = None,
+    ):
+        self.name = name
+        self.shared = shared
+        self.ttl_func = ttl_func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        # key -> (value, expires_at)
+        self._entries: OrderedDict = OrderedDict()
+        self._refreshing: set = set()
+        # keeps references to in-progress asyncio refresh tasks
+        self._tasks: set = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        CACHES.add(self)
+
+    def configure(
+        self,
+        maxsize: Optional[int] = None,
+        ttl: Optional[float] = None,
+        negative_ttl: Optional[float] = None,
+        stale_ttl: Optional[float] = None,
+    ):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        if stale_ttl is not None:
+            self.stale_ttl = stale_ttl
+
+    # Returns the cached value for 'key', calling 'loader()' to fetch it on a miss
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        found, value, refresh = self._lookup(key)
+        if refresh:
+            threading.Thread(
+                target=self._refresh, args=(key, loader), daemon=True
+            ).start()
+        if found:
+            return value
+
+        value = loader()
+        self.set(key, value)
+        return value
+
+    # Same as get(), for use from asyncio code: 'loader' is a coroutine function, and background refreshes run as tasks on the event loop
+    async def get_async(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        found, value, refresh = self._get_local(key)
+        if not found:
+            if self._shared_tier() is not None:
+                found, value, refresh = await asyncio.to_thread(self._lookup_shared, key)
+            else:
+                found, value, refresh = self._lookup_shared(key)
+        if refresh:
+            task = asyncio.ensure_future(self._refresh_async(key, loader))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if found:
+            return value
+
+        value = await loader()
+        await self.set_async(key, value)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = self._set_local(key, value, ttl)
+        shared = self._shared_tier()
+        if shared is not None:
+            evict_at = expires_at + (self.stale_ttl if value is not None else 0)
+            shared.set(self.name, key, value, expires_at, evict_at)
+
+    # Same as set(), but the shared tier write happens on a worker thread
+    async def set_async(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = self._set_local(key, value, ttl)
+        shared = self._shared_tier()
+        if shared is not None:
+            evict_at = expires_at + (self.stale_ttl if value is not None else 0)
+            await asyncio.to_thread(shared.set, self.name, key, value, expires_at, evict_at)
+
+    # Stores the local entry, and returns its expiry time
+    def _set_local(self, key: str, value: Any, ttl: Optional[float]) -> float:
+        if ttl is None:
+            if value is None:
+                ttl = self.negative_ttl
+            elif self.ttl_func is not None:
+                ttl = self.ttl_func(value)
+            else:
+                ttl = self.ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, value, expires_at)
+        return expires_at
+
+    # Returns the current local value for 'key' even if it has expired (eg, to revalidate it), or None. Doesn't count as a hit or miss.
+    def peek(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        shared = self._shared_tier()
+        if shared is not None:
+            shared.delete(self.name, key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+            }
+
+    def _shared_tier(self):
+        return SHARED_TIER if self.shared else None
+
+    # Checks the local entry for 'key', then the shared tier. Returns (found, value, refresh), where 'refresh' means a stale value was found and the caller should start a background refresh.
+    def _lookup(self, key: str) -> Tuple[bool, Any, bool]:
+        found, value, refresh = self._get_local(key)
+        if found:
+            return found, value, refresh
+        return self._lookup_shared(key)
+
+    # The second half of _lookup(): checks the shared tier (if any), after a local miss
+    def _lookup_shared(self, key: str) -> Tuple[bool, Any, bool]:
+        shared = self._shared_tier()
+        if shared is not None:
+            entry = shared.get(self.name, key)
+            if entry is not None:
+                with self._lock:
+                    self._store(key, *entry)
+                found, value, refresh = self._get_local(key)
+                if found:
+                    with self._lock:
+                        self.shared_hits += 1
+                    return found, value, refresh
+
+        with self._lock:
+            self.misses += 1
+        return False, None, False
+
+    def _get_local(self, key: str) -> Tuple[bool, Any, bool]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None, False
+            value, expires_at = entry
+            if now < expires_at:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value, False
+            # expired entries are left in place (until overwritten or evicted), so they can still be peeked at
+            if value is None or now >= expires_at + self.stale_ttl:
+                return False, None, False
+            self._entries.move_to_end(key)
+            self.stale_hits += 1
+            refresh = key not in self._refreshing
+            if refresh:
+                self._refreshing.add(key)
+            return True, value, refresh
+
+    # Must be called with the lock held
+    def _store(self, key: str, value: Any, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _refresh(self, key: str, loader: Callable[[], Any]):
+        try:
+            value = loader()
+            # a failed refresh keeps serving the stale (positive) value until it falls out of the stale window
+            if value is not None:
+                self.set(key, value)
+        except Exception as e:
+            print(f"{self.name} cache refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    async def _refresh_async(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        try:
+            value = await loader()
+            if value is not None:
+                await self.set_async(key, value)
+        except Exception as e:
+            print(f"{self.name} cache refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+# Computes how long (in seconds) an HTTP response may be cached for, based on its Cache-Control and Age headers. Responses without an explicit lifetime get 'default', and all lifetimes are capped at 'maximum'.
+def cache_max_age(headers, default: float, maximum: float) -> float:
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, val = part.strip().partition("=")
+        directives[name.lower()] = val.strip('"')
+    # "no-cache" allows storing, but requires revalidation before every use
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    max_age = default
+    if "max-age" in directives:
+        try:
+            max_age = int(directives["max-age"])
+        except ValueError:
+            pass
+    try:
+        max_age -= int(headers.get("Age", 0))
+    except ValueError:
+        pass
+    return min(max(max_age, 0), maximum)
+
+
+# Cache tier shared between worker processes, stored in a sqlite table in WAL mode (so readers never block on writers).
+# Values are stored as JSON. Rows are kept until 'evict_at', which includes the stale-while-revalidate window; expired rows are swept occasionally on write.
+# Errors talking to the database are printed and treated as a cache miss: the shared tier is only an optimization.
+class SqliteSharedCache:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entry (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                evict_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS cache_entry_evict_at ON cache_entry (evict_at);
+            """
+        )
+
+    # sqlite connections can't be shared between threads, so each thread gets its own
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Returns (value, expires_at), or None if there is no usable entry
+    def get(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        try:
+            row = (
+                self._conn()
+                .execute(
+                    "SELECT value, expires_at FROM cache_entry WHERE namespace = ? AND key = ? AND evict_at > ?",
+                    (namespace, key, time.time()),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            print(f"shared cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, namespace: str, key: str, value: Any, expires_at: float, evict_at: float):
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entry (namespace, key, value, expires_at, evict_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), expires_at, evict_at),
+            )
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM cache_entry WHERE evict_at < ?", (time.time(),))
+        except sqlite3.Error as e:
+            print(f"shared cache write failed: {e}")
+
+    def delete(self, namespace: str, key: str):
+        try:
+            self._conn().execute(
+                "DELETE FROM cache_entry WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+        except sqlite3.Error as e:
+            print(f"shared cache delete failed: {e}")
+
+
+# Enables the shared cache tier for all TTLCache instances in this process. Every worker process should point at the same file.
+def enable_shared_cache(path: str):
+    global SHARED_TIER
+    SHARED_TIER = SqliteSharedCache(path)
+
+
+if __name__ == "__main__":
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return len(calls)
+
+    cache = TTLCache("test", maxsize=2, ttl=60)
+    assert cache.get("a", loader) == 1
+    assert cache.get("a", loader) == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # LRU eviction
+    cache.get("b", loader)
+    cache.get("c", loader)
+    assert cache.stats()["size"] == 2
+    assert cache.get("a", loader) == 4
+
+    # negative entries use the shorter TTL
+    cache.configure(negative_ttl=0)
+    assert cache.get("none", lambda: None) is None
+    assert cache.get("none", lambda: "found") == "found"
+
+    # stale entries are served while refreshing in the background
+    cache = TTLCache("test", ttl=0, stale_ttl=60)
+    cache.set("k", "old")
+    assert cache.get("k", lambda: "new") == "old"
+    time.sleep(0.1)
+    assert cache._entries["k"][0] == "new"
+    assert cache.stats()["stale_hits"] == 1
+
+    assert cache_max_age({}, 600, 3600) == 600
+    assert cache_max_age({"Cache-Control": "public, max-age=60", "Age": "10"}, 600, 3600) == 50
+    assert cache_max_age({"Cache-Control": "max-age=99999"}, 600, 3600) == 3600
+    assert cache_max_age({"Cache-Control": "no-store"}, 600, 3600) == 0
+
+    async def async_loader():
+        return "async"
+
+    assert asyncio.run(TTLCache("async").get_async("k", async_loader)) == "async"
+
+    # entries written by one cache are visible to another (eg, in a different process) through the shared tier
+    enable_shared_cache(":memory:")
+    TTLCache("shared").set("k", {"v": 1})
+    cache = TTLCache("shared")
+    assert cache.get("k", lambda: None) == {"v": 1}
+    assert cache.stats()["shared_hits"] == 1
+
+    # in async code, the shared tier is only used from worker threads (sqlite calls block)
+    class ThreadCheckingTier(SqliteSharedCache):
+        def get(self, namespace, key):
+            assert threading.current_thread() is not threading.main_thread()
+            return super().get(namespace, key)
+
+        def set(self, namespace, key, value, expires_at, evict_at):
+            assert threading.current_thread() is not threading.main_thread()
+            super().set(namespace, key, value, expires_at, evict_at)
+
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # (each thread has its own connection, so this needs a file rather than ":memory:")
+        SHARED_TIER = ThreadCheckingTier(os.path.join(tmp, "cache.sqlite"))
+        cache = TTLCache("async_shared")
+        assert asyncio.run(cache.get_async("k", async_loader)) == "async"
+        cache.clear()
+        assert asyncio.run(cache.get_async("k", async_loader)) == "async"
+        assert cache.stats()["shared_hits"] == 1
+    print("ok")
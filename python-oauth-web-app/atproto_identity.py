@@ -1,14 +1,66 @@
 import re
 import sys
+import time
+import socket
+import threading
+import contextvars
+import concurrent.futures
 import requests
 import dns.resolver
-from typing import Optional, Tuple
+from requests_hardened.ip_filter import InvalidIPAddress
+from typing import Iterable, Iterator, Optional, Tuple
 
+import metrics
+import tracing
 from atproto_security import hardened_http
+from atproto_cache import TTLCache
 
 HANDLE_REGEX = r"^([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$"
 DID_REGEX = r"^did:[a-z]+:[a-zA-Z0-9._:%-]*[a-zA-Z0-9._-]$"
 
+# In-process caches for handle->DID and DID->document resolution. Failed lookups are cached briefly (negative_ttl), and recently-expired entries are served while being refreshed in the background (stale_ttl).
+HANDLE_CACHE = TTLCache("handle", maxsize=10000, ttl=3600, negative_ttl=60, stale_ttl=600)
+DID_CACHE = TTLCache("did", maxsize=10000, ttl=3600, negative_ttl=60, stale_ttl=600)
+
+# Handle resolution runs the DNS and HTTP methods concurrently by default, each with its own deadline (in seconds)
+RACE_HANDLE_RESOLUTION = True
+HANDLE_DNS_TIMEOUT = 2.0
+HANDLE_HTTP_TIMEOUT = 3.0
+HANDLE_RESOLUTION_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=32, thread_name_prefix="handle-resolution"
+)
+
+PLC_DIRECTORY_URL = "https://plc.directory"
+
+
+# Raised when a lookup fails in a way which might be temporary: timeouts, connection errors, DNS SERVFAIL, HTTP server errors. Lookups which get a definitive answer (NXDOMAIN or no TXT record, HTTP 404, a host blocked by the SSRF filter) return None instead.
+# The difference matters for caching: None results are negative-cached, but TTLCache never caches exceptions, so a network blip doesn't make a valid handle unresolvable for the negative TTL.
+class IdentityLookupError(Exception):
+    pass
+
+
+# Whether a request failed because the host name doesn't exist (as opposed to a DNS server failure)
+def is_host_not_found(e: BaseException) -> bool:
+    while e is not None:
+        if isinstance(e, socket.gaierror):
+            return e.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME))
+        e = e.__cause__ or e.__context__
+    return False
+
+
+# Sends a GET request for an identity lookup. Returns the response, or None if the host doesn't exist or isn't allowed (SSRF filter); raises IdentityLookupError for other failures.
+def identity_get(url: str, **kwargs) -> Optional[requests.Response]:
+    try:
+        with hardened_http.get_session() as sess:
+            return sess.get(url, **kwargs)
+    except InvalidIPAddress as e:
+        print(f"identity lookup blocked ({url}): {e}")
+        return None
+    except Exception as e:
+        if is_host_not_found(e):
+            return None
+        raise IdentityLookupError(f"request to {url} failed: {e}") from e
+
 
 def is_valid_handle(handle: str) -> bool:
     return re.match(HANDLE_REGEX, handle) is not None
@@ -28,6 +80,7 @@ def handle_from_doc(doc: dict) -> Optional[str]:
 
 
 # resolves an identity (handle or DID) to a DID, handle, and DID document. verifies handle bi-directionally.
+@tracing.traced()
 def resolve_identity(atid: str) -> Tuple[str, str, dict]:
     if is_valid_handle(atid):
         handle = atid
@@ -56,57 +109,214 @@ def resolve_identity(atid: str) -> Tuple[str, str, dict]:
     raise Exception("identifier not a handle or DID: " + atid)
 
 
+# Resolves many identities (handles or DIDs) concurrently, for bulk checks like allowlists or account imports.
+# Inputs are normalized (surrounding whitespace and a leading '@' removed, handles lower-cased), and duplicates after normalization are only resolved once. Results are yielded as they complete (not in input order), as (atid, (did, handle, doc), None) tuples on success, or (atid, None, error) on failure, where 'atid' is the caller's original input (the first one, for duplicates); exceptions are never raised for individual items.
+# DID document fetches are grouped by DID method, each with its own concurrency limit: did:plc documents all come from a single directory server, so by default they are limited to the HTTP session pool's per-host connection limit (more would only queue for a connection slot), while did:web documents are spread across many hosts.
+# Only a bounded number of inputs are in flight at a time, so 'atids' can be a large (or lazy) iterable.
+def resolve_identities(
+    atids: Iterable[str],
+    concurrency: int = 16,
+    plc_concurrency: Optional[int] = None,
+    web_concurrency: int = 8,
+) -> Iterator[Tuple[str, Optional[Tuple[str, str, dict]], Optional[str]]]:
+    if plc_concurrency is None:
+        plc_concurrency = hardened_http.per_host_connections
+    did_fetch_limits = {
+        "plc": threading.BoundedSemaphore(plc_concurrency),
+        "web": threading.BoundedSemaphore(web_concurrency),
+    }
+
+    def resolve_one(atid: str, original: str):
+        try:
+            did = atid
+            if is_valid_handle(atid):
+                did = resolve_handle(atid)
+            # warm the DID document cache under the per-method limit, then do the full bi-directional check (mostly cache hits by now)
+            if did and is_valid_did(did):
+                method = did.split(":")[1]
+                if method in did_fetch_limits:
+                    with did_fetch_limits[method]:
+                        resolve_did(did)
+            return original, resolve_identity(atid), None
+        except Exception as e:
+            return original, None, str(e) or type(e).__name__
+
+    seen = set()
+    inputs = iter(atids)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="identity-batch"
+    ) as pool:
+        in_flight = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < concurrency * 2:
+                original = next(inputs, None)
+                if original is None:
+                    exhausted = True
+                    break
+                atid = original.strip().removeprefix("@")
+                key = atid.lower() if is_valid_handle(atid) else atid
+                if key in seen:
+                    continue
+                seen.add(key)
+                in_flight.add(pool.submit(resolve_one, key, original))
+            if not in_flight:
+                break
+            done, in_flight = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future.result()
+
+
+def configure_identity_cache(**kwargs):
+    HANDLE_CACHE.configure(**kwargs)
+    DID_CACHE.configure(**kwargs)
+
+
+def identity_cache_stats() -> dict:
+    return {"handle": HANDLE_CACHE.stats(), "did": DID_CACHE.stats()}
+
+
+# Handles are case-insensitive, so they are normalized to lower-case for the cache key
+@tracing.traced()
 def resolve_handle(handle: str) -> Optional[str]:
+    return HANDLE_CACHE.get(handle.lower(), lambda: resolve_handle_uncached(handle))
+
+
+@tracing.traced()
+def resolve_did(did: str) -> Optional[dict]:
+    return DID_CACHE.get(did, lambda: resolve_did_uncached(did))
+
+
+# A handle lookup running on HANDLE_RESOLUTION_POOL, in a copy of the caller's context (so that it shows up in the same trace).
+# Its deadline counts from when it starts running on a pool thread, not from when it was submitted: time spent queued behind other lookups (including losing HTTP requests, which keep their thread until their own timeout) isn't charged to it.
+class PooledLookup:
+    def __init__(self, func, *args):
+        self.started = threading.Event()
+        self.started_at = 0.0
+        self.future = HANDLE_RESOLUTION_POOL.submit(contextvars.copy_context().run, self._run, func, *args)
+
+    def _run(self, func, *args):
+        self.started_at = time.monotonic()
+        self.started.set()
+        return func(*args)
+
+    # Waits for the result, at most 'timeout' seconds after the lookup started. Raises concurrent.futures.TimeoutError if it takes longer, or whatever the lookup raised.
+    def result(self, timeout: float):
+        self.started.wait()
+        return self.future.result(timeout=max(self.started_at + timeout - time.monotonic(), 0))
+
+
+# Resolves a handle using both methods. By default (RACE_HANDLE_RESOLUTION) the DNS TXT lookup and the HTTPS well-known request are started at the same time, so a handle without a TXT record doesn't pay the DNS timeout before the HTTP request even starts. DNS still takes precedence if both succeed.
+# Worst-case latency is bounded by the slower of the two per-method deadlines (plus any time waiting for a free thread in HANDLE_RESOLUTION_POOL), instead of their sum.
+# Returns None only if both methods gave a definitive "not found"; if either failed (see IdentityLookupError) and the other didn't find a DID, the error is raised.
+@tracing.traced()
+def resolve_handle_uncached(handle: str, race: Optional[bool] = None) -> Optional[str]:
+    if race is None:
+        race = RACE_HANDLE_RESOLUTION
+    if not race:
+        try:
+            did = resolve_handle_dns(handle)
+        except IdentityLookupError as e:
+            did, dns_error = None, e
+        else:
+            dns_error = None
+        return did or combine_handle_results(resolve_handle_http(handle), dns_error)
+
+    dns_lookup = PooledLookup(resolve_handle_dns, handle)
+    http_lookup = PooledLookup(resolve_handle_http, handle)
 
-    # first try TXT record
+    dns_error = None
     try:
-        for record in dns.resolver.resolve(f"_atproto.{handle}", "TXT"):
-            val = record.to_text().replace('"', "")
-            if val.startswith("did="):
-                val = val[4:]
-                if is_valid_did(val):
-                    return val
-    except Exception as e:
-        print("DNS TXT handle resolution:", e)
-        pass
+        did = dns_lookup.result(timeout=HANDLE_DNS_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        print("DNS TXT handle resolution: deadline exceeded")
+        did, dns_error = None, IdentityLookupError("DNS TXT handle resolution: deadline exceeded")
+    except IdentityLookupError as e:
+        did, dns_error = None, e
+    if did:
+        # The HTTP request lost. If it hasn't started yet this cancels it; an in-flight request can't be interrupted, but it is bounded by its own timeout and the result is discarded.
+        http_lookup.future.cancel()
+        return did
 
-    # then try HTTP well-known
-    # IMPORTANT: 'handle' domain is untrusted user input. SSRF mitigations are necessary
     try:
-        with hardened_http.get_session() as sess:
-            resp = sess.get(f"https://{handle}/.well-known/atproto-did")
-    except Exception as e:
-        print("HTTP handle resolution:", e)
-        return None
+        http_did = http_lookup.result(timeout=HANDLE_HTTP_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        print("HTTP handle resolution: deadline exceeded")
+        raise IdentityLookupError("HTTP handle resolution: deadline exceeded")
+    return combine_handle_results(http_did, dns_error)
 
-    if resp.status_code != 200:
+
+# The HTTP method's result, when the DNS method didn't find a DID: if DNS failed, "not found" over HTTP isn't conclusive (the handle might only have a TXT record)
+def combine_handle_results(http_did: Optional[str], dns_error: Optional[Exception]) -> Optional[str]:
+    if http_did is None and dns_error is not None:
+        raise dns_error
+    return http_did
+
+
+# DNS lookups are recorded in the outbound request metrics with the origin "dns", and a status of "ok", "not_found" (no TXT record) or "error"
+@tracing.traced()
+def resolve_handle_dns(handle: str, timeout: float = HANDLE_DNS_TIMEOUT) -> Optional[str]:
+    with metrics.observe("dns", op="resolve_handle") as call:
+        try:
+            answer = dns.resolver.resolve(f"_atproto.{handle}", "TXT", lifetime=timeout)
+            call["status"] = "ok"
+            for record in answer:
+                val = record.to_text().replace('"', "")
+                if val.startswith("did="):
+                    val = val[4:]
+                    if is_valid_did(val):
+                        return val
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+            call["status"] = "not_found"
+            print("DNS TXT handle resolution:", e)
+        except Exception as e:
+            # timeouts, SERVFAIL (dns.resolver.NoNameservers), etc
+            print("DNS TXT handle resolution:", e)
+            raise IdentityLookupError(f"DNS TXT handle resolution failed: {e}") from e
+    return None
+
+
+@tracing.traced()
+@metrics.operation("resolve_handle")
+def resolve_handle_http(handle: str, timeout: float = HANDLE_HTTP_TIMEOUT) -> Optional[str]:
+    # IMPORTANT: 'handle' domain is untrusted user input. SSRF mitigations are necessary
+    resp = identity_get(f"https://{handle}/.well-known/atproto-did", timeout=timeout)
+    if resp is None or resp.status_code == 404:
         return None
-    did = resp.text.split()[0]
-    if is_valid_did(did):
-        return did
+    if resp.status_code != 200:
+        raise IdentityLookupError(f"HTTP handle resolution: status {resp.status_code}")
+    parts = resp.text.split()
+    if parts and is_valid_did(parts[0]):
+        return parts[0]
     return None
 
 
-def resolve_did(did: str) -> Optional[dict]:
+@tracing.traced()
+@metrics.operation("resolve_did")
+def resolve_did_uncached(did: str) -> Optional[dict]:
     if did.startswith("did:plc:"):
         # NOTE: 'did' is untrusted input, but has been validated by regex by this point
-        resp = requests.get(f"https://plc.directory/{did}")
-        if resp.status_code != 200:
+        resp = identity_get(f"{PLC_DIRECTORY_URL}/{did}")
+        # 410 is a tombstoned (deleted) DID
+        if resp is None or resp.status_code in (404, 410):
             return None
+        if resp.status_code != 200:
+            raise IdentityLookupError(f"PLC directory: status {resp.status_code}")
         return resp.json()
 
     if did.startswith("did:web:"):
         domain = did[8:]
         # IMPORTANT: domain is untrusted input. SSRF mitigations are necessary
         # "handle" validation works to check that domain is a simple hostname
-        assert is_valid_handle(domain)
-        try:
-            with hardened_http.get_session() as sess:
-                resp = sess.get(f"https://{domain}/.well-known/did.json")
-        except requests.exceptions.ConnectionError:
+        if not is_valid_handle(domain):
             return None
-        if resp.status_code != 200:
+        resp = identity_get(f"https://{domain}/.well-known/did.json")
+        if resp is None or resp.status_code == 404:
             return None
+        if resp.status_code != 200:
+            raise IdentityLookupError(f"did:web resolution: status {resp.status_code}")
         return resp.json()
     raise ValueError("unsupported DID type")
 
@@ -123,6 +333,26 @@ if __name__ == "__main__":
     assert is_valid_did("did:plc:abc123")
     assert is_valid_did("") is False
     assert is_valid_did("did:asdfasdf") is False
+
+    # a failed lookup is only "not found" if the other method didn't fail
+    assert combine_handle_results("did:plc:abc", IdentityLookupError("timeout")) == "did:plc:abc"
+    assert combine_handle_results(None, None) is None
+    try:
+        combine_handle_results(None, IdentityLookupError("timeout"))
+        assert False
+    except IdentityLookupError:
+        pass
+    assert is_host_not_found(Exception("wrapped")) is False
+    try:
+        try:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        except socket.gaierror as e:
+            raise requests.ConnectionError("Failed to resolve domain") from e
+    except requests.ConnectionError as e:
+        assert is_host_not_found(e)
+
+    if len(sys.argv) < 2:
+        sys.exit(0)
     handle = sys.argv[1]
     if not is_valid_handle(handle):
         print("invalid handle!")
@@ -135,3 +365,4 @@ if __name__ == "__main__":
     print(doc)
     resolve_identity(handle)
     resolve_identity(did)
+    print(identity_cache_stats())
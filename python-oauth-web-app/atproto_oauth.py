@@ -1,16 +1,38 @@
 from urllib.parse import urlparse
-from typing import Any, Tuple
+from typing import Any, Callable, Optional, Tuple
+from base64 import urlsafe_b64encode
+from collections import OrderedDict
 import time
 import json
+import atexit
+import functools
+import threading
 from requests import Response
 from authlib.jose import JsonWebKey
 from authlib.common.security import generate_token
 from authlib.jose import jwt
 from authlib.oauth2.rfc7636 import create_s256_code_challenge
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
 from requests import Response
 import urllib.request
 
+import metrics
+import tracing
 from atproto_security import is_safe_url, hardened_http
+from atproto_cache import TTLCache, cache_max_age
+
+# Resource Server (PDS) -> Authorization Server mappings, and Authorization Server metadata, rarely change and are shared by many accounts.
+# Entries are cached for as long as the server's Cache-Control header allows (with a default and an upper bound, in seconds), and are revalidated with ETag / If-None-Match once they expire. Metadata is only validated when a new document is fetched, not on every use. Failures are raised (not cached).
+DISCOVERY_DEFAULT_TTL = 600
+DISCOVERY_MAX_TTL = 86400
+PDS_AUTHSERVER_CACHE = TTLCache(
+    "pds_authserver", maxsize=1000, ttl_func=lambda entry: entry["max_age"]
+)
+AUTHSERVER_META_CACHE = TTLCache(
+    "authserver_meta", maxsize=1000, ttl_func=lambda entry: entry["max_age"]
+)
 
 
 # Checks an Authorization Server metadata response against atproto OAuth requirements
@@ -44,30 +66,89 @@ def is_valid_authserver_meta(obj: dict, url: str) -> bool:
 
 
 # Takes a Resource Server (PDS) URL, and tries to resolve it to an Authorization Server host/origin
+@tracing.traced()
 def resolve_pds_authserver(url: str) -> str:
     # IMPORTANT: PDS endpoint URL is untrusted input, SSRF mitigations are needed
     assert is_safe_url(url)
-    with hardened_http.get_session() as sess:
-        resp = sess.get(f"{url}/.well-known/oauth-protected-resource")
+    entry = PDS_AUTHSERVER_CACHE.get(
+        url, lambda: fetch_pds_authserver_entry(url, PDS_AUTHSERVER_CACHE.peek(url))
+    )
+    return entry["authserver_url"]
+
+
+@tracing.traced()
+@metrics.operation("resolve_pds_authserver")
+def fetch_pds_authserver_entry(url: str, previous: Optional[dict]) -> dict:
+    resp = discovery_get(f"{url}/.well-known/oauth-protected-resource", previous)
+    return pds_authserver_entry_from_response(resp, previous)
+
+
+# Builds a cache entry from a protected-resource document response. Also used by the asyncio client.
+def pds_authserver_entry_from_response(resp: Response, previous: Optional[dict]) -> dict:
+    if resp.status_code == 304 and previous:
+        return previous | {"max_age": discovery_max_age(resp)}
     resp.raise_for_status()
     # Additionally check that status is exactly 200 (not just 2xx)
     assert resp.status_code == 200
     authserver_url = resp.json()["authorization_servers"][0]
-    return authserver_url
+    return {
+        "authserver_url": authserver_url,
+        "etag": resp.headers.get("ETag"),
+        "max_age": discovery_max_age(resp),
+    }
 
 
 # Does an HTTP GET for Authorization Server (entryway) metadata, verify the contents, and return the metadata as a dict
+@tracing.traced()
 def fetch_authserver_meta(url: str) -> dict:
     # IMPORTANT: Authorization Server URL is untrusted input, SSRF mitigations are needed
     assert is_safe_url(url)
-    with hardened_http.get_session() as sess:
-        resp = sess.get(f"{url}/.well-known/oauth-authorization-server")
+    entry = AUTHSERVER_META_CACHE.get(
+        url, lambda: fetch_authserver_meta_entry(url, AUTHSERVER_META_CACHE.peek(url))
+    )
+    return entry["meta"]
+
+
+@tracing.traced()
+@metrics.operation("authserver_meta")
+def fetch_authserver_meta_entry(url: str, previous: Optional[dict]) -> dict:
+    resp = discovery_get(f"{url}/.well-known/oauth-authorization-server", previous)
+    return authserver_meta_entry_from_response(resp, previous, url)
+
+
+# Validates an Authorization Server metadata response and builds a cache entry from it. Also used by the asyncio client.
+def authserver_meta_entry_from_response(
+    resp: Response, previous: Optional[dict], url: str
+) -> dict:
+    # Not modified: the metadata was already validated when it was first fetched
+    if resp.status_code == 304 and previous:
+        return previous | {"max_age": discovery_max_age(resp)}
     resp.raise_for_status()
 
     authserver_meta = resp.json()
     # print("Auth Server Metadata: " + json.dumps(authserver_meta, indent=2))
     assert is_valid_authserver_meta(authserver_meta, url)
-    return authserver_meta
+    return {
+        "meta": authserver_meta,
+        "etag": resp.headers.get("ETag"),
+        "max_age": discovery_max_age(resp),
+    }
+
+
+# HTTP GET for a discovery document, conditional on the ETag of a previously cached copy (if any)
+def discovery_get(url: str, previous: Optional[dict]) -> Response:
+    with hardened_http.get_session() as sess:
+        return sess.get(url, headers=discovery_headers(previous))
+
+
+def discovery_headers(previous: Optional[dict]) -> dict:
+    if previous and previous.get("etag"):
+        return {"If-None-Match": previous["etag"]}
+    return {}
+
+
+def discovery_max_age(resp: Response) -> float:
+    return cache_max_age(resp.headers, DISCOVERY_DEFAULT_TTL, DISCOVERY_MAX_TTL)
 
 
 def client_assertion_jwt(
@@ -88,34 +169,142 @@ def client_assertion_jwt(
     return client_assertion
 
 
+# Builds DPoP proof JWTs for a single DPoP private key.
+# Parsing the JWK and encoding the JWS header (which embeds the public key) are done once up front, so each proof only needs to encode the claims and sign them. Signing uses the 'cryptography' key object directly (the same library authlib uses under the hood).
+class DpopSigner:
+    def __init__(self, dpop_private_jwk: JsonWebKey):
+        self.private_jwk = dpop_private_jwk
+        self._private_key = dpop_private_jwk.get_private_key()
+        dpop_pub_jwk = json.loads(dpop_private_jwk.as_json(is_private=False))
+        # Defensively check that the public JWK is really public
+        assert "d" not in dpop_pub_jwk
+        header = {"typ": "dpop+jwt", "alg": "ES256", "jwk": dpop_pub_jwk}
+        self._header_b64 = b64url_json(header)
+
+    def proof(
+        self,
+        method: str,
+        url: str,
+        nonce: Optional[str] = None,
+        access_token: Optional[str] = None,
+        lifetime: int = 30,
+    ) -> str:
+        now = int(time.time())
+        body = {
+            "jti": generate_token(),
+            "htm": method,
+            "htu": url,
+            "iat": now,
+            "exp": now + lifetime,
+        }
+        if access_token:
+            # PKCE S256 is same as DPoP ath hashing
+            body["ath"] = create_s256_code_challenge(access_token)
+        if nonce:
+            body["nonce"] = nonce
+        signing_input = self._header_b64 + b"." + b64url_json(body)
+        # JWS ES256 signatures are the raw (r, s) pair, not DER-encoded
+        r, s = decode_dss_signature(
+            self._private_key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+        )
+        signature = r.to_bytes(32, "big") + s.to_bytes(32, "big")
+        return (signing_input + b"." + urlsafe_b64encode(signature).rstrip(b"=")).decode()
+
+
+# Returns a (cached) DpopSigner for a DPoP private key in JSON format, as stored in the session database
+@functools.lru_cache(maxsize=4096)
+def dpop_signer_for(dpop_private_jwk_json: str) -> DpopSigner:
+    return DpopSigner(JsonWebKey.import_key(json.loads(dpop_private_jwk_json)))
+
+
+def b64url_json(obj: dict) -> bytes:
+    return urlsafe_b64encode(json.dumps(obj, separators=(",", ":")).encode()).rstrip(b"=")
+
+
 def authserver_dpop_jwt(
-    method: str, url: str, nonce: str, dpop_private_jwk: JsonWebKey
+    method: str, url: str, nonce: str, dpop_signer: DpopSigner
 ) -> str:
-    dpop_pub_jwk = json.loads(dpop_private_jwk.as_json(is_private=False))
-    body = {
-        "jti": generate_token(),
-        "htm": method,
-        "htu": url,
-        "iat": int(time.time()),
-        "exp": int(time.time()) + 30,
-    }
-    if nonce:
-        body["nonce"] = nonce
-    dpop_proof = jwt.encode(
-        {"typ": "dpop+jwt", "alg": "ES256", "jwk": dpop_pub_jwk},
-        body,
-        dpop_private_jwk,
-    ).decode("utf-8")
-    return dpop_proof
+    return dpop_signer.proof(method, url, nonce=nonce, lifetime=30)
+
+
+# DPoP nonces are issued by a server (per origin), not per session, so the latest nonce seen from a server can be used by every session talking to it.
+# The nonce is picked up from the "DPoP-Nonce" header of every response, including successful ones: servers rotate nonces periodically, and learning about it only from a "use_dpop_nonce" error would cost an extra round trip each time.
+class DpopNonceCache:
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._nonces: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[str]:
+        with self._lock:
+            return self._nonces.get(url_origin(url))
+
+    # Records the nonce from a response (if any), and returns it
+    def update(self, url: str, resp: Response) -> Optional[str]:
+        nonce = resp.headers.get("DPoP-Nonce")
+        if nonce:
+            origin = url_origin(url)
+            with self._lock:
+                self._nonces[origin] = nonce
+                self._nonces.move_to_end(origin)
+                while len(self._nonces) > self.maxsize:
+                    self._nonces.popitem(last=False)
+        return nonce
+
+
+def url_origin(url: str) -> str:
+    parts = urlparse(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+DPOP_NONCES = DpopNonceCache()
+
+
+# Batches up per-session DPoP nonce updates, and persists them from a background thread ("write-behind"), so that PDS requests never wait on a database commit just to save a nonce.
+# 'flush_func' is called with a dict of {did: nonce} (only the latest nonce for each account).
+class NonceWriteBehind:
+    def __init__(self, flush_func: Callable[[dict], None], interval: float = 1.0):
+        self.flush_func = flush_func
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, did: str, nonce: str):
+        with self._lock:
+            self._pending[did] = nonce
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="dpop-nonce-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.flush_func(pending)
+        except Exception as e:
+            # nonces are only an optimization (a stale nonce costs one retry), so failed writes are dropped
+            print(f"failed to persist DPoP nonces: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
 
 # POST data to auth server with client assertion and DPoP, handling DPoP nonce rotation
 # Returns latest DPoP nonce and 'requests' response object (which may be an error response)
+@tracing.traced()
 def auth_server_post(
     authserver_url: str,
     client_id: str,
     client_secret_jwk: JsonWebKey,
-    dpop_private_jwk: JsonWebKey,
+    dpop_signer: DpopSigner,
     dpop_authserver_nonce: str,
     post_url: str,
     post_data: dict
@@ -130,42 +319,39 @@ def auth_server_post(
         "client_assertion": client_assertion,
     }
 
+    # Prefer the most recent nonce seen from this server (by any session) over the one passed in
+    dpop_authserver_nonce = DPOP_NONCES.get(post_url) or dpop_authserver_nonce
+
     # Create DPoP header JWT
     dpop_proof = authserver_dpop_jwt(
-        "POST", post_url, dpop_authserver_nonce, dpop_private_jwk
+        "POST", post_url, dpop_authserver_nonce, dpop_signer
     )
 
     # IMPORTANT: This method may be passed untrusted URLs as input, SSRF mitigations are needed
     assert is_safe_url(post_url)
     with hardened_http.get_session() as sess:
         resp = sess.post(post_url, data=post_data, headers={"DPoP": dpop_proof})
+    dpop_authserver_nonce = DPOP_NONCES.update(post_url, resp) or dpop_authserver_nonce
 
     # Handle DPoP missing/invalid nonce error by retrying with server-provided nonce
     if is_use_dpop_nonce_error_response(resp):
-        dpop_authserver_nonce = resp.headers["DPoP-Nonce"]
         print(f"retrying with new auth server DPoP nonce: {dpop_authserver_nonce}")
+        metrics.record_nonce_retry(post_url)
+        tracing.current_span().set("dpop_nonce_retry", True)
         # print(server_nonce)
         dpop_proof = authserver_dpop_jwt(
-            "POST", post_url, dpop_authserver_nonce, dpop_private_jwk
+            "POST", post_url, dpop_authserver_nonce, dpop_signer
         )
         with hardened_http.get_session() as sess:
             resp = sess.post(post_url, data=post_data, headers={"DPoP": dpop_proof})
+        dpop_authserver_nonce = DPOP_NONCES.update(post_url, resp) or dpop_authserver_nonce
 
     return dpop_authserver_nonce, resp
 
-# Prepares and sends a pushed auth request (PAR) via HTTP POST to the Authorization Server.
-# Returns "state" id HTTP response on success, without checking HTTP response status
-def send_par_auth_request(
-    authserver_url: str,
-    authserver_meta: dict,
-    login_hint: str,
-    client_id: str,
-    redirect_uri: str,
-    scope: str,
-    client_secret_jwk: JsonWebKey,
-    dpop_private_jwk: JsonWebKey,
-) -> Tuple[str, str, str, Any]:
-    par_url = authserver_meta["pushed_authorization_request_endpoint"]
+# Generates fresh "state" and PKCE verifier values, and returns them along with the pushed auth request (PAR) form body
+def par_request_body(
+    login_hint: Optional[str], redirect_uri: str, scope: str
+) -> Tuple[str, str, dict]:
     state = generate_token()
     pkce_verifier = generate_token(48)
 
@@ -184,6 +370,25 @@ def send_par_auth_request(
     if login_hint:
         par_body["login_hint"] = login_hint
     # print(par_body)
+    return pkce_verifier, state, par_body
+
+
+# Prepares and sends a pushed auth request (PAR) via HTTP POST to the Authorization Server.
+# Returns "state" id HTTP response on success, without checking HTTP response status
+@tracing.traced()
+@metrics.operation("par")
+def send_par_auth_request(
+    authserver_url: str,
+    authserver_meta: dict,
+    login_hint: str,
+    client_id: str,
+    redirect_uri: str,
+    scope: str,
+    client_secret_jwk: JsonWebKey,
+    dpop_private_jwk: JsonWebKey,
+) -> Tuple[str, str, str, Any]:
+    par_url = authserver_meta["pushed_authorization_request_endpoint"]
+    pkce_verifier, state, par_body = par_request_body(login_hint, redirect_uri, scope)
 
     # IMPORTANT: Pushed Authorization Request URL is untrusted input, SSRF mitigations are needed
     assert is_safe_url(par_url)
@@ -191,7 +396,7 @@ def send_par_auth_request(
         authserver_url=authserver_url,
         client_id=client_id,
         client_secret_jwk=client_secret_jwk,
-        dpop_private_jwk=dpop_private_jwk,
+        dpop_signer=DpopSigner(dpop_private_jwk),
         dpop_authserver_nonce="",  # not yet known
         post_url=par_url,
         post_data=par_body
@@ -202,6 +407,8 @@ def send_par_auth_request(
 
 # Completes the auth flow by sending an initial auth token request.
 # Returns token response (dict) and DPoP nonce (str)
+@tracing.traced()
+@metrics.operation("token")
 def initial_token_request(
     auth_request: dict,
     code: str,
@@ -211,7 +418,7 @@ def initial_token_request(
 ) -> Tuple[dict, str]:
     authserver_url = auth_request["authserver_iss"]
 
-    # Re-fetch server metadata
+    # Fetch server metadata (usually cached)
     authserver_meta = fetch_authserver_meta(authserver_url)
 
     params = {
@@ -222,9 +429,7 @@ def initial_token_request(
     }
 
     token_url = authserver_meta["token_endpoint"]
-    dpop_private_jwk = JsonWebKey.import_key(
-        json.loads(auth_request["dpop_private_jwk"])
-    )
+    dpop_signer = dpop_signer_for(auth_request["dpop_private_jwk"])
 
     # IMPORTANT: Token URL is untrusted input, SSRF mitigations are needed
     assert is_safe_url(token_url)
@@ -232,7 +437,7 @@ def initial_token_request(
         authserver_url=authserver_url,
         client_id=client_id,
         client_secret_jwk=client_secret_jwk,
-        dpop_private_jwk=dpop_private_jwk,
+        dpop_signer=dpop_signer,
         dpop_authserver_nonce=auth_request["dpop_authserver_nonce"],
         post_url=token_url,
         post_data=params
@@ -247,6 +452,8 @@ def initial_token_request(
 
 
 # Returns token response (dict) and DPoP nonce (str)
+@tracing.traced()
+@metrics.operation("refresh")
 def refresh_token_request(
     user: dict,
     client_id: str,
@@ -254,7 +461,7 @@ def refresh_token_request(
 ) -> Tuple[dict, str]:
     authserver_url = user["authserver_iss"]
 
-    # Re-fetch server metadata
+    # Fetch server metadata (usually cached)
     authserver_meta = fetch_authserver_meta(authserver_url)
 
     params = {
@@ -264,7 +471,7 @@ def refresh_token_request(
 
     # Retrieve the existing DPoP signing key for this account/session
     token_url = authserver_meta["token_endpoint"]
-    dpop_private_jwk = JsonWebKey.import_key(json.loads(user["dpop_private_jwk"]))
+    dpop_signer = dpop_signer_for(user["dpop_private_jwk"])
     dpop_authserver_nonce = user["dpop_authserver_nonce"]
 
     # IMPORTANT: Token URL is untrusted input, SSRF mitigations are needed
@@ -273,7 +480,7 @@ def refresh_token_request(
         authserver_url=authserver_url,
         client_id=client_id,
         client_secret_jwk=client_secret_jwk,
-        dpop_private_jwk=dpop_private_jwk,
+        dpop_signer=dpop_signer,
         dpop_authserver_nonce=dpop_authserver_nonce,
         post_url=token_url,
         post_data=params
@@ -288,6 +495,8 @@ def refresh_token_request(
     return token_body, dpop_authserver_nonce
 
 
+@tracing.traced()
+@metrics.operation("revoke")
 def revoke_token_request(
     user: dict,
     client_id: str,
@@ -295,11 +504,11 @@ def revoke_token_request(
 ):
     authserver_url = user["authserver_iss"]
 
-    # Re-fetch server metadata
+    # Fetch server metadata (usually cached)
     authserver_meta = fetch_authserver_meta(authserver_url)
 
     # Retrieve the existing DPoP signing key for this account/session
-    dpop_private_jwk = JsonWebKey.import_key(json.loads(user["dpop_private_jwk"]))
+    dpop_signer = dpop_signer_for(user["dpop_private_jwk"])
     dpop_authserver_nonce = user["dpop_authserver_nonce"]
 
     # Revocation may not be supported by all ASes
@@ -315,7 +524,7 @@ def revoke_token_request(
             authserver_url=authserver_url,
             client_id=client_id,
             client_secret_jwk=client_secret_jwk,
-            dpop_private_jwk=dpop_private_jwk,
+            dpop_signer=dpop_signer,
             dpop_authserver_nonce=dpop_authserver_nonce,
             post_url=revoke_url,
             post_data={
@@ -332,26 +541,12 @@ def pds_dpop_jwt(
     url: str,
     access_token: str,
     nonce: str,
-    dpop_private_jwk: JsonWebKey,
+    dpop_signer: DpopSigner,
 ) -> str:
-    dpop_pub_jwk = json.loads(dpop_private_jwk.as_json(is_private=False))
-    body = {
-        "iat": int(time.time()),
-        "exp": int(time.time()) + 10,
-        "jti": generate_token(),
-        "htm": method,
-        "htu": url,
-        # PKCE S256 is same as DPoP ath hashing
-        "ath": create_s256_code_challenge(access_token),
-    }
-    if nonce:
-        body["nonce"] = nonce
-    dpop_proof = jwt.encode(
-        {"typ": "dpop+jwt", "alg": "ES256", "jwk": dpop_pub_jwk},
-        body,
-        dpop_private_jwk,
-    ).decode("utf-8")
-    return dpop_proof
+    return dpop_signer.proof(
+        method, url, nonce=nonce, access_token=access_token, lifetime=10
+    )
+
 
 # Minimal www-authenticate header parser, only supports the format expected for DPoP nonce errors
 def parse_www_authenticate(data: str) -> Tuple[str, dict]:
@@ -381,21 +576,52 @@ def is_use_dpop_nonce_error_response(resp: Response):
     return False
 
 
+# An expired (or otherwise rejected) access token is signaled with error="invalid_token", in the WWW-Authenticate header (see https://datatracker.ietf.org/doc/html/rfc6750#section-3.1) or in a JSON response body
+def is_invalid_token_error_response(resp: Response) -> bool:
+    if resp.status_code not in [400, 401]:
+        return False
+    www_authenticate = resp.headers.get("WWW-Authenticate")
+    if www_authenticate:
+        try:
+            scheme, params = parse_www_authenticate(www_authenticate)
+            if scheme.lower() == "dpop" and params.get("error") == "invalid_token":
+                return True
+        except Exception:
+            pass
+    try:
+        json_body = resp.json()
+    except ValueError:
+        return False
+    return isinstance(json_body, dict) and json_body.get("error") == "invalid_token"
+
+
 # Helper to demonstrate making a request (HTTP GET or POST) to the user's PDS ("Resource Server" in OAuth terminology) using DPoP and access token.
+# If the access token has expired and a 'refresh' function is provided, it is called with the rejected access token, and should return the session with new tokens (see app.refresh_session, which makes sure concurrent requests only refresh once). The request is then retried.
 # This method returns a 'requests' reponse, without checking status code.
-def pds_authed_req(method: str, url: str, user: dict, db: Any, body=None) -> Any:
-    dpop_private_jwk = JsonWebKey.import_key(json.loads(user["dpop_private_jwk"]))
-    dpop_pds_nonce = user["dpop_pds_nonce"]
+@tracing.traced()
+@metrics.operation("pds_write")
+def pds_authed_req(
+    method: str,
+    url: str,
+    user: dict,
+    nonce_writer: Optional[NonceWriteBehind] = None,
+    body=None,
+    refresh: Optional[Callable[[str], dict]] = None,
+) -> Any:
+    dpop_signer = dpop_signer_for(user["dpop_private_jwk"])
+    # Prefer the most recent nonce seen from this PDS (by any session) over the one stored with the session
+    dpop_pds_nonce = DPOP_NONCES.get(url) or user["dpop_pds_nonce"]
     access_token = user["access_token"]
 
-    # Might need to retry request with a new nonce.
-    for i in range(2):
+    # Might need to retry request with a new nonce, and/or with a refreshed access token.
+    nonce_retried, token_refreshed = False, False
+    while True:
         dpop_jwt = pds_dpop_jwt(
             "POST",
             url,
             access_token,
             dpop_pds_nonce,
-            dpop_private_jwk,
+            dpop_signer,
         )
 
         with hardened_http.get_session() as sess:
@@ -407,21 +633,27 @@ def pds_authed_req(method: str, url: str, user: dict, db: Any, body=None) -> Any
                 },
                 json=body,
             )
+        dpop_pds_nonce = DPOP_NONCES.update(url, resp) or dpop_pds_nonce
 
-        # If we got a new server-provided DPoP nonce, store it in database and retry.
-        if is_use_dpop_nonce_error_response(resp):
+        # If we got a new server-provided DPoP nonce, retry.
+        if not nonce_retried and is_use_dpop_nonce_error_response(resp):
             # print(resp.headers)
-            dpop_pds_nonce = resp.headers["DPoP-Nonce"]
             print(f"retrying with new PDS DPoP nonce: {dpop_pds_nonce}")
-            # update session database with new nonce
-            cur = db.cursor()
-            cur.execute(
-                "UPDATE oauth_session SET dpop_pds_nonce = ? WHERE did = ?;",
-                [dpop_pds_nonce, user["did"]],
-            )
-            db.commit()
-            cur.close()
+            metrics.record_nonce_retry(url)
+            tracing.current_span().set("dpop_nonce_retry", True)
+            nonce_retried = True
+            continue
+
+        if refresh is not None and not token_refreshed and is_invalid_token_error_response(resp):
+            print(f"access token rejected by PDS, refreshing: {user['did']}")
+            user = refresh(access_token)
+            access_token = user["access_token"]
+            token_refreshed = True
             continue
         break
 
+    # The session database is updated with the latest nonce in the background
+    if nonce_writer is not None and dpop_pds_nonce != user["dpop_pds_nonce"]:
+        nonce_writer.put(user["did"], dpop_pds_nonce)
+
     return resp
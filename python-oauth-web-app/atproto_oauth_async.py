@@ -0,0 +1,598 @@
+import json
+import time
+import socket
+import asyncio
+import ipaddress
+from urllib.parse import urlparse
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+import aiohttp
+import dns.asyncresolver
+from aiohttp.abc import AbstractResolver
+from authlib.jose import JsonWebKey
+
+import metrics
+import tracing
+from atproto_security import is_safe_url
+from atproto_identity import (
+    DID_CACHE,
+    HANDLE_CACHE,
+    HANDLE_DNS_TIMEOUT,
+    HANDLE_HTTP_TIMEOUT,
+    PLC_DIRECTORY_URL,
+    IdentityLookupError,
+    combine_handle_results,
+    handle_from_doc,
+    is_host_not_found,
+    is_valid_did,
+    is_valid_handle,
+)
+from atproto_oauth import (
+    AUTHSERVER_META_CACHE,
+    DPOP_NONCES,
+    PDS_AUTHSERVER_CACHE,
+    DpopSigner,
+    NonceWriteBehind,
+    authserver_dpop_jwt,
+    authserver_meta_entry_from_response,
+    client_assertion_jwt,
+    discovery_headers,
+    dpop_signer_for,
+    is_invalid_token_error_response,
+    is_use_dpop_nonce_error_response,
+    par_request_body,
+    pds_authserver_entry_from_response,
+    pds_dpop_jwt,
+)
+
+
+# Raised for requests refused by the SSRF mitigations: URLs which fail is_safe_url, and hosts which resolve to non-public IP addresses (see is_forbidden_ip). It is an OSError (like other connection failures) so that aiohttp passes it through from the resolver.
+class BlockedRequestError(OSError):
+    pass
+
+
+# NAT64 prefixes (RFC 6052 and RFC 8215), which embed an IPv4 address in the last 32 bits
+NAT64_WELL_KNOWN_PREFIX = ipaddress.ip_network("64:ff9b::/96")
+NAT64_LOCAL_PREFIX = ipaddress.ip_network("64:ff9b:1::/48")
+
+
+# Whether connections to 'ip' must be refused: anything which isn't a globally routable unicast address. This is stricter than the requests_hardened filter ('is_private'), which lets through eg shared address space (CG-NAT, 100.64.0.0/10) and multicast. IPv6 addresses which embed an IPv4 address (IPv4-mapped, NAT64, 6to4) are judged by the IPv4 address.
+def is_forbidden_ip(ip) -> bool:
+    if ip.version == 6:
+        if ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        elif ip in NAT64_LOCAL_PREFIX:
+            return True
+        elif ip in NAT64_WELL_KNOWN_PREFIX:
+            ip = ipaddress.IPv4Address(int(ip) & 0xFFFFFFFF)
+        elif ip.sixtofour is not None:
+            ip = ip.sixtofour
+    return ip.is_multicast or not ip.is_global
+
+
+# DNS resolver for aiohttp which refuses to connect to private, loopback, shared, reserved or multicast IP addresses (see is_forbidden_ip). This is the asyncio equivalent of the requests_hardened IP filter: the check happens at connection time, on the exact addresses aiohttp will connect to, so DNS re-binding can't sneak past it.
+class PublicAddressResolver(AbstractResolver):
+    def __init__(self, allow_loopback: bool = False):
+        self.allow_loopback = allow_loopback
+        self._resolver = aiohttp.ThreadedResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        addresses = await self._resolver.resolve(host, port, family)
+        for addr in addresses:
+            ip = ipaddress.ip_address(addr["host"])
+            if ip.version == 6 and ip.ipv4_mapped is not None:
+                ip = ip.ipv4_mapped
+            if self.allow_loopback and ip.is_loopback:
+                continue
+            if is_forbidden_ip(ip):
+                # aiohttp wraps this in a connection error; AsyncOAuthClient.request() unwraps it
+                raise BlockedRequestError(f"Forbidden IP address: {ip} for hostname {host}")
+        return addresses
+
+    async def close(self):
+        await self._resolver.close()
+
+
+# Fully-read HTTP response, with the same interface as a 'requests' response for the parts used by the shared helpers in atproto_oauth (nonce handling, error detection, cache headers)
+class AsyncResponse:
+    def __init__(self, status_code: int, headers, content: bytes, url: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPStatusError(self.status_code, self.url)
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status_code: int, url: str):
+        super().__init__(f"HTTP {status_code} for {url}")
+        self.status_code = status_code
+
+
+# asyncio version of the atproto identity resolution and OAuth client operations in atproto_identity and atproto_oauth (PAR, token, refresh, revoke, and authenticated PDS requests). A single instance can run thousands of concurrent exchanges without a thread per request.
+# The same SSRF mitigations apply as for the synchronous code: every URL is checked with is_safe_url, connections to private IP addresses are refused (with a stricter check than requests_hardened, see is_forbidden_ip), redirects are never followed, and all requests have timeouts. DPoP nonces and discovery documents share the same caches as the synchronous code.
+# Requests are recorded in the same outbound request metrics, with the same operation names, and as "http" tracing spans.
+# The HTTP session (with its keep-alive connection pool) is created on first use, and should be closed with 'await client.close()' (or by using the client as an async context manager).
+class AsyncOAuthClient:
+    def __init__(
+        self,
+        client_secret_jwk: JsonWebKey,
+        per_host_connections: int = 8,
+        max_connections: int = 256,
+        timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(
+            total=30, connect=2, sock_read=10
+        ),
+        allow_loopback: bool = False,
+        user_agent: str = "AtprotoCookbookOAuthFlaskDemo",
+    ):
+        self.client_secret_jwk = client_secret_jwk
+        self.per_host_connections = per_host_connections
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.allow_loopback = allow_loopback
+        self.user_agent = user_agent
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _http(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                resolver=PublicAddressResolver(self.allow_loopback),
+                limit=self.max_connections,
+                limit_per_host=self.per_host_connections,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"User-Agent": self.user_agent},
+                # sessions are shared between users, so never persist cookies set by remote servers
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self._session
+
+    # IMPORTANT: all URLs passed here are untrusted input; SSRF mitigations are applied to every request. Refused requests raise BlockedRequestError.
+    async def request(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        if not is_safe_url(url):
+            raise BlockedRequestError(f"URL not allowed: {url}")
+        parts = urlparse(url)
+        with tracing.span(
+            "http", kind="client", method=method, url=f"{parts.scheme}://{parts.netloc}{parts.path}"
+        ) as span:
+            status = None
+            start = time.perf_counter()
+            try:
+                async with self._http().request(
+                    method, url, allow_redirects=False, **kwargs
+                ) as resp:
+                    content = await resp.read()
+                    status = resp.status
+                    span.set("status_code", status)
+                    return AsyncResponse(resp.status, resp.headers, content, url)
+            except aiohttp.ClientConnectorError as e:
+                if isinstance(e.os_error, BlockedRequestError):
+                    raise e.os_error from None
+                raise
+            finally:
+                metrics.record_request(url, status, time.perf_counter() - start)
+
+    # Same as atproto_identity.identity_get: returns the response, or None if the host doesn't exist or isn't allowed; raises IdentityLookupError for other failures
+    async def identity_get(self, url: str, **kwargs) -> Optional[AsyncResponse]:
+        try:
+            return await self.request("GET", url, **kwargs)
+        except BlockedRequestError as e:
+            print(f"identity lookup blocked ({url}): {e}")
+            return None
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            if is_host_not_found(e):
+                return None
+            raise IdentityLookupError(f"request to {url} failed: {e}") from e
+
+    # resolves an identity (handle or DID) to a DID, handle, and DID document. verifies handle bi-directionally. Same checks as atproto_identity.resolve_identity, and shares its caches.
+    @tracing.traced()
+    async def resolve_identity(self, atid: str) -> Tuple[str, str, dict]:
+        if is_valid_handle(atid):
+            handle = atid
+            did = await self.resolve_handle(handle)
+            if not did:
+                raise Exception("Failed to resolve handle: " + handle)
+            doc = await self.resolve_did(did)
+            if not doc:
+                raise Exception("Failed to resolve DID: " + did)
+            doc_handle = handle_from_doc(doc)
+            if not doc_handle or doc_handle != handle:
+                raise Exception("Handle did not match DID: " + handle)
+            return did, handle, doc
+        if is_valid_did(atid):
+            did = atid
+            doc = await self.resolve_did(did)
+            if not doc:
+                raise Exception("Failed to resolve DID: " + did)
+            handle = handle_from_doc(doc)
+            if not handle:
+                raise Exception("Handle did not match DID: " + did)
+            if await self.resolve_handle(handle) != did:
+                raise Exception("Handle did not match DID: " + handle)
+            return did, handle, doc
+
+        raise Exception("identifier not a handle or DID: " + atid)
+
+    @tracing.traced()
+    async def resolve_handle(self, handle: str) -> Optional[str]:
+        return await HANDLE_CACHE.get_async(
+            handle.lower(), lambda: self.resolve_handle_uncached(handle)
+        )
+
+    @tracing.traced()
+    async def resolve_did(self, did: str) -> Optional[dict]:
+        return await DID_CACHE.get_async(did, lambda: self.resolve_did_uncached(did))
+
+    # Races the DNS TXT and HTTPS well-known methods, like atproto_identity.resolve_handle_uncached, with the same error handling: None only if both methods gave a definitive "not found". DNS takes precedence if both succeed; unlike the threaded version, the losing HTTP request is actually cancelled.
+    @tracing.traced()
+    async def resolve_handle_uncached(self, handle: str) -> Optional[str]:
+        http_task = asyncio.ensure_future(self.resolve_handle_http(handle))
+        try:
+            try:
+                did = await self.resolve_handle_dns(handle)
+            except IdentityLookupError as e:
+                did, dns_error = None, e
+            else:
+                dns_error = None
+            if did:
+                return did
+            return combine_handle_results(await http_task, dns_error)
+        finally:
+            http_task.cancel()
+
+    @tracing.traced()
+    async def resolve_handle_dns(self, handle: str) -> Optional[str]:
+        with metrics.observe("dns", op="resolve_handle") as call:
+            try:
+                answer = await dns.asyncresolver.resolve(
+                    f"_atproto.{handle}", "TXT", lifetime=HANDLE_DNS_TIMEOUT
+                )
+                call["status"] = "ok"
+                for record in answer:
+                    val = record.to_text().replace('"', "")
+                    if val.startswith("did="):
+                        val = val[4:]
+                        if is_valid_did(val):
+                            return val
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+                call["status"] = "not_found"
+                print("DNS TXT handle resolution:", e)
+            except Exception as e:
+                print("DNS TXT handle resolution:", e)
+                raise IdentityLookupError(f"DNS TXT handle resolution failed: {e}") from e
+        return None
+
+    @tracing.traced()
+    async def resolve_handle_http(self, handle: str) -> Optional[str]:
+        # IMPORTANT: 'handle' domain is untrusted user input. SSRF mitigations are necessary
+        with metrics.operation("resolve_handle"):
+            resp = await self.identity_get(
+                f"https://{handle}/.well-known/atproto-did",
+                timeout=aiohttp.ClientTimeout(total=HANDLE_HTTP_TIMEOUT),
+            )
+        if resp is None or resp.status_code == 404:
+            return None
+        if resp.status_code != 200:
+            raise IdentityLookupError(f"HTTP handle resolution: status {resp.status_code}")
+        parts = resp.text.split()
+        if parts and is_valid_did(parts[0]):
+            return parts[0]
+        return None
+
+    @tracing.traced()
+    async def resolve_did_uncached(self, did: str) -> Optional[dict]:
+        if did.startswith("did:plc:"):
+            # NOTE: 'did' is untrusted input, but has been validated by regex by this point
+            with metrics.operation("resolve_did"):
+                resp = await self.identity_get(f"{PLC_DIRECTORY_URL}/{did}")
+            # 410 is a tombstoned (deleted) DID
+            if resp is None or resp.status_code in (404, 410):
+                return None
+            if resp.status_code != 200:
+                raise IdentityLookupError(f"PLC directory: status {resp.status_code}")
+            return resp.json()
+
+        if did.startswith("did:web:"):
+            domain = did[8:]
+            # IMPORTANT: domain is untrusted input. SSRF mitigations are necessary
+            # "handle" validation works to check that domain is a simple hostname
+            if not is_valid_handle(domain):
+                return None
+            with metrics.operation("resolve_did"):
+                resp = await self.identity_get(f"https://{domain}/.well-known/did.json")
+            if resp is None or resp.status_code == 404:
+                return None
+            if resp.status_code != 200:
+                raise IdentityLookupError(f"did:web resolution: status {resp.status_code}")
+            return resp.json()
+        raise ValueError("unsupported DID type")
+
+    # Takes a Resource Server (PDS) URL, and tries to resolve it to an Authorization Server host/origin
+    @tracing.traced()
+    async def resolve_pds_authserver(self, url: str) -> str:
+        assert is_safe_url(url)
+
+        async def load():
+            previous = PDS_AUTHSERVER_CACHE.peek(url)
+            with metrics.operation("resolve_pds_authserver"):
+                resp = await self.request(
+                    "GET",
+                    f"{url}/.well-known/oauth-protected-resource",
+                    headers=discovery_headers(previous),
+                )
+            return pds_authserver_entry_from_response(resp, previous)
+
+        entry = await PDS_AUTHSERVER_CACHE.get_async(url, load)
+        return entry["authserver_url"]
+
+    # Fetches (and validates) Authorization Server metadata
+    @tracing.traced()
+    async def fetch_authserver_meta(self, url: str) -> dict:
+        assert is_safe_url(url)
+
+        async def load():
+            previous = AUTHSERVER_META_CACHE.peek(url)
+            with metrics.operation("authserver_meta"):
+                resp = await self.request(
+                    "GET",
+                    f"{url}/.well-known/oauth-authorization-server",
+                    headers=discovery_headers(previous),
+                )
+            return authserver_meta_entry_from_response(resp, previous, url)
+
+        entry = await AUTHSERVER_META_CACHE.get_async(url, load)
+        return entry["meta"]
+
+    # POST data to auth server with client assertion and DPoP, handling DPoP nonce rotation
+    # Returns latest DPoP nonce and response (which may be an error response)
+    @tracing.traced()
+    async def auth_server_post(
+        self,
+        authserver_url: str,
+        client_id: str,
+        dpop_signer: DpopSigner,
+        dpop_authserver_nonce: str,
+        post_url: str,
+        post_data: dict,
+    ) -> Tuple[str, AsyncResponse]:
+        client_assertion = client_assertion_jwt(
+            client_id, authserver_url, self.client_secret_jwk
+        )
+        post_data = post_data | {
+            "client_id": client_id,
+            "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+            "client_assertion": client_assertion,
+        }
+        dpop_authserver_nonce = DPOP_NONCES.get(post_url) or dpop_authserver_nonce
+
+        for _ in range(2):
+            dpop_proof = authserver_dpop_jwt(
+                "POST", post_url, dpop_authserver_nonce, dpop_signer
+            )
+            resp = await self.request(
+                "POST", post_url, data=post_data, headers={"DPoP": dpop_proof}
+            )
+            dpop_authserver_nonce = (
+                DPOP_NONCES.update(post_url, resp) or dpop_authserver_nonce
+            )
+            if not is_use_dpop_nonce_error_response(resp):
+                break
+            print(f"retrying with new auth server DPoP nonce: {dpop_authserver_nonce}")
+            metrics.record_nonce_retry(post_url)
+            tracing.current_span().set("dpop_nonce_retry", True)
+
+        return dpop_authserver_nonce, resp
+
+    # Sends a pushed auth request (PAR). Returns (pkce_verifier, state, dpop_authserver_nonce, response), without checking HTTP response status
+    @tracing.traced()
+    async def send_par_auth_request(
+        self,
+        authserver_url: str,
+        authserver_meta: dict,
+        login_hint: Optional[str],
+        client_id: str,
+        redirect_uri: str,
+        scope: str,
+        dpop_private_jwk: JsonWebKey,
+    ) -> Tuple[str, str, str, AsyncResponse]:
+        par_url = authserver_meta["pushed_authorization_request_endpoint"]
+        pkce_verifier, state, par_body = par_request_body(login_hint, redirect_uri, scope)
+        with metrics.operation("par"):
+            dpop_authserver_nonce, resp = await self.auth_server_post(
+                authserver_url,
+                client_id,
+                DpopSigner(dpop_private_jwk),
+                "",  # not yet known
+                par_url,
+                par_body,
+            )
+        return pkce_verifier, state, dpop_authserver_nonce, resp
+
+    # Completes the auth flow with the initial token request. Returns token response (dict) and DPoP nonce (str)
+    @tracing.traced()
+    async def initial_token_request(
+        self,
+        auth_request: dict,
+        code: str,
+        client_id: str,
+        redirect_uri: str,
+    ) -> Tuple[dict, str]:
+        authserver_url = auth_request["authserver_iss"]
+        authserver_meta = await self.fetch_authserver_meta(authserver_url)
+        params = {
+            "redirect_uri": redirect_uri,
+            "grant_type": "authorization_code",
+            "code": code,
+            "code_verifier": auth_request["pkce_verifier"],
+        }
+        with metrics.operation("token"):
+            dpop_authserver_nonce, resp = await self.auth_server_post(
+                authserver_url,
+                client_id,
+                dpop_signer_for(auth_request["dpop_private_jwk"]),
+                auth_request["dpop_authserver_nonce"],
+                authserver_meta["token_endpoint"],
+                params,
+            )
+        resp.raise_for_status()
+        # IMPORTANT: the 'sub' field must be verified against the original request by code calling this function.
+        return resp.json(), dpop_authserver_nonce
+
+    # Returns token response (dict) and DPoP nonce (str)
+    @tracing.traced()
+    async def refresh_token_request(self, user: dict, client_id: str) -> Tuple[dict, str]:
+        authserver_url = user["authserver_iss"]
+        authserver_meta = await self.fetch_authserver_meta(authserver_url)
+        with metrics.operation("refresh"):
+            dpop_authserver_nonce, resp = await self.auth_server_post(
+                authserver_url,
+                client_id,
+                dpop_signer_for(user["dpop_private_jwk"]),
+                user["dpop_authserver_nonce"],
+                authserver_meta["token_endpoint"],
+                {"grant_type": "refresh_token", "refresh_token": user["refresh_token"]},
+            )
+        if resp.status_code not in [200, 201]:
+            print(f"Token Refresh Error: {resp.text}")
+        resp.raise_for_status()
+        return resp.json(), dpop_authserver_nonce
+
+    @tracing.traced()
+    async def revoke_token_request(self, user: dict, client_id: str):
+        authserver_url = user["authserver_iss"]
+        authserver_meta = await self.fetch_authserver_meta(authserver_url)
+
+        # Revocation may not be supported by all ASes
+        revoke_url = authserver_meta.get("revocation_endpoint")
+        if not revoke_url:
+            print("revocation_endpoint not in authserver_meta, doing nothing")
+            return
+
+        dpop_signer = dpop_signer_for(user["dpop_private_jwk"])
+        dpop_authserver_nonce = user["dpop_authserver_nonce"]
+        for token_type in ["access_token", "refresh_token"]:
+            with metrics.operation("revoke"):
+                dpop_authserver_nonce, resp = await self.auth_server_post(
+                    authserver_url,
+                    client_id,
+                    dpop_signer,
+                    dpop_authserver_nonce,
+                    revoke_url,
+                    {"token": user[token_type], "token_type_hint": token_type},
+                )
+            resp.raise_for_status()
+
+    # Makes an authenticated request to the user's PDS, with the same DPoP nonce retry and expired token handling as atproto_oauth.pds_authed_req. 'refresh' is a coroutine function here.
+    @tracing.traced()
+    async def pds_authed_req(
+        self,
+        method: str,
+        url: str,
+        user: dict,
+        nonce_writer: Optional[NonceWriteBehind] = None,
+        body=None,
+        refresh: Optional[Callable[[str], Awaitable[dict]]] = None,
+    ) -> AsyncResponse:
+        dpop_signer = dpop_signer_for(user["dpop_private_jwk"])
+        dpop_pds_nonce = DPOP_NONCES.get(url) or user["dpop_pds_nonce"]
+        access_token = user["access_token"]
+
+        nonce_retried, token_refreshed = False, False
+        with metrics.operation("pds_write"):
+            while True:
+                dpop_jwt = pds_dpop_jwt(method, url, access_token, dpop_pds_nonce, dpop_signer)
+                resp = await self.request(
+                    method,
+                    url,
+                    headers={
+                        "Authorization": f"DPoP {access_token}",
+                        "DPoP": dpop_jwt,
+                    },
+                    json=body,
+                )
+                dpop_pds_nonce = DPOP_NONCES.update(url, resp) or dpop_pds_nonce
+
+                if not nonce_retried and is_use_dpop_nonce_error_response(resp):
+                    print(f"retrying with new PDS DPoP nonce: {dpop_pds_nonce}")
+                    metrics.record_nonce_retry(url)
+                    tracing.current_span().set("dpop_nonce_retry", True)
+                    nonce_retried = True
+                    continue
+
+                if refresh is not None and not token_refreshed and is_invalid_token_error_response(resp):
+                    print(f"access token rejected by PDS, refreshing: {user['did']}")
+                    user = await refresh(access_token)
+                    access_token = user["access_token"]
+                    token_refreshed = True
+                    continue
+                break
+
+        if nonce_writer is not None and dpop_pds_nonce != user["dpop_pds_nonce"]:
+            nonce_writer.put(user["did"], dpop_pds_nonce)
+
+        return resp
+
+
+if __name__ == "__main__":
+    # private addresses are refused before any connection is made
+    async def main():
+        resolver = PublicAddressResolver()
+        try:
+            await resolver.resolve("localhost", 443)
+            raise AssertionError("loopback address was allowed")
+        except BlockedRequestError:
+            pass
+        assert await PublicAddressResolver(allow_loopback=True).resolve("localhost", 443)
+
+        # only globally routable unicast addresses are allowed (checked with a stubbed DNS lookup)
+        class StubResolver:
+            def __init__(self, ip):
+                self.ip = ip
+
+            async def resolve(self, host, port=0, family=socket.AF_INET):
+                return [{"hostname": host, "host": self.ip, "port": port, "family": family, "proto": 0, "flags": 0}]
+
+        blocked = ["10.0.0.1", "100.64.0.1", "64:ff9b::a00:1", "224.0.0.1", "ff02::1", "::ffff:127.0.0.1", "2002:a00:1::1", "0.0.0.0", "169.254.169.254"]
+        for ip in blocked + ["8.8.8.8", "2606:4700:4700::1111", "64:ff9b::808:808"]:
+            resolver._resolver = StubResolver(ip)
+            try:
+                await resolver.resolve("stub.example.com", 443)
+                assert ip not in blocked, f"{ip} was allowed"
+            except BlockedRequestError:
+                assert ip in blocked, f"{ip} was blocked"
+
+        # refused URLs are a definitive "not found" for identity lookups (so they are negative-cached), not an exception
+        async with AsyncOAuthClient(None) as client:
+            try:
+                await client.request("GET", "http://example.com/")
+                raise AssertionError("unsafe URL was allowed")
+            except BlockedRequestError:
+                pass
+            assert await client.identity_get("https://127.0.0.1/.well-known/did.json") is None
+            assert await client.resolve_did_uncached("did:web:127.0.0.1") is None
+        print("ok")
+
+    asyncio.run(main())
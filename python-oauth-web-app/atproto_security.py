@@ -1,6 +1,14 @@
+import time
+import threading
+import contextlib
+from http.cookiejar import DefaultCookiePolicy
 from urllib.parse import urlparse
+import requests
 import requests_hardened
 
+import metrics
+import tracing
+
 
 # this is a crude/partial filter that looks at HTTPS URLs and checks if they seem "safe" for server-side requests (SSRF). This is only a partial mitigation, the actual HTTP client also needs to prevent other attacks and behaviors.
 # this isn't a fully complete or secure implementation
@@ -29,8 +37,129 @@ def is_safe_url(url):
     return True
 
 
-# configures a "hardened" requests wrapper
-hardened_http = requests_hardened.Manager(
+# A hardened requests session which is returned to a HardenedSessionPool after use, instead of being closed.
+# The SSRF protections (IP filter, no redirects, default timeouts) all come from the requests_hardened base class; note that the IP filter runs on every request (not just when a connection is opened), and pooled connections are keyed by the resolved IP.
+class PooledHTTPSession(requests_hardened.HTTPSession):
+    def __init__(self, config: requests_hardened.Config, pool: "HardenedSessionPool"):
+        super().__init__(config)
+        self._pool = pool
+        for adapter in self.adapters.values():
+            adapter.init_poolmanager(pool.max_hosts, pool.per_host_connections)
+        # sessions are shared between users, so never persist cookies set by remote servers
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    # Every request is recorded in the outbound request metrics (see metrics.py) and as an "http" tracing span, not counting time spent waiting for a per-host slot
+    def send(self, request, **kwargs):
+        url = request.url
+        parts = urlparse(url)
+        with self._pool.host_slot(parts.hostname):
+            with tracing.span(
+                "http", kind="client", method=request.method, url=f"{parts.scheme}://{parts.netloc}{parts.path}"
+            ) as span:
+                status = None
+                start = time.perf_counter()
+                try:
+                    resp = super().send(request, **kwargs)
+                    status = resp.status_code
+                    span.set("status_code", status)
+                    return resp
+                finally:
+                    metrics.record_request(url, status, time.perf_counter() - start)
+
+
+# Raised when a request waited too long for a per-host connection slot (see HardenedSessionPool.host_slot)
+class HostSlotTimeout(requests.exceptions.Timeout):
+    pass
+
+
+# Long-lived, thread-safe pool of hardened HTTP sessions, so that repeated requests to the same PDS or entryway re-use warm (keep-alive) connections instead of paying for a new TCP+TLS handshake every time.
+# Each session is used by only one thread at a time: 'get_session()' checks one out (most recently used first, since it is most likely to have warm connections), and returns it to the pool at the end of the 'with' block.
+# The number of concurrent requests to any single host is limited across all sessions; a request which can't get a slot within 'slot_timeout' seconds fails with HostSlotTimeout. Sessions which have been idle for longer than 'idle_timeout' seconds are closed.
+class HardenedSessionPool:
+    def __init__(
+        self,
+        config: requests_hardened.Config,
+        max_idle_sessions: int = 16,
+        per_host_connections: int = 8,
+        max_hosts: int = 32,
+        idle_timeout: float = 60,
+        slot_timeout: float = 10,
+    ):
+        self.config = config
+        self.max_idle_sessions = max_idle_sessions
+        self.per_host_connections = per_host_connections
+        self.max_hosts = max_hosts
+        self.idle_timeout = idle_timeout
+        self.slot_timeout = slot_timeout
+        # stack of (session, last_used), oldest first
+        self._idle = []
+        self._lock = threading.Lock()
+        self._host_active = {}
+        self._host_cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def get_session(self):
+        sess = self._checkout()
+        try:
+            yield sess
+        finally:
+            self._checkin(sess)
+
+    @contextlib.contextmanager
+    def host_slot(self, host: str):
+        deadline = time.monotonic() + self.slot_timeout
+        with self._host_cond:
+            while self._host_active.get(host, 0) >= self.per_host_connections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise HostSlotTimeout(f"timed out waiting for a connection slot for {host}")
+                self._host_cond.wait(remaining)
+            self._host_active[host] = self._host_active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self._host_cond:
+                self._host_active[host] -= 1
+                if self._host_active[host] == 0:
+                    del self._host_active[host]
+                self._host_cond.notify_all()
+
+    # Creates up to 'count' idle sessions ahead of time, eg before a worker process starts taking requests
+    def warm(self, count: int):
+        for _ in range(min(count, self.max_idle_sessions)):
+            self._checkin(PooledHTTPSession(self.config, self))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sess, _ in idle:
+            sess.close()
+
+    def _checkout(self) -> PooledHTTPSession:
+        now = time.monotonic()
+        expired = []
+        sess = None
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.pop(0)[0])
+            if self._idle:
+                sess = self._idle.pop()[0]
+        for old in expired:
+            old.close()
+        if sess is None:
+            sess = PooledHTTPSession(self.config, self)
+        return sess
+
+    def _checkin(self, sess: PooledHTTPSession):
+        with self._lock:
+            if len(self._idle) < self.max_idle_sessions:
+                self._idle.append((sess, time.monotonic()))
+                return
+        sess.close()
+
+
+# configures a "hardened" requests wrapper, with a pool of re-usable sessions
+hardened_http = HardenedSessionPool(
     requests_hardened.Config(
         default_timeout=(2, 10),
         never_redirect=True,
@@ -39,3 +168,24 @@ hardened_http = requests_hardened.Manager(
         user_agent_override="AtprotoCookbookOAuthFlaskDemo",
     )
 )
+
+
+if __name__ == "__main__":
+    assert is_safe_url("https://bsky.social/xrpc/com.atproto.server.describeServer")
+    assert not is_safe_url("https://x.local/")
+    assert not is_safe_url("https://127.0.0.1/")
+
+    pool = HardenedSessionPool(hardened_http.config, per_host_connections=1, slot_timeout=0.05)
+    with pool.host_slot("example.com"):
+        # a second slot for the same host times out, while other hosts aren't affected
+        with pool.host_slot("other.example.com"):
+            pass
+        start = time.monotonic()
+        try:
+            with pool.host_slot("example.com"):
+                assert False
+        except HostSlotTimeout:
+            assert time.monotonic() - start >= 0.05
+    with pool.host_slot("example.com"):
+        pass
+    print("ok")
@@ -0,0 +1,88 @@
+# Throughput benchmark for batch identity resolution, against a local stand-in PLC directory and handle resolver.
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.bench_identity [num_accounts] [latency_seconds]
+
+import sys
+import time
+from typing import Optional
+
+import requests
+import requests_hardened
+
+import atproto_identity
+from atproto_security import HardenedSessionPool
+from benchmarks.mock_servers import MockIdentityServer
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+
+    server = MockIdentityServer(latency=latency).start()
+    accounts = server.add_accounts(count)
+
+    # point DID and handle resolution at the local server. The DNS method is replaced with an HTTP lookup against the mock, and the real HTTPS well-known method is disabled (it would refuse to connect to loopback addresses anyway).
+    atproto_identity.PLC_DIRECTORY_URL = server.url
+    atproto_identity.hardened_http = HardenedSessionPool(
+        requests_hardened.Config(
+            default_timeout=(2, 10),
+            never_redirect=True,
+            ip_filter_enable=True,
+            ip_filter_allow_loopback_ips=True,
+        ),
+        per_host_connections=32,
+    )
+    atproto_identity.RACE_HANDLE_RESOLUTION = False
+
+    def mock_resolve_handle_dns(handle: str, timeout: float = 2.0) -> Optional[str]:
+        resp = requests.get(f"{server.url}/handle/{handle}", timeout=timeout)
+        return resp.text if resp.status_code == 200 else None
+
+    atproto_identity.resolve_handle_dns = mock_resolve_handle_dns
+    atproto_identity.resolve_handle_http = lambda handle, timeout=None: None
+
+    # half handles, half DIDs, with some duplicates and a few unknown accounts
+    inputs = [handle for _, handle in accounts[: count // 2]]
+    inputs += [did for did, _ in accounts[count // 2 :]]
+    inputs += inputs[: count // 10]
+    inputs += [f"missing-{i}.bench.test" for i in range(count // 20)]
+
+    def reset():
+        atproto_identity.HANDLE_CACHE.clear()
+        atproto_identity.DID_CACHE.clear()
+        server.requests = 0
+
+    reset()
+    start = time.perf_counter()
+    serial_errors = 0
+    for atid in inputs:
+        try:
+            atproto_identity.resolve_identity(atid)
+        except Exception:
+            serial_errors += 1
+    serial_secs = time.perf_counter() - start
+    serial_requests = server.requests
+
+    reset()
+    start = time.perf_counter()
+    batch_results, batch_errors = 0, 0
+    for _, result, error in atproto_identity.resolve_identities(inputs, concurrency=32):
+        batch_results += 1
+        if error:
+            batch_errors += 1
+    batch_secs = time.perf_counter() - start
+
+    print(f"inputs: {len(inputs)}  unique: {batch_results}  simulated latency: {latency * 1000:.0f}ms")
+    print(
+        f"serial loop:         {serial_secs:7.2f}s  {len(inputs) / serial_secs:8.1f} items/s  requests={serial_requests}  errors={serial_errors}"
+    )
+    print(
+        f"resolve_identities:  {batch_secs:7.2f}s  {len(inputs) / batch_secs:8.1f} items/s  requests={server.requests}  errors={batch_errors}"
+    )
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
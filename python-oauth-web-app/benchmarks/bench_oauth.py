@@ -0,0 +1,227 @@
+# Benchmark suite for the OAuth web app, against a local stand-in atproto network (PLC directory, handle resolution, Authorization Server and PDS; see MockAtprotoNetwork).
+# Each simulated user goes through the whole flow using the Flask test client, and the end-to-end latency of each route is recorded: oauth_login (identity resolution, PAR), oauth_callback (token request), bsky_post (PDS createRecord) and oauth_refresh (refresh token request). Every user is a new account, so identity resolution is never cached; Authorization Server metadata is.
+# Some hot helper functions are also micro-benchmarked on their own.
+# Results are printed as a table, and can also be written as JSON (for tracking regressions between commits) with --json.
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.bench_oauth [--users N] [--latency SECONDS] [--json results.json]
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+from urllib.parse import urlparse, parse_qs
+
+from authlib.jose import JsonWebKey
+
+from benchmarks.mock_servers import MockAtprotoNetwork
+
+ROUTES = ["oauth_login", "oauth_callback", "bsky_post", "oauth_refresh", "oauth_logout"]
+POST_TEXT = "benchmarking the #atproto OAuth demo with some #hashtags and #facets"
+
+
+# Same as generate_jwk.py
+def generate_client_key() -> JsonWebKey:
+    return JsonWebKey.generate_key("EC", "P-256", options={"kid": f"bench-{int(time.time())}"}, is_private=True)
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+# Runs the full login/post/refresh/logout flow for one user, returning the latency of each route (seconds)
+def run_user(flask_app, network: MockAtprotoNetwork, did: str, handle: str) -> dict:
+    client = flask_app.test_client()
+    timings = {}
+
+    start = time.perf_counter()
+    resp = client.post("/oauth/login", data={"username": handle})
+    timings["oauth_login"] = time.perf_counter() - start
+    assert resp.status_code == 302, f"login failed: {resp.status_code}"
+    request_uri = parse_qs(urlparse(resp.location).query)["request_uri"][0]
+
+    # the user approves the request at the Authorization Server (not timed)
+    callback_params = network.authorize(request_uri, did)
+
+    start = time.perf_counter()
+    resp = client.get("/oauth/callback", query_string=callback_params)
+    timings["oauth_callback"] = time.perf_counter() - start
+    assert resp.status_code == 302, f"callback failed: {resp.status_code}"
+
+    start = time.perf_counter()
+    resp = client.post("/bsky/post", data={"post_text": POST_TEXT})
+    timings["bsky_post"] = time.perf_counter() - start
+    assert resp.status_code == 200, f"post failed: {resp.status_code}"
+
+    start = time.perf_counter()
+    resp = client.get("/oauth/refresh")
+    timings["oauth_refresh"] = time.perf_counter() - start
+    assert resp.status_code == 302, f"refresh failed: {resp.status_code}"
+
+    start = time.perf_counter()
+    resp = client.get("/oauth/logout")
+    timings["oauth_logout"] = time.perf_counter() - start
+    assert resp.status_code == 302, f"logout failed: {resp.status_code}"
+    return timings
+
+
+def bench_routes(users: int, latency: float, nonce_lifetime: float, store: str) -> tuple:
+    network = MockAtprotoNetwork(latency=latency, nonce_lifetime=nonce_lifetime).start()
+    network.install()
+
+    import app
+
+    # the app logs every step with print(); that would drown out (and slow down) the results
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(None):
+        flask_app = app.create_app(
+            {
+                "SECRET_KEY": "bench",
+                "CLIENT_SECRET_JWK": generate_client_key().as_dict(is_private=True),
+                "SESSION_STORE": store,
+                "DATABASE_URL": os.path.join(tmp, "bench.sqlite"),
+                "CACHE_DATABASE_URL": "",
+            }
+        )
+        accounts = network.add_accounts(users + 1)
+        # the first user warms up imports, connections and Authorization Server metadata, and isn't counted
+        run_user(flask_app, network, *accounts[0])
+        network.counts.clear()
+        network.nonce_errors.clear()
+        samples = [run_user(flask_app, network, did, handle) for did, handle in accounts[1:]]
+        app.pds_nonce_writer.flush()
+        app.session_store.close()
+
+    network.stop()
+    results = []
+    for route in ROUTES:
+        values = [s[route] * 1000 for s in samples]
+        results.append(
+            {
+                "name": route,
+                "kind": "route",
+                "unit": "ms",
+                "n": len(values),
+                "mean": statistics.mean(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "min": min(values),
+                "max": max(values),
+            }
+        )
+    counters = {
+        "requests": dict(network.counts),
+        "dpop_nonce_errors": dict(network.nonce_errors),
+    }
+    return results, counters
+
+
+# Times a single call of 'func', as the best of several repeats (microseconds)
+def bench_func(name: str, func, number: int) -> dict:
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    return {
+        "name": name,
+        "kind": "micro",
+        "unit": "us",
+        "n": number,
+        "mean": best * 1e6,
+        "ops_per_sec": 1 / best,
+    }
+
+
+def bench_micro(number: int) -> list:
+    import atproto_oauth
+    from bsky_util import extract_facets
+
+    client_secret_jwk = generate_client_key()
+    dpop_jwk_json = JsonWebKey.generate_key("EC", "P-256", is_private=True).as_json(is_private=True)
+    dpop_signer = atproto_oauth.dpop_signer_for(dpop_jwk_json)
+    meta = MockAtprotoNetwork().authserver_meta()
+    access_token = "x" * 600
+    client_id = "https://app.example.com/oauth-client-metadata.json"
+    pds_url = "https://pds.example.com/xrpc/com.atproto.repo.createRecord"
+    long_text = " ".join(f"word{i} #tag{i}" if i % 5 == 0 else f"word{i}" for i in range(60))
+
+    return [
+        bench_func(
+            "client_assertion_jwt",
+            lambda: atproto_oauth.client_assertion_jwt(client_id, "https://auth.example.com", client_secret_jwk),
+            number,
+        ),
+        bench_func(
+            "pds_dpop_jwt",
+            lambda: atproto_oauth.pds_dpop_jwt("POST", pds_url, access_token, "nonce", dpop_signer),
+            number,
+        ),
+        bench_func("extract_facets (short)", lambda: extract_facets(POST_TEXT), number * 10),
+        bench_func("extract_facets (300 chars)", lambda: extract_facets(long_text), number * 10),
+        bench_func(
+            "is_valid_authserver_meta",
+            lambda: atproto_oauth.is_valid_authserver_meta(meta, "https://auth.bench.test"),
+            number * 10,
+        ),
+    ]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the OAuth web app routes, against a local stand-in atproto network")
+    parser.add_argument("--users", type=int, default=50, help="simulated users (one full flow each)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated network latency per request (seconds)")
+    parser.add_argument("--nonce-lifetime", type=float, default=60.0, help="DPoP nonce rotation interval of the mock servers (seconds); should be well above the simulated latency")
+    parser.add_argument("--store", default="sqlite", choices=["sqlite", "memory"], help="session store backend")
+    parser.add_argument("--iterations", type=int, default=500, help="calls per micro-benchmark repeat")
+    parser.add_argument("--json", help="write results to this file as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    routes, counters = bench_routes(args.users, args.latency, args.nonce_lifetime, args.store)
+    micro = bench_micro(args.iterations)
+
+    out = sys.stderr if args.json == "-" else sys.stdout
+    print(f"{args.users} users, {args.latency * 1000:.0f}ms simulated latency, {args.store} session store", file=out)
+    print(f"{'route':28s} {'mean':>9s} {'p50':>9s} {'p95':>9s} {'p99':>9s}", file=out)
+    for r in routes:
+        print(f"{r['name']:28s} {r['mean']:7.2f}ms {r['p50']:7.2f}ms {r['p95']:7.2f}ms {r['p99']:7.2f}ms", file=out)
+    print(f"DPoP nonce errors: {counters['dpop_nonce_errors']}", file=out)
+    print(f"{'function':28s} {'per call':>10s} {'calls/s':>10s}", file=out)
+    for r in micro:
+        print(f"{r['name']:28s} {r['mean']:8.1f}us {r['ops_per_sec']:10.0f}", file=out)
+
+    if args.json:
+        report = {
+            "benchmark": "bench_oauth",
+            "timestamp": int(time.time()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(args),
+            "results": routes + micro,
+            "counters": counters,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
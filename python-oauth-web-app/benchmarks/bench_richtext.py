@@ -0,0 +1,211 @@
+# Benchmark for rich-text facet extraction (richtext.tokenize), compared with the regex-based parsers it replaced (the mention and URL regexes of python-bsky-post, and the hashtag regex of bsky_util).
+#
+# - adversarial: inputs built to make a parser do the most work per character, at doubling sizes. For a linear-time parser the time doubles with the size (average growth per doubling ~2x); quadratic behaviour shows up as ~4x, and catastrophic backtracking as worse than that. The old parsers are skipped for larger sizes once a single run goes over --max-seconds.
+# - throughput: a corpus of synthetic posts (up to 300 characters, with a mix of words, emoji, mentions, links and hashtags), reported as posts per second.
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.bench_richtext [--posts N] [--max-size CHARS] [--json results.json]
+
+import gc
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+from richtext import tokenize
+
+# the regexes from create_bsky_post.py and bsky_util.py, before richtext.py
+LEGACY_MENTION_REGEX = re.compile(
+    rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
+)
+LEGACY_URL_REGEX = re.compile(
+    rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
+)
+LEGACY_TAG_REGEX = re.compile(r"(#\w+?\b)")
+
+
+def legacy_tokenize(text: str) -> list:
+    text_bytes = text.encode("UTF-8")
+    tokens = [("mention", m.start(1), m.end(1)) for m in LEGACY_MENTION_REGEX.finditer(text_bytes)]
+    tokens += [("link", m.start(1), m.end(1)) for m in LEGACY_URL_REGEX.finditer(text_bytes)]
+    parts = LEGACY_TAG_REGEX.split(text)
+    start = len(parts[0].encode())
+    for tag, plaintext in zip(parts[1::2], parts[2::2]):
+        tokens.append(("tag", start, start + len(tag.encode())))
+        start += len(tag.encode()) + len(plaintext.encode())
+    return tokens
+
+
+PARSERS = {"tokenize": tokenize, "legacy": legacy_tokenize}
+
+
+# name -> function building an adversarial input of (about) 'n' characters
+def repeat_to(unit: str, n: int, prefix: str = "") -> str:
+    return prefix + unit * max(1, (n - len(prefix)) // len(unit))
+
+
+ADVERSARIAL = {
+    # a URL host which never reaches a valid TLD
+    "long url host": lambda n: repeat_to("a", n, " http://"),
+    # many URL starts, each with a long run of host characters and no TLD
+    "url host runs": lambda n: repeat_to(" http://" + "a" * 60 + "_", n),
+    # dots and hyphens everywhere in the host, so every split is a candidate label
+    "url labels": lambda n: repeat_to("a.-", n, " http://"),
+    # a mention which keeps almost matching: labels of maximum length, then an invalid TLD
+    "mention labels": lambda n: repeat_to("a" * 61 + ".", n, " @"),
+    "mention runs": lambda n: repeat_to(" @" + "a-" * 30 + ".1", n),
+    "at signs": lambda n: repeat_to(" @", n),
+    # hashtag candidates: all digits or all punctuation, so none are valid
+    "hash digits": lambda n: repeat_to(" #" + "1" * 40, n),
+    "hashes": lambda n: repeat_to("#", n, " "),
+    # multi-byte characters around valid tokens, for the byte offset conversion
+    "emoji tokens": lambda n: repeat_to("💩 #tag @a.example.com ", n),
+}
+
+
+def time_call(func, text: str, max_seconds: float) -> float:
+    # best of a few runs (at least 3, unless they're slow), without garbage collection pauses
+    best = None
+    total = 0.0
+    runs = 0
+    gc.disable()
+    try:
+        while total < max_seconds and (runs < 3 or total < 0.2):
+            start = time.perf_counter()
+            func(text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            total += elapsed
+            runs += 1
+    finally:
+        gc.enable()
+    return best
+
+
+def bench_adversarial(max_size: int, max_seconds: float) -> list:
+    sizes = []
+    n = 1000
+    while n <= max_size:
+        sizes.append(n)
+        n *= 2
+    results = []
+    for case, build in ADVERSARIAL.items():
+        for parser, func in PARSERS.items():
+            timings = []
+            for n in sizes:
+                if timings and timings[-1][1] > max_seconds:
+                    break
+                text = build(n)
+                timings.append((len(text), time_call(func, text, max_seconds)))
+            # average growth in time per doubling of the input size
+            growth = (timings[-1][1] / timings[0][1]) ** (1 / (len(timings) - 1)) if len(timings) > 1 else None
+            results.append(
+                {
+                    "name": f"{case} ({parser})",
+                    "kind": "adversarial",
+                    "case": case,
+                    "parser": parser,
+                    "unit": "ms",
+                    "sizes": [size for size, _ in timings],
+                    "times": [t * 1000 for _, t in timings],
+                    "us_per_char": timings[-1][1] / timings[-1][0] * 1e6,
+                    "growth": growth,
+                }
+            )
+    return results
+
+
+WORDS = "the a to and of in is it you that was for on are with as I be at this have from or one had by word but not what all were we when your can said there use an each which she do how their if will up other about out many then them these so some her would make like him into time has look two more write go see number no way could people my than first water been call who oil its now find long down day did get come made may part".split()
+EMOJI = ["💩", "✨", "🦋", "日本語", "ça", "👩‍👩‍👧"]
+
+
+def make_post(rng: random.Random) -> str:
+    parts = []
+    length = 0
+    limit = rng.randint(20, 300)
+    while length < limit:
+        r = rng.random()
+        if r < 0.04:
+            part = f"@{rng.choice(WORDS)}{rng.randint(1, 999)}.bsky.social"
+        elif r < 0.07:
+            part = f"https://{rng.choice(WORDS)}.example.com/{rng.choice(WORDS)}/{rng.randint(1, 99999)}?ref={rng.choice(WORDS)}"
+        elif r < 0.11:
+            part = f"#{rng.choice(WORDS)}{rng.choice(['', 'Bsky', '2024'])}"
+        elif r < 0.15:
+            part = rng.choice(EMOJI)
+        else:
+            part = rng.choice(WORDS) + rng.choice(["", "", "", ",", ".", "!"])
+        parts.append(part)
+        length += len(part) + 1
+    return " ".join(parts)[:300]
+
+
+def bench_throughput(posts: int) -> list:
+    rng = random.Random(42)
+    corpus = [make_post(rng) for _ in range(posts)]
+    chars = sum(len(p) for p in corpus)
+    tokens = sum(len(tokenize(p)) for p in corpus)
+    results = []
+    for parser, func in PARSERS.items():
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            for post in corpus:
+                func(post)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append(
+            {
+                "name": f"corpus ({parser})",
+                "kind": "throughput",
+                "parser": parser,
+                "unit": "us",
+                "n": posts,
+                "mean": best / posts * 1e6,
+                "posts_per_sec": posts / best,
+                "chars_per_sec": chars / best,
+                "tokens": tokens,
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rich-text facet extraction benchmark")
+    parser.add_argument("--posts", type=int, default=20000, help="posts in the throughput corpus")
+    parser.add_argument("--max-size", type=int, default=64000, help="largest adversarial input (characters)")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="stop growing an adversarial case after a run this slow")
+    parser.add_argument("--json", help="write results to this file as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    adversarial = bench_adversarial(args.max_size, args.max_seconds)
+    throughput = bench_throughput(args.posts)
+
+    out = sys.stderr if args.json == "-" else sys.stdout
+    print(f"{'adversarial input':34s} {'chars':>7s} {'time':>10s} {'us/char':>8s} {'growth':>7s}", file=out)
+    for r in adversarial:
+        growth = f"{r['growth']:6.1f}x" if r["growth"] else "      -"
+        print(f"{r['name']:34s} {r['sizes'][-1]:7d} {r['times'][-1]:8.2f}ms {r['us_per_char']:8.3f} {growth}", file=out)
+    for r in throughput:
+        print(f"{r['name']:34s} {r['mean']:7.1f}us/post {r['posts_per_sec']:9.0f} posts/s ({r['tokens']} tokens in {r['n']} posts)", file=out)
+
+    if args.json:
+        report = {
+            "benchmark": "bench_richtext",
+            "timestamp": int(time.time()),
+            "params": vars(args),
+            "results": adversarial + throughput,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Benchmark for the session store backends, with several threads running a request-like mix: every request loads the logged-in session, and some also write (a login storing and consuming an auth request, or a PDS nonce update).
+# The "per-request connection" case is what app.py used to do: a new sqlite connection for every request (default rollback journal), committing even after a SELECT.
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.bench_session_store [threads] [seconds_per_case]
+
+import os
+import sys
+import time
+import sqlite3
+import secrets
+import tempfile
+import threading
+
+from session_store import SessionStore, SqliteSessionStore, MemorySessionStore
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "schema.sql")
+ACCOUNTS = 1000
+
+
+# The previous app.py database helpers, behind the SessionStore interface (only the methods used here)
+class PerRequestConnectionStore(SessionStore):
+    def __init__(self, path: str):
+        self.path = path
+        conn = sqlite3.connect(path)
+        with open(SCHEMA_PATH) as f:
+            conn.executescript(f.read())
+        conn.close()
+
+    def _query(self, query, args=(), one=False):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        try:
+            cur = conn.cursor()
+            cur.execute(query, args)
+            rv = cur.fetchall()
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+        return (rv[0] if rv else None) if one else rv
+
+    def save_auth_request(self, row: dict):
+        self._query(
+            "INSERT INTO oauth_auth_request (state, authserver_iss, pkce_verifier, scope, dpop_authserver_nonce, dpop_private_jwk) VALUES(?, ?, ?, ?, ?, ?);",
+            [row["state"], row["authserver_iss"], row["pkce_verifier"], row["scope"], row["dpop_authserver_nonce"], row["dpop_private_jwk"]],
+        )
+
+    def pop_auth_request(self, state: str):
+        row = self._query("SELECT * FROM oauth_auth_request WHERE state = ?;", [state], one=True)
+        self._query("DELETE FROM oauth_auth_request WHERE state = ?;", [state])
+        return row
+
+    def get_session(self, did: str):
+        return self._query("SELECT * FROM oauth_session WHERE did = ?", [did], one=True)
+
+    def save_session(self, row: dict):
+        self._query(
+            "INSERT OR REPLACE INTO oauth_session (did, pds_url, authserver_iss, access_token, refresh_token, dpop_authserver_nonce, dpop_private_jwk) VALUES(?, ?, ?, ?, ?, ?, ?);",
+            [row["did"], row["pds_url"], row["authserver_iss"], row["access_token"], row["refresh_token"], row["dpop_authserver_nonce"], row["dpop_private_jwk"]],
+        )
+
+    def save_pds_nonces(self, nonces: dict):
+        for did, nonce in nonces.items():
+            self._query("UPDATE oauth_session SET dpop_pds_nonce = ? WHERE did = ?;", [nonce, did])
+
+    # the rest of the SessionStore interface isn't used by this benchmark
+    def delete_expired_auth_requests(self, before: int, limit: int) -> int:
+        raise NotImplementedError
+
+    def get_session_summary(self, did: str):
+        raise NotImplementedError
+
+    def update_session_tokens(self, did, access_token, refresh_token, expires_at, dpop_authserver_nonce):
+        raise NotImplementedError
+
+    def claim_refresh_lease(self, did: str, access_token: str, until: int) -> bool:
+        raise NotImplementedError
+
+    def release_refresh_lease(self, did: str):
+        raise NotImplementedError
+
+    def touch_session(self, did: str, last_seen_at: int):
+        raise NotImplementedError
+
+    def delete_session(self, did: str):
+        raise NotImplementedError
+
+
+def populate(store: SessionStore):
+    for i in range(ACCOUNTS):
+        store.save_session({
+            "did": f"did:plc:bench{i}",
+            "pds_url": "https://pds.example.com",
+            "authserver_iss": "https://as.example.com",
+            "access_token": secrets.token_urlsafe(200),
+            "refresh_token": secrets.token_urlsafe(32),
+            "dpop_authserver_nonce": "nonce",
+            "dpop_private_jwk": secrets.token_urlsafe(180),
+        })
+
+
+def request(store: SessionStore, i: int):
+    did = f"did:plc:bench{i % ACCOUNTS}"
+    assert store.get_session(did) is not None
+    if i % 20 == 0:
+        state = secrets.token_urlsafe(16)
+        store.save_auth_request({
+            "state": state,
+            "authserver_iss": "https://as.example.com",
+            "pkce_verifier": "verifier",
+            "scope": "atproto",
+            "dpop_authserver_nonce": "nonce",
+            "dpop_private_jwk": "{}",
+        })
+        assert store.pop_auth_request(state) is not None
+    elif i % 10 == 0:
+        store.save_pds_nonces({did: secrets.token_urlsafe(8)})
+
+
+def run(name: str, store: SessionStore, threads: int, seconds: float) -> float:
+    populate(store)
+    counts = [0] * threads
+    errors = []
+    deadline = time.perf_counter() + seconds
+
+    def worker(n: int):
+        i = n
+        try:
+            while time.perf_counter() < deadline:
+                request(store, i)
+                i += threads
+                counts[n] += 1
+        except Exception as e:
+            errors.append(e)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    rate = sum(counts) / (time.perf_counter() - start)
+    print(f"{name:28s} {rate:10.0f} requests/s  errors={len(errors)}")
+    if errors:
+        print(f"  first error: {errors[0]}")
+    return rate
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    print(f"{threads} threads, {seconds}s per case")
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = run(
+            "per-request connection", PerRequestConnectionStore(os.path.join(tmp, "baseline.sqlite")), threads, seconds
+        )
+        pooled = run(
+            "SqliteSessionStore (WAL)",
+            SqliteSessionStore(os.path.join(tmp, "pooled.sqlite"), schema_path=SCHEMA_PATH),
+            threads,
+            seconds,
+        )
+        memory = run("MemorySessionStore", MemorySessionStore(), threads, seconds)
+    print(f"SqliteSessionStore speedup: {pooled / baseline:.1f}x")
+    print(f"MemorySessionStore speedup: {memory / baseline:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Benchmark for worker startup: time to import app.py and build the app with create_app(), and the latency of the first requests a fresh worker handles, with and without FLASK_WARMUP. Each run is a fresh Python process.
+# The "eager imports" case also imports the atproto_* modules up front, like app.py used to at import time.
+# The benchmark uses the in-memory session store and doesn't make network requests (warmup is run with an empty FLASK_WARMUP_AUTHSERVERS).
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.bench_startup [runs]
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+from authlib.jose import JsonWebKey
+
+CHILD = """
+import sys, json, time
+timings = {}
+start = time.perf_counter()
+import app
+if EAGER:
+    import atproto_identity, atproto_oauth, atproto_security
+timings["import"] = time.perf_counter() - start
+
+start = time.perf_counter()
+flask_app = app.create_app({"TESTING": True})
+timings["create_app"] = time.perf_counter() - start
+
+client = flask_app.test_client()
+start = time.perf_counter()
+assert client.get("/").status_code == 200
+timings["first GET /"] = time.perf_counter() - start
+
+# an invalid login still has to load the identity and OAuth modules, but doesn't touch the network
+start = time.perf_counter()
+assert client.post("/oauth/login", data={"username": "not a handle"}).status_code == 400
+timings["first POST /oauth/login"] = time.perf_counter() - start
+
+start = time.perf_counter()
+assert client.get("/oauth/jwks.json").status_code == 200
+timings["first GET /oauth/jwks.json"] = time.perf_counter() - start
+
+start = time.perf_counter()
+assert client.post("/oauth/login", data={"username": "not a handle"}).status_code == 400
+timings["second POST /oauth/login"] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def run_child(eager: bool, warmup: bool) -> dict:
+    env = os.environ | {
+        "FLASK_SESSION_STORE": "memory",
+        "FLASK_CACHE_DATABASE_URL": "",
+        "FLASK_SECRET_KEY": "bench",
+        "FLASK_WARMUP": "true" if warmup else "false",
+        "FLASK_WARMUP_AUTHSERVERS": "[]",
+    }
+    out = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", f"EAGER = {eager}\n" + CHILD],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    os.environ["FLASK_CLIENT_SECRET_JWK"] = JsonWebKey.generate_key(
+        "EC", "P-256", is_private=True
+    ).as_json(is_private=True)
+
+    cases = [
+        ("eager imports", True, False),
+        ("lazy imports", False, False),
+        ("lazy imports + warmup", False, True),
+    ]
+    for name, eager, warmup in cases:
+        results = [run_child(eager, warmup) for _ in range(runs)]
+        print(f"{name} (median of {runs} runs):")
+        for key in results[0]:
+            median = statistics.median(r[key] for r in results)
+            print(f"  {key:28s} {median * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+# Load generator for the OAuth web app: simulated users arrive over time, and each one runs the whole login -> callback -> post -> refresh -> logout cycle, against a local stand-in atproto network (see MockAtprotoNetwork) with simulated network latency.
+# Arrivals follow one or more phases (--rates), so a single run can step the load up until the app falls over. The users are split evenly between the phases, and within a phase they arrive at the given rate (users per second), either evenly spaced or as a Poisson process.
+# The app runs in-process, with one thread per active user (up to --max-active; later arrivals queue, and the queueing delay is reported). With --processes, several copies run in separate processes, sharing a single sqlite session database like the worker processes of a real deployment.
+# For each route the report has latency percentiles, error rates, and session store lock contention: time spent waiting for the sqlite write lock (other threads in the same process), time holding it (which includes sqlite's own busy waiting on other processes), waits for a pooled read connection, and "database is locked" errors.
+#
+# Run from the python-oauth-web-app directory:
+#
+#   uv run python -m benchmarks.loadgen [--users N] [--rates 20,50,100] [--processes P] [--json results.json]
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+import collections
+import multiprocessing
+import concurrent.futures
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks.bench_oauth import generate_client_key, percentile
+from benchmarks.mock_servers import MockAtprotoNetwork
+
+ROUTES = ["oauth_login", "oauth_callback", "bsky_post", "oauth_refresh", "oauth_logout"]
+POST_TEXT = "load testing the #atproto OAuth demo"
+
+# the route each thread is currently running; session store writes from the app's own background threads (nonce write-behind, token refresh, auth request sweeper) are counted as "background"
+current = threading.local()
+
+
+def current_route() -> str:
+    return getattr(current, "route", "background")
+
+
+# Session store lock contention, by route
+class ContentionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.write_waits = collections.defaultdict(list)
+        self.write_holds = collections.defaultdict(list)
+        self.read_waits = collections.defaultdict(list)
+
+    def record(self, kind: dict, seconds: float):
+        with self._lock:
+            kind[current_route()].append(seconds)
+
+
+# Stands in for SqliteSessionStore's write lock, timing how long each write waits for it, and how long it is held.
+# When the app is CPU bound, a thread can wait a long time for the GIL right after getting the lock, so wall-clock waits overstate contention: a lock which was free on the first try counts as no wait at all.
+class TimedLock:
+    def __init__(self, lock, stats: ContentionStats):
+        self.lock = lock
+        self.stats = stats
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        if self.lock.acquire(blocking=False):
+            wait = 0.0
+        else:
+            start = time.perf_counter()
+            self.lock.acquire()
+            wait = time.perf_counter() - start
+        self._acquired_at = time.perf_counter()
+        self.stats.record(self.stats.write_waits, wait)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired_at
+        self.lock.release()
+        self.stats.record(self.stats.write_holds, held)
+
+
+# Stands in for SqliteSessionStore's pool of read connections, timing waits for a free connection
+class TimedPool:
+    def __init__(self, pool, stats: ContentionStats):
+        self.pool = pool
+        self.stats = stats
+
+    def get(self):
+        start = time.perf_counter()
+        conn = self.pool.get()
+        self.stats.record(self.stats.read_waits, time.perf_counter() - start)
+        return conn
+
+    def put(self, conn):
+        self.pool.put(conn)
+
+    def empty(self) -> bool:
+        return self.pool.empty()
+
+
+def instrument_store(store, stats: ContentionStats):
+    # unwrap CachedSessionStore
+    store = getattr(store, "store", store)
+    if hasattr(store, "_write_lock"):
+        store._write_lock = TimedLock(store._write_lock, stats)
+        store._readers = TimedPool(store._readers, stats)
+
+
+def error_name(e: Exception) -> str:
+    if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+        return "sqlite_locked"
+    return type(e).__name__
+
+
+# One simulated user. Returns a list of (route, start, latency, error) samples; the cycle stops at the first failed step.
+def run_user(flask_app, network, did: str, handle: str, think_time: float) -> list:
+    client = flask_app.test_client()
+    samples = []
+    state = {}
+
+    def login():
+        resp = client.post("/oauth/login", data={"username": handle})
+        assert resp.status_code == 302, f"HTTP {resp.status_code}"
+        request_uri = parse_qs(urlparse(resp.location).query)["request_uri"][0]
+        # the user approves the request at the Authorization Server (not part of any route)
+        state["callback"] = network.authorize(request_uri, did)
+
+    def callback():
+        resp = client.get("/oauth/callback", query_string=state["callback"])
+        assert resp.status_code == 302 and resp.location.endswith("/bsky/post"), f"HTTP {resp.status_code}"
+
+    def post():
+        resp = client.post("/bsky/post", data={"post_text": POST_TEXT})
+        assert resp.status_code == 200, f"HTTP {resp.status_code}"
+
+    def refresh():
+        resp = client.get("/oauth/refresh")
+        assert resp.status_code == 302 and resp.location.endswith("/"), f"HTTP {resp.status_code}"
+
+    def logout():
+        resp = client.get("/oauth/logout")
+        assert resp.status_code == 302, f"HTTP {resp.status_code}"
+
+    for route, step in zip(ROUTES, [login, callback, post, refresh, logout]):
+        if think_time:
+            time.sleep(random.expovariate(1 / think_time))
+        current.route = route
+        start = time.perf_counter()
+        error = None
+        try:
+            step()
+        except Exception as e:
+            error = error_name(e)
+        finally:
+            current.route = "background"
+        samples.append((route, start, time.perf_counter() - start, error))
+        if error:
+            break
+    return samples
+
+
+# Runs one worker process worth of load: its share of the users, at its share of the arrival rates. Returns the raw samples and contention stats (plain data, so they can be sent back to the parent process).
+def run_worker(index: int, args, db_path: str) -> dict:
+    network = MockAtprotoNetwork(latency=args.latency, nonce_lifetime=args.nonce_lifetime).start()
+    network.install()
+
+    import app
+
+    stats = ContentionStats()
+    with contextlib.redirect_stdout(None):
+        flask_app = app.create_app(
+            {
+                "SECRET_KEY": "loadgen",
+                "CLIENT_SECRET_JWK": args.client_jwk,
+                "SESSION_STORE": args.store,
+                "DATABASE_URL": db_path,
+                "CACHE_DATABASE_URL": "",
+                # let exceptions (eg, "database is locked") reach the load generator, instead of rendering an error page
+                "PROPAGATE_EXCEPTIONS": True,
+            }
+        )
+        instrument_store(app.session_store, stats)
+
+        rates = [rate / args.processes for rate in args.rates]
+        per_phase = args.users // args.processes // len(rates)
+        accounts = network.add_accounts(per_phase * len(rates), first=index * args.users)
+        # warm up imports and Authorization Server metadata with an extra account, which isn't counted
+        run_user(flask_app, network, *network.add_accounts(1, first=args.users * args.processes + index)[0], 0)
+        stats.clear()
+
+        samples, arrivals = [], []
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.max_active)
+        futures = []
+
+        def user_task(phase: int, scheduled: float, did: str, handle: str):
+            started = time.perf_counter()
+            arrivals.append((phase, started - scheduled))
+            return phase, run_user(flask_app, network, did, handle, args.think_time)
+
+        next_arrival = time.perf_counter()
+        for phase, rate in enumerate(rates):
+            for did, handle in accounts[phase * per_phase : (phase + 1) * per_phase]:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(user_task, phase, next_arrival, did, handle))
+                gap = random.expovariate(rate) if args.arrival == "poisson" else 1 / rate
+                next_arrival += gap
+        for future in futures:
+            phase, user_samples = future.result()
+            samples += [(phase,) + sample for sample in user_samples]
+        pool.shutdown()
+        app.pds_nonce_writer.flush()
+        app.session_store.close()
+
+    network.stop()
+    return {
+        "samples": samples,
+        "arrivals": arrivals,
+        "write_waits": dict(stats.write_waits),
+        "write_holds": dict(stats.write_holds),
+        "read_waits": dict(stats.read_waits),
+    }
+
+
+def summarize_ms(values: list) -> dict:
+    if not values:
+        return {"n": 0}
+    values = [v * 1000 for v in values]
+    return {
+        "n": len(values),
+        "nonzero": sum(1 for v in values if v > 0),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+        "total": sum(values),
+    }
+
+
+def build_report(args, results: list) -> dict:
+    samples = [s for r in results for s in r["samples"]]
+    arrivals = [a for r in results for a in r["arrivals"]]
+    contention = {}
+    for kind in ["write_waits", "write_holds", "read_waits"]:
+        merged = collections.defaultdict(list)
+        for r in results:
+            for route, values in r[kind].items():
+                merged[route] += values
+        contention[kind] = merged
+
+    def route_summary(route_samples: list) -> dict:
+        errors = collections.Counter(s[4] for s in route_samples if s[4])
+        ok = [s[3] for s in route_samples if not s[4]]
+        return {
+            "requests": len(route_samples),
+            "errors": sum(errors.values()),
+            "error_rate": sum(errors.values()) / len(route_samples) if route_samples else 0,
+            "error_types": dict(errors),
+            "latency_ms": summarize_ms(ok),
+        }
+
+    routes = {}
+    for route in ROUTES:
+        route_samples = [s for s in samples if s[1] == route]
+        routes[route] = route_summary(route_samples) | {
+            "sqlite_write_lock_wait_ms": summarize_ms(contention["write_waits"].get(route, [])),
+            "sqlite_write_lock_hold_ms": summarize_ms(contention["write_holds"].get(route, [])),
+            "sqlite_read_conn_wait_ms": summarize_ms(contention["read_waits"].get(route, [])),
+        }
+
+    phases = []
+    for phase, rate in enumerate(args.rates):
+        phase_samples = [s for s in samples if s[0] == phase]
+        if not phase_samples:
+            continue
+        start = min(s[2] for s in phase_samples)
+        end = max(s[2] + s[3] for s in phase_samples)
+        phases.append(
+            {
+                "rate": rate,
+                "users": sum(1 for s in phase_samples if s[1] == "oauth_login"),
+                "requests_per_sec": len(phase_samples) / (end - start) if end > start else 0,
+                "queue_delay_ms": summarize_ms([a[1] for a in arrivals if a[0] == phase]),
+                "routes": {
+                    route: route_summary([s for s in phase_samples if s[1] == route])
+                    for route in ROUTES
+                },
+            }
+        )
+
+    params = {k: v for k, v in vars(args).items() if k != "client_jwk"}
+    return {
+        "benchmark": "loadgen",
+        "timestamp": int(time.time()),
+        "params": params,
+        "routes": routes,
+        "phases": phases,
+        "background": {
+            "sqlite_write_lock_wait_ms": summarize_ms(contention["write_waits"].get("background", [])),
+            "sqlite_write_lock_hold_ms": summarize_ms(contention["write_holds"].get("background", [])),
+        },
+    }
+
+
+def print_report(report: dict, out):
+    def ms(summary: dict, key: str) -> str:
+        return f"{summary[key]:8.1f}" if summary["n"] else f"{'-':>8s}"
+
+    print(f"{'route':16s} {'requests':>8s} {'errors':>7s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'max ms':>8s}", file=out)
+    for route, r in report["routes"].items():
+        lat = r["latency_ms"]
+        print(
+            f"{route:16s} {r['requests']:8d} {r['error_rate']:6.1%} {ms(lat, 'p50')} {ms(lat, 'p95')} {ms(lat, 'p99')} {ms(lat, 'max')}"
+            + (f"  {r['error_types']}" if r["errors"] else ""),
+            file=out,
+        )
+
+    print(file=out)
+    print("sqlite lock contention:", file=out)
+    print(f"{'route':16s} {'writes':>7s} {'waited':>7s} {'wait p95':>9s} {'wait max':>9s} {'hold p95':>9s} {'hold max':>9s} {'read wait p95':>14s}", file=out)
+    rows = list(report["routes"].items()) + [("background", report["background"] | {"sqlite_read_conn_wait_ms": {"n": 0}})]
+    for route, r in rows:
+        wait, hold, read = r["sqlite_write_lock_wait_ms"], r["sqlite_write_lock_hold_ms"], r["sqlite_read_conn_wait_ms"]
+        print(
+            f"{route:16s} {wait['n']:7d} {wait.get('nonzero', 0):7d} {ms(wait, 'p95'):>9s} {ms(wait, 'max'):>9s} {ms(hold, 'p95'):>9s} {ms(hold, 'max'):>9s} {ms(read, 'p95'):>14s}",
+            file=out,
+        )
+
+    print(file=out)
+    print("phases:", file=out)
+    for p in report["phases"]:
+        worst = max(p["routes"].items(), key=lambda item: item[1]["latency_ms"].get("p95", 0))
+        errors = sum(r["errors"] for r in p["routes"].values())
+        requests = sum(r["requests"] for r in p["routes"].values())
+        queue = p["queue_delay_ms"]
+        print(
+            f"  {p['rate']:7.1f} users/s  {p['users']:5d} users  {p['requests_per_sec']:7.1f} req/s  errors {errors / requests:6.1%}"
+            f"  queue delay p95 {ms(queue, 'p95').strip()}ms  slowest {worst[0]} p95 {ms(worst[1]['latency_ms'], 'p95').strip()}ms",
+            file=out,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the OAuth web app")
+    parser.add_argument("--users", type=int, default=600, help="total simulated users, split evenly between phases and processes")
+    parser.add_argument("--rates", default="10,30,60", help="comma-separated arrival rates (users per second), one per phase")
+    parser.add_argument("--arrival", default="poisson", choices=["poisson", "constant"], help="arrival process within a phase")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause before each step of a user's cycle (seconds)")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated network latency per request to the mock servers (seconds)")
+    parser.add_argument("--nonce-lifetime", type=float, default=60.0, help="DPoP nonce rotation interval of the mock servers (seconds)")
+    parser.add_argument("--store", default="sqlite", choices=["sqlite", "memory"], help="session store backend")
+    parser.add_argument("--processes", type=int, default=1, help="app worker processes sharing the session database")
+    parser.add_argument("--max-active", type=int, default=256, help="maximum concurrently active users per process")
+    parser.add_argument("--json", help="write the report to this file as JSON ('-' for stdout)")
+    args = parser.parse_args()
+    args.rates = [float(rate) for rate in args.rates.split(",")]
+    args.client_jwk = generate_client_key().as_dict(is_private=True)
+
+    out = sys.stderr if args.json == "-" else sys.stdout
+    print(
+        f"{args.users} users, rates {args.rates} users/s ({args.arrival}), {args.processes} process(es), {args.store} session store, {args.latency * 1000:.0f}ms simulated latency",
+        file=out,
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "loadgen.sqlite")
+        if args.processes == 1:
+            results = [run_worker(0, args, db_path)]
+        else:
+            # create the schema once up front, instead of racing on it
+            from session_store import SqliteSessionStore
+
+            SqliteSessionStore(db_path, schema_path="schema.sql").close()
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(args.processes) as pool:
+                results = pool.starmap(run_worker, [(i, args, db_path) for i in range(args.processes)])
+
+    report = build_report(args, results)
+    print_report(report, out)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import json
+import time
+import base64
+import socket
+import secrets
+import threading
+import collections
+import urllib.parse
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests.adapters
+import requests_hardened
+from authlib.oauth2.rfc7636 import create_s256_code_challenge
+
+from atproto_security import HardenedSessionPool, PooledHTTPSession
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default listen backlog (5) causes connection stalls under concurrent load
+    request_queue_size = 1024
+
+
+# Minimal local stand-in for plc.directory and handle resolution, for benchmarks.
+# Serves DID documents at "/{did}", and resolves handles at "/handle/{handle}" (standing in for a DNS TXT or HTTPS well-known lookup). Every response is delayed by 'latency' seconds to simulate a network round trip.
+class MockIdentityServer:
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.docs = {}
+        self.handles = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.httpd = MockHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    # Registers 'count' did:plc accounts, with handles like "user-0.bench.test". Returns the list of (did, handle).
+    def add_accounts(self, count: int, pds_url: str = "https://pds.bench.test"):
+        accounts = []
+        for i in range(count):
+            did = f"did:plc:bench{i:020d}"
+            handle = f"user-{i}.bench.test"
+            self.docs[did] = {
+                "id": did,
+                "alsoKnownAs": [f"at://{handle}"],
+                "service": [
+                    {
+                        "id": "#atproto_pds",
+                        "type": "AtprotoPersonalDataServer",
+                        "serviceEndpoint": pds_url,
+                    }
+                ],
+            }
+            self.handles[handle] = did
+            accounts.append((did, handle))
+        return accounts
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # headers and body are written separately; without this, keep-alive connections stall on delayed ACKs
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                path = self.path.lstrip("/")
+                if path.startswith("handle/"):
+                    did = server.handles.get(path[7:])
+                    body = did.encode() if did else None
+                else:
+                    doc = server.docs.get(path)
+                    body = json.dumps(doc).encode() if doc else None
+                if body is None:
+                    self.send_response(404)
+                    body = b"not found"
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Sends requests for "https://*.bench.test" URLs to a local plain-HTTP server instead, keeping the original hostname in the Host header
+class MockNetworkAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, target_url: str):
+        super().__init__()
+        self.target_url = target_url
+
+    def send(self, request, **kwargs):
+        parts = urlparse(request.url)
+        request.headers["Host"] = parts.hostname
+        request.url = self.target_url + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+
+# A HardenedSessionPool whose sessions talk to a MockAtprotoNetwork. Other https:// URLs are routed there too, so a benchmark can never accidentally hit real servers.
+class MockNetworkSessionPool(HardenedSessionPool):
+    def __init__(self, target_url: str, **kwargs):
+        super().__init__(
+            requests_hardened.Config(
+                default_timeout=(2, 10),
+                never_redirect=True,
+                ip_filter_enable=False,
+                ip_filter_allow_loopback_ips=True,
+            ),
+            **kwargs,
+        )
+        self.target_url = target_url
+
+    def _checkout(self) -> PooledHTTPSession:
+        sess = super()._checkout()
+        if not isinstance(sess.get_adapter("https://"), MockNetworkAdapter):
+            sess.mount("https://", MockNetworkAdapter(self.target_url))
+        return sess
+
+
+# Local stand-in for the parts of the atproto network that a login touches, for benchmarks: the PLC directory, handle resolution (HTTPS well-known), an OAuth Authorization Server (PAR, token and revocation endpoints) and a PDS (createRecord only).
+# Everything is served by one local HTTP server, which tells the services apart by the Host header. The app under test keeps using ordinary "https://*.bench.test" URLs, so the is_safe_url() and is_valid_authserver_meta() checks run unmodified; install() points the atproto_* modules at this server.
+# Like the real services, the Authorization Server and PDS require a server-issued DPoP nonce in every proof, and rotate it every 'nonce_lifetime' seconds (the previous nonce is still accepted). A missing or stale nonce gets a "use_dpop_nonce" error, so clients pay an extra round trip. Every response is delayed by 'latency' seconds to simulate a network round trip.
+# Signatures (client assertions, DPoP proofs) are not verified: the benchmark is about the cost of the client side.
+class MockAtprotoNetwork:
+    PLC_URL = "https://plc.bench.test"
+    AUTHSERVER_URL = "https://auth.bench.test"
+    PDS_URL = "https://pds.bench.test"
+
+    def __init__(self, latency: float = 0.0, nonce_lifetime: float = 60.0, token_lifetime: int = 3600):
+        self.latency = latency
+        self.nonce_lifetime = nonce_lifetime
+        self.token_lifetime = token_lifetime
+        self.docs = {}
+        self.handles = {}
+        self.par_requests = {}
+        self.codes = {}
+        self.access_tokens = {}
+        self.refresh_tokens = {}
+        self.records = 0
+        # request counts by endpoint, and DPoP nonce errors by host
+        self.counts = collections.Counter()
+        self.nonce_errors = collections.Counter()
+        self._nonces = {}
+        self._lock = threading.Lock()
+        self.httpd = MockHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    # Registers 'count' did:plc accounts hosted on the mock PDS, with handles like "user-0.bench.test". Returns the list of (did, handle).
+    # Account numbers continue from the last call, or start at 'first' (eg, so that several processes sharing one session database use different accounts).
+    def add_accounts(self, count: int, first: Optional[int] = None):
+        if first is None:
+            first = len(self.docs)
+        accounts = []
+        for i in range(first, first + count):
+            did = f"did:plc:bench{i:020d}"
+            handle = f"user-{i}.bench.test"
+            self.docs[did] = {
+                "id": did,
+                "alsoKnownAs": [f"at://{handle}"],
+                "service": [
+                    {
+                        "id": "#atproto_pds",
+                        "type": "AtprotoPersonalDataServer",
+                        "serviceEndpoint": self.PDS_URL,
+                    }
+                ],
+            }
+            self.handles[handle] = did
+            accounts.append((did, handle))
+        return accounts
+
+    def authserver_meta(self) -> dict:
+        url = self.AUTHSERVER_URL
+        return {
+            "issuer": url,
+            "authorization_endpoint": f"{url}/oauth/authorize",
+            "token_endpoint": f"{url}/oauth/token",
+            "pushed_authorization_request_endpoint": f"{url}/oauth/par",
+            "revocation_endpoint": f"{url}/oauth/revoke",
+            "response_types_supported": ["code"],
+            "grant_types_supported": ["authorization_code", "refresh_token"],
+            "code_challenge_methods_supported": ["S256"],
+            "token_endpoint_auth_methods_supported": ["none", "private_key_jwt"],
+            "token_endpoint_auth_signing_alg_values_supported": ["ES256"],
+            "scopes_supported": ["atproto", "transition:generic"],
+            "authorization_response_iss_parameter_supported": True,
+            "require_pushed_authorization_requests": True,
+            "dpop_signing_alg_values_supported": ["ES256"],
+            "require_request_uri_registration": True,
+            "client_id_metadata_document_supported": True,
+        }
+
+    # Stands in for the user approving the authorization request in their browser. Returns the query parameters for the client's callback URL.
+    def authorize(self, request_uri: str, did: str) -> dict:
+        with self._lock:
+            par = self.par_requests.pop(request_uri)
+            code = secrets.token_urlsafe(16)
+            self.codes[code] = par | {"did": did}
+        return {"state": par["state"], "iss": self.AUTHSERVER_URL, "code": code}
+
+    # Patches the atproto_* modules to resolve identities and make OAuth requests against this server
+    def install(self):
+        import atproto_identity
+        import atproto_oauth
+
+        pool = MockNetworkSessionPool(self.url, per_host_connections=32)
+        atproto_identity.PLC_DIRECTORY_URL = self.PLC_URL
+        atproto_identity.hardened_http = pool
+        atproto_oauth.hardened_http = pool
+        # there are no DNS TXT records for the mock handles; only the HTTPS well-known method is used
+        atproto_identity.RACE_HANDLE_RESOLUTION = False
+        atproto_identity.resolve_handle_dns = lambda handle, timeout=None: None
+        return pool
+
+    def current_nonce(self, host: str) -> Tuple[str, Optional[str]]:
+        now = time.monotonic()
+        with self._lock:
+            nonce, previous, issued = self._nonces.get(host, (None, None, 0))
+            if nonce is None or now - issued > self.nonce_lifetime:
+                # a nonce is only accepted for one lifetime after it is replaced
+                previous = nonce if now - issued < 2 * self.nonce_lifetime else None
+                nonce = secrets.token_urlsafe(16)
+                self._nonces[host] = (nonce, previous, now)
+        return nonce, previous
+
+    def _issue_tokens(self, did: str, scope: str) -> dict:
+        access_token = secrets.token_urlsafe(32)
+        refresh_token = secrets.token_urlsafe(32)
+        self.access_tokens[access_token] = (did, time.time() + self.token_lifetime)
+        self.refresh_tokens[refresh_token] = (did, scope)
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "token_type": "DPoP",
+            "scope": scope,
+            "sub": did,
+            "expires_in": self.token_lifetime,
+        }
+
+    # Handles one request. Returns (status, headers, body); the body is JSON-encoded unless it is already bytes.
+    def handle(self, method: str, host: str, path: str, headers, body: bytes):
+        if host == "plc.bench.test":
+            label = "GET plc.bench.test/{did}"
+        elif host in self.handles:
+            label = f"{method} {{handle}}{path}"
+        else:
+            label = f"{method} {host}{path}"
+        with self._lock:
+            self.counts[label] += 1
+
+        if method == "GET":
+            if host == "plc.bench.test" and path[1:] in self.docs:
+                return 200, {}, self.docs[path[1:]]
+            if host == "auth.bench.test" and path == "/.well-known/oauth-authorization-server":
+                return 200, {}, self.authserver_meta()
+            if host == "pds.bench.test" and path == "/.well-known/oauth-protected-resource":
+                return 200, {}, {"resource": self.PDS_URL, "authorization_servers": [self.AUTHSERVER_URL]}
+            if path == "/.well-known/atproto-did" and host in self.handles:
+                return 200, {"Content-Type": "text/plain"}, self.handles[host].encode()
+            return 404, {}, {"error": "NotFound"}
+
+        # everything else is a DPoP-protected POST
+        nonce, previous = self.current_nonce(host)
+        nonce_headers = {"DPoP-Nonce": nonce}
+        proof = self._decode_proof(headers.get("DPoP"))
+        if proof is None or proof.get("htm") != method or proof.get("htu") != f"https://{host}{path}":
+            return 400, nonce_headers, {"error": "invalid_dpop_proof"}
+        if not proof.get("nonce") or proof["nonce"] not in (nonce, previous):
+            with self._lock:
+                self.nonce_errors[host] += 1
+            if host == "pds.bench.test":
+                return 401, nonce_headers | {"WWW-Authenticate": 'DPoP error="use_dpop_nonce"'}, {"error": "use_dpop_nonce"}
+            return 400, nonce_headers, {"error": "use_dpop_nonce"}
+
+        if host == "auth.bench.test":
+            form = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+            status, resp = self._authserver_post(path, form)
+        elif host == "pds.bench.test" and path == "/xrpc/com.atproto.repo.createRecord":
+            status, resp = self._create_record(headers.get("Authorization", ""), json.loads(body))
+        else:
+            status, resp = 404, {"error": "NotFound"}
+        if status == 401:
+            nonce_headers["WWW-Authenticate"] = f'DPoP error="{resp["error"]}"'
+        return status, nonce_headers, resp
+
+    def _decode_proof(self, proof: Optional[str]) -> Optional[dict]:
+        try:
+            payload = proof.split(".")[1]
+            return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except Exception:
+            return None
+
+    def _authserver_post(self, path: str, form: dict):
+        if "client_assertion" not in form:
+            return 401, {"error": "invalid_client"}
+        with self._lock:
+            if path == "/oauth/par":
+                request_uri = f"urn:ietf:params:oauth:request_uri:req-{secrets.token_hex(16)}"
+                self.par_requests[request_uri] = form
+                return 201, {"request_uri": request_uri, "expires_in": 299}
+            if path == "/oauth/token" and form.get("grant_type") == "authorization_code":
+                par = self.codes.pop(form.get("code"), None)
+                if par is None or par["redirect_uri"] != form.get("redirect_uri"):
+                    return 400, {"error": "invalid_grant"}
+                if create_s256_code_challenge(form.get("code_verifier", "")) != par["code_challenge"]:
+                    return 400, {"error": "invalid_grant", "error_description": "PKCE verification failed"}
+                return 200, self._issue_tokens(par["did"], par["scope"])
+            if path == "/oauth/token" and form.get("grant_type") == "refresh_token":
+                # refresh tokens are single use
+                entry = self.refresh_tokens.pop(form.get("refresh_token"), None)
+                if entry is None:
+                    return 400, {"error": "invalid_grant"}
+                return 200, self._issue_tokens(*entry)
+            if path == "/oauth/revoke":
+                self.access_tokens.pop(form.get("token"), None)
+                self.refresh_tokens.pop(form.get("token"), None)
+                return 200, {}
+        return 404, {"error": "NotFound"}
+
+    def _create_record(self, authorization: str, body: dict):
+        scheme, _, access_token = authorization.partition(" ")
+        with self._lock:
+            did, expires_at = self.access_tokens.get(access_token, (None, 0))
+            if scheme != "DPoP" or did is None or expires_at < time.time():
+                return 401, {"error": "invalid_token"}
+            if body.get("repo") != did:
+                return 403, {"error": "Forbidden"}
+            self.records += 1
+            rkey = f"3bench{self.records:08d}"
+        return 200, {
+            "uri": f"at://{did}/{body['collection']}/{rkey}",
+            "cid": "bafyreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm",
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def respond(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                req_body = self.rfile.read(length) if length else b""
+                time.sleep(server.latency)
+                host = (self.headers.get("Host") or "").split(":")[0]
+                path = self.path.split("?")[0]
+                status, headers, body = server.handle(method, host, path, self.headers, req_body)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                    headers = {"Content-Type": "application/json"} | headers
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,25 +1,64 @@
-import re
-
-
-# only supports hashtags, for now
-def extract_facets(text: str) -> list:
-    parts = re.split(
-        r"(#\w+?\b)", text
-    )  # always an odd-length list, with at least one item
-    start_idx = len(parts[0].encode())
-    facets = []
-    for hashtag, plaintext in zip(parts[1::2], parts[2::2]):
-        taglen, textlen = len(hashtag.encode()), len(plaintext.encode())
-        facets.append(
-            {
-                "index": {"byteStart": start_idx, "byteEnd": start_idx + taglen},
-                "features": [
-                    {"$type": "app.bsky.richtext.facet#tag", "tag": hashtag[1:]}
-                ],
-            }
-        )
-        start_idx += taglen + textlen
-    return facets
+import asyncio
+import contextvars
+import concurrent.futures
+from typing import Callable, Optional
+
+from richtext import tokenize, mention_handles, facets_from_tokens
+
+# Only this many distinct handles are resolved per post (in order of first mention); further mentions are left as plain text. A post is at most 300 characters, but there is no reason to make dozens of identity lookups for one.
+MAX_MENTIONS = 10
+# Most handles resolved at the same time for one post
+MAX_CONCURRENT_RESOLVES = 8
+
+
+# Facets (mentions, links and hashtags) for a post's text, see richtext.py. Mentions are only included if 'resolve_handle' is given: it is called once per distinct handle (up to MAX_MENTIONS), concurrently, and returns a DID or None. Handles which fail to resolve are left as plain text.
+def extract_facets(text: str, resolve_handle: Optional[Callable[[str], Optional[str]]] = None) -> list:
+    tokens = tokenize(text)
+    dids = {}
+    handles = mention_handles(tokens)[:MAX_MENTIONS] if resolve_handle else []
+    if len(handles) == 1:
+        results = [resolve_or_error(resolve_handle, handles[0])]
+    elif handles:
+        # each lookup runs in a copy of the caller's context, so it keeps the metrics operation label and tracing span
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(MAX_CONCURRENT_RESOLVES, len(handles)), thread_name_prefix="mentions"
+        ) as pool:
+            futures = [
+                pool.submit(contextvars.copy_context().run, resolve_or_error, resolve_handle, h)
+                for h in handles
+            ]
+            results = [f.result() for f in futures]
+    else:
+        results = []
+    for handle, did in zip(handles, results):
+        if isinstance(did, Exception):
+            print(f"failed to resolve mentioned handle {handle}: {did}")
+            continue
+        dids[handle] = did
+    return facets_from_tokens(tokens, dids)
+
+
+# Calls 'resolve_handle', returning any exception instead of raising it (like asyncio.gather(return_exceptions=True))
+def resolve_or_error(resolve_handle: Callable[[str], Optional[str]], handle: str):
+    try:
+        return resolve_handle(handle)
+    except Exception as e:
+        return e
+
+
+# Same as extract_facets(), with an async 'resolve_handle'. The handles (up to MAX_MENTIONS) are resolved concurrently.
+async def extract_facets_async(text: str, resolve_handle=None) -> list:
+    tokens = tokenize(text)
+    dids = {}
+    if resolve_handle:
+        handles = mention_handles(tokens)[:MAX_MENTIONS]
+        results = await asyncio.gather(*(resolve_handle(h) for h in handles), return_exceptions=True)
+        for handle, did in zip(handles, results):
+            if isinstance(did, Exception):
+                print(f"failed to resolve mentioned handle {handle}: {did}")
+                continue
+            dids[handle] = did
+    return facets_from_tokens(tokens, dids)
 
 
 if __name__ == "__main__":
@@ -56,3 +95,53 @@ if __name__ == "__main__":
             "features": [{"$type": "app.bsky.richtext.facet#tag", "tag": "words"}],
         },
     ]
+
+    assert extract_facets("hi @bob.example.com, see https://bsky.app #atproto") == [
+        {
+            "index": {"byteStart": 25, "byteEnd": 41},
+            "features": [{"$type": "app.bsky.richtext.facet#link", "uri": "https://bsky.app"}],
+        },
+        {
+            "index": {"byteStart": 42, "byteEnd": 50},
+            "features": [{"$type": "app.bsky.richtext.facet#tag", "tag": "atproto"}],
+        },
+    ]
+    resolved = {"bob.example.com": "did:plc:bob"}
+    facets = extract_facets("hi @bob.example.com @Bob.example.com @nobody.example.com", resolved.get)
+    assert [f["features"][0].get("did") for f in facets] == ["did:plc:bob", "did:plc:bob"]
+
+    # mentions are resolved concurrently, and only up to MAX_MENTIONS of them
+    import time
+    import threading
+
+    calls = []
+    calls_lock = threading.Lock()
+
+    def resolve_slowly(handle):
+        with calls_lock:
+            calls.append(handle)
+        time.sleep(0.05)
+        if handle == "broken.example.com":
+            raise Exception("timeout")
+        return "did:plc:" + handle.split(".")[0]
+
+    text = " ".join(f"@user{i}.example.com" for i in range(MAX_MENTIONS + 5)) + " @broken.example.com"
+    start = time.perf_counter()
+    facets = extract_facets(text, resolve_slowly)
+    assert time.perf_counter() - start < 0.05 * 3
+    assert len(calls) == MAX_MENTIONS and "broken.example.com" not in calls
+    assert [f["features"][0]["did"] for f in facets] == [f"did:plc:user{i}" for i in range(MAX_MENTIONS)]
+    calls.clear()
+    assert extract_facets("@broken.example.com @user1.example.com", resolve_slowly)[0]["features"][0]["did"] == "did:plc:user1"
+
+    async def resolve_async(handle):
+        if handle == "broken.example.com":
+            raise Exception("timeout")
+        return resolved.get(handle)
+
+    assert asyncio.run(extract_facets_async("@bob.example.com @broken.example.com", resolve_async)) == [
+        {
+            "index": {"byteStart": 0, "byteEnd": 16},
+            "features": [{"$type": "app.bsky.richtext.facet#mention", "did": "did:plc:bob"}],
+        }
+    ]
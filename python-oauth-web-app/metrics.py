@@ -0,0 +1,270 @@
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from typing import Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+import atproto_cache
+
+# Minimal in-process metrics (counters and histograms) in the Prometheus text exposition format, without any extra dependencies. Metrics are per worker process: each worker's /metrics endpoint reports its own counts (scrape every worker, or add up the series).
+#
+# The outbound request metrics are recorded by the hardened HTTP session pool (see atproto_security.PooledHTTPSession), so every request made through it is counted. The calling code labels its requests with an operation name, with 'operation()'.
+
+# Latency buckets (seconds) for outbound requests
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# PDS and auth server hosts are an open-ended set. After this many distinct origins, new ones are all reported as "other".
+MAX_ORIGINS = 500
+
+# Operations whose requests go to a different host for almost every account, and so are reported with one fixed origin label instead (otherwise they would use up MAX_ORIGINS). HTTPS handle resolution fetches from the handle's own domain, and so does did:web DID resolution.
+FIXED_ORIGINS = {"resolve_handle": "handle", "resolve_did": "did_web"}
+# Origins which keep their own label, even for the operations in FIXED_ORIGINS: did:plc documents all come from the PLC directory (atproto_identity.PLC_DIRECTORY_URL)
+SHARED_ORIGINS = {"https://plc.directory"}
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str]):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str], buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (not cumulative; the last one is +Inf), count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            entry = self._values.get(labels)
+            return entry[1] if entry else 0
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted((labels, [list(e[0]), e[1], e[2]]) for labels, e in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (bucket_counts, count, total) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else format_value(bound)
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.labelnames + ('le',), labels + (le,))} {cumulative}"
+                )
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+        return lines
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+OUTBOUND_REQUEST_DURATION = Histogram(
+    "atproto_outbound_request_duration_seconds",
+    "Latency of outbound requests to atproto services, by operation and destination origin",
+    ["operation", "origin"],
+)
+OUTBOUND_REQUESTS = Counter(
+    "atproto_outbound_requests_total",
+    "Outbound requests to atproto services, by operation, destination origin and HTTP status ('error' if no response was received)",
+    ["operation", "origin", "status"],
+)
+DPOP_NONCE_RETRIES = Counter(
+    "atproto_dpop_nonce_retries_total",
+    "Requests retried because the server asked for a new DPoP nonce",
+    ["operation", "origin"],
+)
+
+METRICS = [OUTBOUND_REQUEST_DURATION, OUTBOUND_REQUESTS, DPOP_NONCE_RETRIES]
+# Functions called at render time, returning extra exposition lines (eg, values which are tracked elsewhere)
+COLLECTORS: list = []
+
+_origins: set = set()
+_origins_lock = threading.Lock()
+
+
+# The scheme://host[:port] of a URL, for use as a label value (see MAX_ORIGINS and FIXED_ORIGINS). Values which aren't URLs (eg, "dns") are used as they are.
+def origin_label(url: str, op: Optional[str] = None) -> str:
+    parts = urlparse(url)
+    if not parts.netloc:
+        return url
+    origin = f"{parts.scheme}://{parts.netloc}"
+    if op in FIXED_ORIGINS and origin not in SHARED_ORIGINS:
+        return FIXED_ORIGINS[op]
+    if origin in _origins:
+        return origin
+    with _origins_lock:
+        if len(_origins) < MAX_ORIGINS:
+            _origins.add(origin)
+            return origin
+    return "other"
+
+
+_operation: contextvars.ContextVar = contextvars.ContextVar("operation", default="other")
+
+
+# Labels the outbound requests made inside the 'with' block with an operation name, eg "resolve_did". Note that the label doesn't carry over to other threads.
+@contextlib.contextmanager
+def operation(name: str):
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def current_operation() -> str:
+    return _operation.get()
+
+
+# Records a finished (or failed) outbound request. 'status' is the HTTP status code, or None if no response was received.
+def record_request(url: str, status: Optional[int], seconds: float, op: Optional[str] = None):
+    op = op or _operation.get()
+    origin = origin_label(url, op)
+    OUTBOUND_REQUEST_DURATION.observe(seconds, op, origin)
+    OUTBOUND_REQUESTS.inc(op, origin, str(status) if status is not None else "error")
+
+
+def record_nonce_retry(url: str):
+    op = _operation.get()
+    DPOP_NONCE_RETRIES.inc(op, origin_label(url, op))
+
+
+# Times the body of the 'with' block as one outbound request, for lookups which don't go through the HTTP session pool (eg, DNS). The yielded dict's "status" can be set by the caller.
+@contextlib.contextmanager
+def observe(url: str, op: Optional[str] = None):
+    result = {"status": None}
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        record_request(url, result["status"], time.perf_counter() - start, op)
+
+
+# Cache hit/miss counts and sizes, from every TTLCache (caches with the same name are added up)
+def cache_lines() -> list:
+    totals = {}
+    for cache in list(atproto_cache.CACHES):
+        stats = cache.stats()
+        total = totals.setdefault(cache.name, dict.fromkeys(stats, 0))
+        for key, value in stats.items():
+            total[key] += value
+    lines = [
+        "# HELP atproto_cache_lookups_total Cache lookups, by cache and result",
+        "# TYPE atproto_cache_lookups_total counter",
+    ]
+    for name, stats in sorted(totals.items()):
+        for key, result in [("hits", "hit"), ("stale_hits", "stale_hit"), ("shared_hits", "shared_hit"), ("misses", "miss")]:
+            lines.append(f'atproto_cache_lookups_total{{cache="{name}",result="{result}"}} {stats[key]}')
+    lines += ["# HELP atproto_cache_entries Entries currently in the cache", "# TYPE atproto_cache_entries gauge"]
+    for name, stats in sorted(totals.items()):
+        lines.append(f'atproto_cache_entries{{cache="{name}"}} {stats["size"]}')
+    return lines
+
+
+COLLECTORS.append(cache_lines)
+
+
+def register_collector(func: Callable[[], list]):
+    COLLECTORS.append(func)
+
+
+# All metrics in the Prometheus text exposition format
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for collector in COLLECTORS:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    with operation("resolve_did"):
+        record_request("https://plc.directory/did:plc:abc", 200, 0.03)
+        record_request("https://plc.directory/did:plc:def", None, 2.0)
+        record_nonce_retry("https://plc.directory/did:plc:abc")
+    record_request("https://pds.example.com/xrpc/x", 201, 0.2, op="pds_write")
+    assert OUTBOUND_REQUESTS.value("resolve_did", "https://plc.directory", "200") == 1
+    assert OUTBOUND_REQUESTS.value("resolve_did", "https://plc.directory", "error") == 1
+    assert OUTBOUND_REQUEST_DURATION.count("resolve_did", "https://plc.directory") == 2
+    assert DPOP_NONCE_RETRIES.value("resolve_did", "https://plc.directory") == 1
+    assert current_operation() == "other"
+
+    text = render()
+    assert 'atproto_outbound_request_duration_seconds_bucket{operation="resolve_did",origin="https://plc.directory",le="0.05"} 1' in text
+    assert 'atproto_outbound_request_duration_seconds_bucket{operation="resolve_did",origin="https://plc.directory",le="+Inf"} 2' in text
+    assert 'atproto_outbound_requests_total{operation="pds_write",origin="https://pds.example.com",status="201"} 1' in text
+
+    # label values are escaped
+    assert format_labels(("a",), ('x"y',)) == '{a="x\\"y"}'
+
+    # handle resolution gets a fixed origin, and doesn't use up the origin budget
+    for i in range(MAX_ORIGINS):
+        record_request(f"https://handle{i}.example.com/.well-known/atproto-did", 200, 0.01, op="resolve_handle")
+    record_request("dns", None, 0.01, op="resolve_handle")
+    assert OUTBOUND_REQUESTS.value("resolve_handle", "handle", "200") == MAX_ORIGINS
+    assert OUTBOUND_REQUESTS.value("resolve_handle", "dns", "error") == 1
+    assert origin_label("https://pds.example.org/xrpc/x") == "https://pds.example.org"
+    # so does did:web resolution, but not the PLC directory
+    assert origin_label("https://alice.example.com/.well-known/did.json", "resolve_did") == "did_web"
+    assert origin_label("https://plc.directory/did:plc:abc", "resolve_did") == "https://plc.directory"
+
+    # otherwise, origin cardinality is bounded
+    for i in range(MAX_ORIGINS):
+        origin_label(f"https://host{i}.example.com/")
+    assert origin_label("https://one-too-many.example.com/") == "other"
+
+    cache = atproto_cache.TTLCache("metrics_test")
+    cache.get("k", lambda: "v")
+    cache.get("k", lambda: "v")
+    text = render()
+    assert 'atproto_cache_lookups_total{cache="metrics_test",result="hit"} 1' in text
+    assert 'atproto_cache_entries{cache="metrics_test"} 1' in text
+    print(text)
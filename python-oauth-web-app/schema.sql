@@ -8,9 +8,13 @@ CREATE TABLE IF NOT EXISTS oauth_auth_request (
     pkce_verifier TEXT NOT NULL,
     scope TEXT NOT NULL,
     dpop_authserver_nonce TEXT NOT NULL,
-    dpop_private_jwk TEXT NOT NULL
+    dpop_private_jwk TEXT NOT NULL,
+    -- creation time (unix seconds). Requests older than the auth request TTL are rejected by the callback, and deleted in the background
+    created_at INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS oauth_auth_request_created_at ON oauth_auth_request (created_at);
+
 CREATE TABLE IF NOT EXISTS oauth_session (
     did TEXT NOT NULL PRIMARY KEY,
     handle TEXT,
@@ -18,7 +22,13 @@ CREATE TABLE IF NOT EXISTS oauth_session (
     authserver_iss TEXT NOT NULL,
     access_token TEXT,
     refresh_token TEXT,
+    -- access token expiry time (unix seconds), computed from the token response 'expires_in'
+    expires_at INTEGER,
+    -- while a token refresh is in progress, the time (unix seconds) until which one worker process holds the right to refresh
+    refresh_lease_until INTEGER,
     dpop_authserver_nonce TEXT NOT NULL,
     dpop_pds_nonce TEXT,
-    dpop_private_jwk TEXT NOT NULL
+    dpop_private_jwk TEXT NOT NULL,
+    -- when the user last used the session (unix seconds, updated at most every few minutes). Idle sessions stop being refreshed in the background
+    last_seen_at INTEGER
 );
@@ -0,0 +1,588 @@
+import time
+import queue
+import sqlite3
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from atproto_cache import TTLCache
+
+# Columns of the two tables in schema.sql, in order
+AUTH_REQUEST_COLUMNS = [
+    "state",
+    "authserver_iss",
+    "did",
+    "handle",
+    "pds_url",
+    "pkce_verifier",
+    "scope",
+    "dpop_authserver_nonce",
+    "dpop_private_jwk",
+    "created_at",
+]
+SESSION_COLUMNS = [
+    "did",
+    "handle",
+    "pds_url",
+    "authserver_iss",
+    "access_token",
+    "refresh_token",
+    "expires_at",
+    "refresh_lease_until",
+    "dpop_authserver_nonce",
+    "dpop_pds_nonce",
+    "dpop_private_jwk",
+    "last_seen_at",
+]
+# Bumped whenever schema.sql (or the migrations in SqliteSessionStore) change. Stored in the database file's 'user_version', so that worker processes starting up against an up-to-date database can skip schema setup.
+SCHEMA_VERSION = 2
+
+# The session columns needed to render pages for a logged-in user (and to schedule token refreshes), without any tokens or keys
+SESSION_SUMMARY_COLUMNS = ["did", "handle", "pds_url", "expires_at", "last_seen_at"]
+
+
+# Storage for OAuth state: in-progress auth requests (keyed by 'state'), and account sessions including tokens and DPoP nonces (keyed by DID).
+# Rows are plain dicts with the columns listed above. Implementations must provide every abstract method. All methods are blocking and thread-safe; 'blocking' tells asyncio code whether calls need to be moved off the event loop.
+class SessionStore(ABC):
+    blocking = True
+
+    # 'created_at' defaults to the current time
+    @abstractmethod
+    def save_auth_request(self, row: dict):
+        raise NotImplementedError
+
+    # Returns and deletes the auth request in one step, so that a callback can't be replayed
+    @abstractmethod
+    def pop_auth_request(self, state: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    # Deletes up to 'limit' auth requests created before 'before' (unix seconds), oldest first. Returns the number deleted.
+    @abstractmethod
+    def delete_expired_auth_requests(self, before: int, limit: int) -> int:
+        raise NotImplementedError
+
+    # 'cached=False' asks for the current row, bypassing any cache (stores without a cache ignore it)
+    @abstractmethod
+    def get_session(self, did: str, cached: bool = True) -> Optional[dict]:
+        raise NotImplementedError
+
+    # Returns only the SESSION_SUMMARY_COLUMNS of a session
+    @abstractmethod
+    def get_session_summary(self, did: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    # Inserts or replaces the whole session row
+    @abstractmethod
+    def save_session(self, row: dict):
+        raise NotImplementedError
+
+    # Stores refreshed tokens, and releases any refresh lease
+    @abstractmethod
+    def update_session_tokens(
+        self,
+        did: str,
+        access_token: str,
+        refresh_token: str,
+        expires_at: Optional[int],
+        dpop_authserver_nonce: str,
+    ):
+        raise NotImplementedError
+
+    # Takes the right to refresh a session until 'until', if the session still has 'access_token' and nobody else holds an unexpired lease. Returns whether the lease was taken.
+    @abstractmethod
+    def claim_refresh_lease(self, did: str, access_token: str, until: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_refresh_lease(self, did: str):
+        raise NotImplementedError
+
+    # Records that the session was used at 'last_seen_at' (unix seconds)
+    @abstractmethod
+    def touch_session(self, did: str, last_seen_at: int):
+        raise NotImplementedError
+
+    # Takes a dict of DID -> latest PDS DPoP nonce
+    @abstractmethod
+    def save_pds_nonces(self, nonces: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_session(self, did: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# Session store in a sqlite database file, for deployments with several worker processes.
+# - the database is in WAL mode, so lookups never wait for writers (and vice versa)
+# - connections are long-lived and pooled, so sqlite's per-connection statement cache means each query is only compiled once
+# - lookups use connections which can only read, in autocommit mode, so every SELECT is its own short read transaction and nothing needs to be committed
+# - writes in this process go through a single connection (sqlite only allows one writer at a time anyway), so threads queue on a lock instead of spinning on SQLITE_BUSY; other processes are waited on with 'busy_timeout'
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path: str, schema_path: Optional[str] = None, readers: int = 8):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        if schema_path is not None:
+            self._init_schema(schema_path)
+        self._readers = queue.LifoQueue()
+        for _ in range(readers):
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+            self._readers.put(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=64,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self, schema_path: str):
+        if self._writer.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        print("initializing database...")
+        # databases created before these columns were added need to be migrated, before the schema (which indexes them) is applied. Tables which don't exist yet have no columns, and are skipped.
+        migrations = {
+            "oauth_session": [
+                ("expires_at", "INTEGER"),
+                ("refresh_lease_until", "INTEGER"),
+                ("last_seen_at", "INTEGER"),
+            ],
+            # existing rows get created_at = 0, so they are treated as expired
+            "oauth_auth_request": [("created_at", "INTEGER NOT NULL DEFAULT 0")],
+        }
+        for table, new_columns in migrations.items():
+            columns = [row["name"] for row in self._writer.execute(f"PRAGMA table_info({table})")]
+            if not columns:
+                continue
+            for column, column_type in new_columns:
+                if column not in columns:
+                    self._writer.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        with open(schema_path) as f:
+            self._writer.executescript(f.read())
+        self._writer.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _read_one(self, query: str, args) -> Optional[dict]:
+        conn = self._readers.get()
+        try:
+            row = conn.execute(query, args).fetchone()
+        finally:
+            self._readers.put(conn)
+        return dict(row) if row is not None else None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def _write(self, query: str, args) -> int:
+        with self._write_lock:
+            return self._writer.execute(query, args).rowcount
+
+    def save_auth_request(self, row: dict):
+        row = {"created_at": int(time.time())} | row
+        self._write(
+            "INSERT INTO oauth_auth_request (state, authserver_iss, did, handle, pds_url, pkce_verifier, scope, dpop_authserver_nonce, dpop_private_jwk, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            [row.get(col) for col in AUTH_REQUEST_COLUMNS],
+        )
+
+    def pop_auth_request(self, state: str) -> Optional[dict]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM oauth_auth_request WHERE state = ?;", [state]
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM oauth_auth_request WHERE state = ?;", [state])
+        return dict(row)
+
+    # the batch is picked using the created_at index, so each call only touches 'limit' rows no matter how large the table is
+    def delete_expired_auth_requests(self, before: int, limit: int) -> int:
+        return self._write(
+            "DELETE FROM oauth_auth_request WHERE state IN (SELECT state FROM oauth_auth_request WHERE created_at < ? ORDER BY created_at LIMIT ?);",
+            [before, limit],
+        )
+
+    def get_session(self, did: str, cached: bool = True) -> Optional[dict]:
+        return self._read_one("SELECT * FROM oauth_session WHERE did = ?;", [did])
+
+    def get_session_summary(self, did: str) -> Optional[dict]:
+        return self._read_one(
+            "SELECT did, handle, pds_url, expires_at, last_seen_at FROM oauth_session WHERE did = ?;", [did]
+        )
+
+    def save_session(self, row: dict):
+        self._write(
+            "INSERT OR REPLACE INTO oauth_session (did, handle, pds_url, authserver_iss, access_token, refresh_token, expires_at, refresh_lease_until, dpop_authserver_nonce, dpop_pds_nonce, dpop_private_jwk, last_seen_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            [row.get(col) for col in SESSION_COLUMNS],
+        )
+
+    def update_session_tokens(self, did, access_token, refresh_token, expires_at, dpop_authserver_nonce):
+        self._write(
+            "UPDATE oauth_session SET access_token = ?, refresh_token = ?, expires_at = ?, dpop_authserver_nonce = ?, refresh_lease_until = NULL WHERE did = ?;",
+            [access_token, refresh_token, expires_at, dpop_authserver_nonce, did],
+        )
+
+    def claim_refresh_lease(self, did: str, access_token: str, until: int) -> bool:
+        now = int(time.time())
+        changed = self._write(
+            "UPDATE oauth_session SET refresh_lease_until = ? WHERE did = ? AND access_token = ? AND (refresh_lease_until IS NULL OR refresh_lease_until < ?);",
+            [until, did, access_token, now],
+        )
+        return changed == 1
+
+    def release_refresh_lease(self, did: str):
+        self._write("UPDATE oauth_session SET refresh_lease_until = NULL WHERE did = ?;", [did])
+
+    def touch_session(self, did: str, last_seen_at: int):
+        self._write("UPDATE oauth_session SET last_seen_at = ? WHERE did = ?;", [last_seen_at, did])
+
+    def save_pds_nonces(self, nonces: dict):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE oauth_session SET dpop_pds_nonce = ? WHERE did = ?;",
+                [(nonce, did) for did, nonce in nonces.items()],
+            )
+
+    def delete_session(self, did: str):
+        self._write("DELETE FROM oauth_session WHERE did = ?;", [did])
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get().close()
+
+
+# Session store in process memory, for single-process deployments (and local testing). Everything is lost on restart, and it must not be used with several worker processes, since each would have its own sessions.
+class MemorySessionStore(SessionStore):
+    blocking = False
+
+    def __init__(self):
+        self._auth_requests = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def save_auth_request(self, row: dict):
+        with self._lock:
+            if row["state"] in self._auth_requests:
+                raise ValueError("duplicate auth request state")
+            row = {"created_at": int(time.time())} | row
+            self._auth_requests[row["state"]] = {col: row.get(col) for col in AUTH_REQUEST_COLUMNS}
+
+    def pop_auth_request(self, state: str) -> Optional[dict]:
+        with self._lock:
+            return self._auth_requests.pop(state, None)
+
+    # dicts keep insertion order, which is (near enough) creation order, so expired requests are at the front
+    def delete_expired_auth_requests(self, before: int, limit: int) -> int:
+        deleted = 0
+        with self._lock:
+            for state, row in self._auth_requests.items():
+                if deleted >= limit or row["created_at"] >= before:
+                    break
+                deleted += 1
+            for state in list(self._auth_requests)[:deleted]:
+                del self._auth_requests[state]
+        return deleted
+
+    # copies are returned, so that callers can't modify the stored session
+    def get_session(self, did: str, cached: bool = True) -> Optional[dict]:
+        with self._lock:
+            row = self._sessions.get(did)
+            return dict(row) if row is not None else None
+
+    def get_session_summary(self, did: str) -> Optional[dict]:
+        with self._lock:
+            row = self._sessions.get(did)
+            return {col: row[col] for col in SESSION_SUMMARY_COLUMNS} if row is not None else None
+
+    def save_session(self, row: dict):
+        with self._lock:
+            self._sessions[row["did"]] = {col: row.get(col) for col in SESSION_COLUMNS}
+
+    def update_session_tokens(self, did, access_token, refresh_token, expires_at, dpop_authserver_nonce):
+        with self._lock:
+            row = self._sessions.get(did)
+            if row is not None:
+                row.update(
+                    access_token=access_token,
+                    refresh_token=refresh_token,
+                    expires_at=expires_at,
+                    dpop_authserver_nonce=dpop_authserver_nonce,
+                    refresh_lease_until=None,
+                )
+
+    def claim_refresh_lease(self, did: str, access_token: str, until: int) -> bool:
+        now = int(time.time())
+        with self._lock:
+            row = self._sessions.get(did)
+            if row is None or row["access_token"] != access_token:
+                return False
+            if row["refresh_lease_until"] is not None and row["refresh_lease_until"] >= now:
+                return False
+            row["refresh_lease_until"] = until
+            return True
+
+    def release_refresh_lease(self, did: str):
+        with self._lock:
+            if did in self._sessions:
+                self._sessions[did]["refresh_lease_until"] = None
+
+    def touch_session(self, did: str, last_seen_at: int):
+        with self._lock:
+            if did in self._sessions:
+                self._sessions[did]["last_seen_at"] = last_seen_at
+
+    def save_pds_nonces(self, nonces: dict):
+        with self._lock:
+            for did, nonce in nonces.items():
+                if did in self._sessions:
+                    self._sessions[did]["dpop_pds_nonce"] = nonce
+
+    def delete_session(self, did: str):
+        with self._lock:
+            self._sessions.pop(did, None)
+
+
+# Wraps another session store with short-lived, bounded, in-process caches of session rows, so that most requests for a logged-in user don't need a database round trip.
+# Every write made through this wrapper (callback, token refresh, logout, nonce updates) invalidates the cached rows for that account. Writes made by other worker processes are only seen once the cached entry expires, so 'ttl' should be a few seconds; code which needs the current row (eg, to coordinate token refreshes between processes) passes 'cached=False'.
+# Cached rows are never written to the shared cache tier, since full rows include tokens and keys.
+class CachedSessionStore(SessionStore):
+    def __init__(self, store: SessionStore, ttl: float = 5, maxsize: int = 10000):
+        self.store = store
+        self.blocking = store.blocking
+        self.ttl = ttl
+        self.sessions = TTLCache("session", maxsize=maxsize, ttl=ttl, negative_ttl=ttl, shared=False)
+        self.summaries = TTLCache("session_summary", maxsize=maxsize, ttl=ttl, negative_ttl=ttl, shared=False)
+
+    def _invalidate(self, did: str):
+        self.sessions.invalidate(did)
+        self.summaries.invalidate(did)
+
+    def save_auth_request(self, row: dict):
+        self.store.save_auth_request(row)
+
+    def pop_auth_request(self, state: str) -> Optional[dict]:
+        return self.store.pop_auth_request(state)
+
+    def delete_expired_auth_requests(self, before: int, limit: int) -> int:
+        return self.store.delete_expired_auth_requests(before, limit)
+
+    # the cached rows are shared between requests, so callers get a copy
+    def get_session(self, did: str, cached: bool = True) -> Optional[dict]:
+        if not cached:
+            return self.store.get_session(did)
+        row = self.sessions.get(did, lambda: self.store.get_session(did))
+        return dict(row) if row is not None else None
+
+    def get_session_summary(self, did: str) -> Optional[dict]:
+        row = self.summaries.get(did, lambda: self.store.get_session_summary(did))
+        return dict(row) if row is not None else None
+
+    def save_session(self, row: dict):
+        self.store.save_session(row)
+        self._invalidate(row["did"])
+
+    def update_session_tokens(self, did, access_token, refresh_token, expires_at, dpop_authserver_nonce):
+        self.store.update_session_tokens(did, access_token, refresh_token, expires_at, dpop_authserver_nonce)
+        self._invalidate(did)
+
+    def claim_refresh_lease(self, did: str, access_token: str, until: int) -> bool:
+        return self.store.claim_refresh_lease(did, access_token, until)
+
+    def release_refresh_lease(self, did: str):
+        self.store.release_refresh_lease(did)
+
+    def touch_session(self, did: str, last_seen_at: int):
+        self.store.touch_session(did, last_seen_at)
+        self._invalidate(did)
+
+    def save_pds_nonces(self, nonces: dict):
+        self.store.save_pds_nonces(nonces)
+        for did in nonces:
+            self.sessions.invalidate(did)
+
+    def delete_session(self, did: str):
+        self.store.delete_session(did)
+        self._invalidate(did)
+
+    def close(self):
+        self.store.close()
+
+
+# Background thread which deletes auth requests older than 'ttl' seconds: logins which were abandoned before the callback would otherwise stay in the store forever.
+# Rows are deleted in small batches (with a pause in between), so the sweeper never holds the database write lock for long, even after a burst of abandoned logins. The thread is started lazily by the first start() call.
+class AuthRequestSweeper:
+    def __init__(
+        self,
+        store: SessionStore,
+        ttl: float = 900,
+        interval: float = 60,
+        batch_size: int = 100,
+        batch_pause: float = 0.05,
+    ):
+        self.store = store
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="auth-request-sweeper", daemon=True
+                )
+                self._thread.start()
+
+    # Deletes all currently expired auth requests. Returns the number deleted.
+    def sweep(self) -> int:
+        total = 0
+        while True:
+            before = int(time.time() - self.ttl)
+            deleted = self.store.delete_expired_auth_requests(before, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            time.sleep(self.batch_pause)
+
+    def _run(self):
+        while True:
+            try:
+                deleted = self.sweep()
+                if deleted:
+                    print(f"deleted {deleted} expired oauth_auth_request rows")
+            except Exception as e:
+                print(f"failed to sweep expired auth requests: {e}")
+            time.sleep(self.interval)
+
+
+# 'kind' is "sqlite" (the default) or "memory". sqlite session rows are cached for 'cache_ttl' seconds (0 disables the cache); the memory store doesn't need a cache.
+def make_session_store(
+    kind: Optional[str], path: str, schema_path: str, cache_ttl: float = 5
+) -> SessionStore:
+    if kind in (None, "", "sqlite"):
+        store = SqliteSessionStore(path, schema_path=schema_path)
+        if cache_ttl > 0:
+            store = CachedSessionStore(store, ttl=cache_ttl)
+        return store
+    if kind == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"unknown session store: {kind}")
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = [
+            SqliteSessionStore(os.path.join(tmp, "test.sqlite"), schema_path=schema_path),
+            MemorySessionStore(),
+        ]
+        for store in stores:
+            store.save_auth_request({
+                "state": "s1",
+                "authserver_iss": "https://as.example.com",
+                "pkce_verifier": "v",
+                "scope": "atproto",
+                "dpop_authserver_nonce": "n",
+                "dpop_private_jwk": "{}",
+            })
+            row = store.pop_auth_request("s1")
+            assert row["authserver_iss"] == "https://as.example.com" and row["created_at"]
+            assert store.pop_auth_request("s1") is None
+
+            for i in range(5):
+                store.save_auth_request({
+                    "state": f"old{i}",
+                    "authserver_iss": "https://as.example.com",
+                    "pkce_verifier": "v",
+                    "scope": "atproto",
+                    "dpop_authserver_nonce": "n",
+                    "dpop_private_jwk": "{}",
+                    "created_at": 1000 + i,
+                })
+            store.save_auth_request({
+                "state": "new",
+                "authserver_iss": "https://as.example.com",
+                "pkce_verifier": "v",
+                "scope": "atproto",
+                "dpop_authserver_nonce": "n",
+                "dpop_private_jwk": "{}",
+            })
+            assert AuthRequestSweeper(store, ttl=60, batch_size=2, batch_pause=0).sweep() == 5
+            assert store.pop_auth_request("old4") is None
+            assert store.pop_auth_request("new") is not None
+
+            store.save_session({
+                "did": "did:example:alice",
+                "pds_url": "https://pds.example.com",
+                "authserver_iss": "https://as.example.com",
+                "access_token": "a1",
+                "refresh_token": "r1",
+                "dpop_authserver_nonce": "n",
+                "dpop_private_jwk": "{}",
+            })
+            assert store.claim_refresh_lease("did:example:alice", "a1", int(time.time()) + 30)
+            assert not store.claim_refresh_lease("did:example:alice", "a1", int(time.time()) + 30)
+            store.update_session_tokens("did:example:alice", "a2", "r2", None, "n2")
+            assert not store.claim_refresh_lease("did:example:alice", "a1", int(time.time()) + 30)
+            store.save_pds_nonces({"did:example:alice": "p1", "did:example:bob": "p2"})
+            row = store.get_session("did:example:alice")
+            assert row["access_token"] == "a2" and row["dpop_pds_nonce"] == "p1"
+            assert row["refresh_lease_until"] is None
+            store.touch_session("did:example:alice", 1234)
+            assert store.get_session_summary("did:example:alice")["last_seen_at"] == 1234
+            store.delete_session("did:example:alice")
+            assert store.get_session("did:example:alice") is None
+            store.close()
+
+        # cached rows are invalidated by writes through the cache
+        store = CachedSessionStore(MemorySessionStore(), ttl=60)
+        session = {
+            "did": "did:example:alice",
+            "handle": "alice.example.com",
+            "pds_url": "https://pds.example.com",
+            "authserver_iss": "https://as.example.com",
+            "access_token": "a1",
+            "refresh_token": "r1",
+            "dpop_authserver_nonce": "n",
+            "dpop_private_jwk": "{}",
+        }
+        assert store.get_session_summary("did:example:alice") is None
+        store.save_session(session)
+        assert store.get_session_summary("did:example:alice") == {
+            "did": "did:example:alice",
+            "handle": "alice.example.com",
+            "pds_url": "https://pds.example.com",
+            "expires_at": None,
+            "last_seen_at": None,
+        }
+        assert store.get_session("did:example:alice")["access_token"] == "a1"
+        store.store.update_session_tokens("did:example:alice", "a2", "r2", None, "n")
+        assert store.get_session("did:example:alice")["access_token"] == "a1"
+        assert store.get_session("did:example:alice", cached=False)["access_token"] == "a2"
+        store.delete_session("did:example:alice")
+        assert store.get_session("did:example:alice") is None
+    print("ok")
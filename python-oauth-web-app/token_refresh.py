@@ -0,0 +1,173 @@
+import time
+import heapq
+import asyncio
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+# Background scheduler which refreshes OAuth sessions shortly before their access tokens expire, so that user requests don't have to wait for (or discover the need for) a token refresh.
+#
+# Sessions are kept in a heap ordered by refresh time ('expires_at' minus 'lead_time'). A single timer thread sleeps until the next refresh is due, then hands it off to a small worker pool, which bounds the number of concurrent refresh requests.
+#
+# 'refresh_func(did, context)' does the actual refresh (and persists the result). It returns the new expiry time (unix seconds), in which case the session is re-scheduled, or None to stop tracking the session. 'context' is whatever was passed to schedule(), eg the OAuth client_id.
+class RefreshScheduler:
+    def __init__(
+        self,
+        refresh_func: Callable[[str, Any], Optional[float]],
+        lead_time: float = 120,
+        max_workers: int = 4,
+    ):
+        self.refresh_func = refresh_func
+        self.lead_time = lead_time
+        self.max_workers = max_workers
+        # heap of (refresh_at, did). Re-scheduled or cancelled sessions leave stale heap entries behind, which are skipped by checking against '_scheduled'.
+        self._heap = []
+        # did -> (refresh_at, context)
+        self._scheduled = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    def schedule(self, did: str, expires_at: float, context: Any = None):
+        refresh_at = expires_at - self.lead_time
+        with self._cond:
+            self._scheduled[did] = (refresh_at, context)
+            heapq.heappush(self._heap, (refresh_at, did))
+            # the thread and pool are started lazily, so that nothing is started before a server forks its worker processes
+            if self._thread is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="token-refresh"
+                )
+                self._thread = threading.Thread(
+                    target=self._run, name="token-refresh-scheduler", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def is_scheduled(self, did: str) -> bool:
+        with self._cond:
+            return did in self._scheduled
+
+    def cancel(self, did: str):
+        with self._cond:
+            self._scheduled.pop(did, None)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._scheduled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    refresh_at, did = self._heap[0]
+                    current = self._scheduled.get(did)
+                    if current is None or current[0] != refresh_at:
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = refresh_at - time.time()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    del self._scheduled[did]
+                    context = current[1]
+                    break
+            self._pool.submit(self._refresh, did, context)
+
+    def _refresh(self, did: str, context: Any):
+        try:
+            expires_at = self.refresh_func(did, context)
+        except Exception as e:
+            # the session is dropped from the schedule; it will be picked up again next time it is used
+            print(f"background token refresh failed for {did}: {e}")
+            return
+        if expires_at is not None:
+            with self._cond:
+                # don't override a newer schedule() call made while the refresh was running
+                if did in self._scheduled:
+                    return
+            self.schedule(did, expires_at, context)
+
+
+# Per-key locks, used so that only one thread per process refreshes the tokens for a given account at a time (a refresh token can only be used once, so concurrent refreshes would invalidate each other).
+# Locks are reference-counted and removed when no longer in use, so this doesn't grow with the number of accounts.
+class KeyedLock:
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+
+# asyncio version of KeyedLock, for code running on a single event loop
+class AsyncKeyedLock:
+    def __init__(self):
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+if __name__ == "__main__":
+    refreshed = []
+
+    def refresh(did, context):
+        refreshed.append((did, context))
+        return None
+
+    scheduler = RefreshScheduler(refresh, lead_time=10)
+    now = time.time()
+    scheduler.schedule("did:example:later", now + 60)
+    scheduler.schedule("did:example:soon", now + 10.1, context="client")
+    scheduler.schedule("did:example:cancelled", now + 10)
+    scheduler.cancel("did:example:cancelled")
+    time.sleep(0.5)
+    assert refreshed == [("did:example:soon", "client")]
+    assert scheduler.is_scheduled("did:example:later")
+    assert len(scheduler) == 1
+
+    locks = KeyedLock()
+    with locks.lock("did:example:alice"):
+        with locks.lock("did:example:bob"):
+            assert len(locks._locks) == 2
+    assert locks._locks == {}
+
+    async def check_async_lock():
+        locks = AsyncKeyedLock()
+        async with locks.lock("did:example:alice"):
+            assert len(locks._locks) == 1
+        assert locks._locks == {}
+
+    asyncio.run(check_async_lock())
+    print("ok")
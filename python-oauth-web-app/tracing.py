@@ -0,0 +1,369 @@
+import json
+import time
+import inspect
+import random
+import secrets
+import functools
+import threading
+import contextvars
+from typing import Any, Optional
+
+# Lightweight span tracing, for finding out which stage of a request (eg, DNS, PLC directory, auth server metadata, PAR) is slow.
+#
+# - spans are nested with a contextvar, so they follow the call stack (including asyncio tasks). Threads don't inherit it: work handed to a thread pool needs to be submitted with 'contextvars.copy_context().run' to stay in the same trace.
+# - the sampling decision is made once per trace (when the root span starts); spans in unsampled traces cost about as much as when tracing is disabled
+# - finished traces are handed to an exporter as a whole, when the root span ends: LogExporter prints an indented tree, OTLPFileExporter appends OTLP/JSON lines which OpenTelemetry tools can import
+#
+# Tracing is disabled until configure() is called with an exporter. When disabled, span() returns a shared no-op object, and functions decorated with traced() just make one extra call.
+
+_exporter = None
+_sample_rate = 1.0
+
+# The current span; or UNSAMPLED inside a trace which wasn't sampled; or None outside of any trace
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+UNSAMPLED = object()
+
+
+def configure(exporter=None, sample_rate: float = 1.0):
+    global _exporter, _sample_rate
+    _exporter = exporter
+    _sample_rate = sample_rate
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: str, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+# Stands in for a span when tracing is disabled, or the trace isn't sampled
+class NoopSpan:
+    def set(self, key: str, value: Any):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class _SpanContext:
+    __slots__ = ("name", "kind", "attributes", "span", "token")
+
+    def __init__(self, name: str, kind: str, attributes: dict):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is UNSAMPLED:
+            self.span = None
+            self.token = None
+            return NOOP_SPAN
+        if parent is None:
+            if random.random() >= _sample_rate:
+                self.span = None
+                self.token = _current.set(UNSAMPLED)
+                return NOOP_SPAN
+            trace, parent_id = Trace(), None
+        else:
+            trace, parent_id = parent.trace, parent.span_id
+        self.span = Span(trace, self.name, parent_id, self.kind, self.attributes)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.token is not None:
+            _current.reset(self.token)
+        span = self.span
+        if span is None:
+            return False
+        span.end_ns = time.time_ns()
+        if exc is not None:
+            span.error = f"{exc_type.__name__}: {exc}"
+        span.trace.add(span)
+        # the root span finishing completes the trace
+        if span.parent_id is None and _exporter is not None:
+            try:
+                _exporter.export(span.trace)
+            except Exception as e:
+                print(f"failed to export trace: {e}")
+        return False
+
+
+# Times the body of a 'with' block as a span, eg:
+#
+#   with tracing.span("save_session", did=did) as sp:
+#       ...
+#       sp.set("rows", 1)
+#
+# 'kind' is "internal", or "client" for outbound requests.
+def span(name: str, kind: str = "internal", **attributes):
+    if _exporter is None:
+        return NOOP_SPAN
+    return _SpanContext(name, kind, attributes)
+
+
+# Decorator which records every call of the function as a span (named after the function by default). Works for coroutine functions too, where the span covers the whole await.
+def traced(name: Optional[str] = None, kind: str = "internal"):
+    def decorator(func):
+        span_name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _exporter is None:
+                    return await func(*args, **kwargs)
+                with _SpanContext(span_name, kind, {}):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _exporter is None:
+                return func(*args, **kwargs)
+            with _SpanContext(span_name, kind, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# The current span (a no-op span outside of a sampled trace), eg for adding attributes
+def current_span():
+    current = _current.get()
+    if current is None or current is UNSAMPLED:
+        return NOOP_SPAN
+    return current
+
+
+# Prints each trace as an indented tree of spans, with durations
+class LogExporter:
+    def export(self, trace: Trace):
+        spans = sorted(trace.spans, key=lambda s: s.start_ns)
+        children = {}
+        for s in spans:
+            children.setdefault(s.parent_id, []).append(s)
+        root = children[None][0]
+        lines = []
+
+        def walk(s: Span, depth: int):
+            attrs = " ".join(f"{k}={v}" for k, v in s.attributes.items())
+            offset = (s.start_ns - root.start_ns) / 1e6
+            error = f" ERROR {s.error}" if s.error else ""
+            lines.append(f"  {'  ' * depth}{s.name} {s.duration_ms:.1f}ms (+{offset:.1f}ms) {attrs}{error}".rstrip())
+            for child in children.get(s.span_id, []):
+                walk(child, depth + 1)
+
+        walk(root, 0)
+        print(f"trace {trace.trace_id}:\n" + "\n".join(lines))
+
+
+# Appends each trace to a file as one line of OTLP/JSON (an ExportTraceServiceRequest), which can be loaded with eg the OpenTelemetry Collector's "otlpjsonfile" receiver
+class OTLPFileExporter:
+    KINDS = {"internal": 1, "server": 2, "client": 3}
+
+    def __init__(self, path: str, service_name: str = "atproto-oauth-flask-demo"):
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace):
+        line = json.dumps(self.to_otlp(trace), separators=(",", ":"))
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def to_otlp(self, trace: Trace) -> dict:
+        spans = []
+        for s in trace.spans:
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": self.KINDS.get(s.kind, 1),
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [otlp_attribute(k, v) for k, v in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {},
+            }
+            if s.parent_id:
+                otlp_span["parentSpanId"] = s.parent_id
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [otlp_attribute("service.name", self.service_name)]},
+                    "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+def otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+# Builds an exporter from configuration: "log", "otlp-file" (written to 'path'), or "" / None for no tracing
+def make_exporter(kind: Optional[str], path: str = "traces.jsonl"):
+    if not kind:
+        return None
+    if kind == "log":
+        return LogExporter()
+    if kind == "otlp-file":
+        return OTLPFileExporter(path)
+    raise ValueError(f"unknown tracing exporter: {kind}")
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import concurrent.futures
+
+    class ListExporter:
+        def __init__(self):
+            self.traces = []
+
+        def export(self, trace: Trace):
+            self.traces.append(trace)
+
+    @traced()
+    def work(n):
+        with span("inner", n=n) as sp:
+            sp.set("done", True)
+        return n
+
+    # disabled: no spans, and the overhead is a single extra call
+    assert span("x") is NOOP_SPAN
+    assert work(1) == 1
+    start = time.perf_counter()
+    for i in range(100000):
+        work(i)
+    disabled = (time.perf_counter() - start) / 100000
+
+    exporter = ListExporter()
+    configure(exporter)
+    with span("root", route="/oauth/login"):
+        work(2)
+        # the trace follows work handed to another thread, if the context is copied
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            pool.submit(contextvars.copy_context().run, work, 3).result()
+        try:
+            with span("failing"):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+    assert len(exporter.traces) == 1
+    trace = exporter.traces[0]
+    by_name = {}
+    for s in trace.spans:
+        by_name.setdefault(s.name, []).append(s)
+    root = by_name["root"][0]
+    assert root.parent_id is None and root.attributes == {"route": "/oauth/login"}
+    assert all(s.parent_id == root.span_id for s in by_name["work"])
+    assert len(by_name["inner"]) == 2 and by_name["inner"][0].attributes["done"] is True
+    assert by_name["failing"][0].error == "ValueError: boom"
+    assert current_span() is NOOP_SPAN
+
+    # coroutine functions: the span covers the await, and concurrent tasks stay in the trace
+    import asyncio
+
+    @traced()
+    async def async_work(n):
+        await asyncio.sleep(0.01)
+        return work(n)
+
+    async def async_root():
+        with span("async_root"):
+            await asyncio.gather(async_work(6), async_work(7))
+
+    asyncio.run(async_root())
+    assert len(exporter.traces) == 2
+    by_name = {}
+    for s in exporter.traces[1].spans:
+        by_name.setdefault(s.name, []).append(s)
+    async_root_span = by_name["async_root"][0]
+    assert len(by_name["async_work"]) == 2
+    assert all(s.parent_id == async_root_span.span_id for s in by_name["async_work"])
+    assert all(s.duration_ms >= 10 for s in by_name["async_work"])
+    assert {s.parent_id for s in by_name["work"]} == {s.span_id for s in by_name["async_work"]}
+    del exporter.traces[1]
+
+    # sampling: unsampled traces record nothing, including their child spans
+    configure(exporter, sample_rate=0.0)
+    with span("root"):
+        work(4)
+        assert current_span() is NOOP_SPAN
+    assert len(exporter.traces) == 1
+
+    configure(exporter)
+    start = time.perf_counter()
+    for i in range(10000):
+        work(i)
+    enabled_cost = (time.perf_counter() - start) / 10000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "traces.jsonl")
+        configure(make_exporter("otlp-file", path))
+        with span("root"):
+            work(5)
+        with open(path) as f:
+            otlp = json.loads(f.readline())
+        spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert {s["name"] for s in spans} == {"root", "work", "inner"}
+        inner = next(s for s in spans if s["name"] == "inner")
+        assert inner["attributes"] == [
+            {"key": "n", "value": {"intValue": "5"}},
+            {"key": "done", "value": {"boolValue": True}},
+        ]
+
+    configure(LogExporter())
+    with span("root"):
+        work(6)
+    configure(None)
+    print(f"traced() call overhead: {disabled * 1e6:.2f}us disabled, {enabled_cost * 1e6:.2f}us per traced call with 2 spans")